@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Encryption of medallions and hack_licenses, shared by misc_code/anonymize_data.py
+and trip_scan.AnonymizeConsumer.  Each distinct id is encrypted with AES only once
+per process (the results are cached), and the trip and fare files are handled in
+aligned chunks of raw lines, which are rewritten as strings - only the first two
+columns change.
+
+pycrypto is only imported when the first id is encrypted, so the other consumers
+of trip_scan.py do not need it.
+
+@author: Brian Donovan (briandonovan100@gmail.com)
+"""
+from tools import parseUtc
+
+
+# The number of lines (from both the trip and fare file) in each chunk of work
+CHUNK_LINES = 200000
+
+# Per-process cache of encrypted ids.  Maps secret --> (cipher, {hex id : encrypted hex id})
+_encrypted_ids = {}
+
+
+# Uses a cipher to encrypt a hex string as another hex string
+def code(orig, cipher):
+    b64 = orig.decode('hex')
+    b64Enc = cipher.encrypt(b64)
+    return b64Enc.encode('hex').upper()
+
+
+# Encrypts many hex strings at once, using the cache of previously encrypted ids
+# AES (in the default ECB mode) encrypts each 16-byte block independently, so all of the new ids
+# which decode to exactly one block are concatenated and encrypted in a single call
+# Params:
+    # ids - a collection of hex strings
+    # secret - the AES key
+# Returns:
+    # A dictionary which maps every id in the cache to its encrypted version.  Ids which cannot be
+    # encrypted (not hex, or not a multiple of 16 bytes) are left out
+def encryptIds(ids, secret):
+    if(secret not in _encrypted_ids):
+        from Crypto.Cipher import AES
+        _encrypted_ids[secret] = (AES.new(secret), {})
+    (cipher, encrypted) = _encrypted_ids[secret]
+
+    new_ids = [orig for orig in set(ids) if orig not in encrypted]
+    blocks = []
+    for orig in new_ids:
+        try:
+            raw = orig.decode('hex')
+        except TypeError:
+            continue
+        if(len(raw)==16):
+            blocks.append((orig, raw))
+        else:
+            try:
+                encrypted[orig] = code(orig, cipher)
+            except ValueError:
+                pass
+
+    # Encrypt all of the one-block ids together, then split the output into blocks
+    if(len(blocks) > 0):
+        enc = cipher.encrypt(''.join(raw for (orig, raw) in blocks)).encode('hex').upper()
+        for i, (orig, raw) in enumerate(blocks):
+            encrypted[orig] = enc[32*i : 32*(i+1)]
+
+    return encrypted
+
+
+# Encrypts the medallions and hack_licenses in one aligned chunk of the trip and fare files
+# Params: one tuple, for ease of use with Pool.map().  The tuple contains:
+    # year, month - the month being processed.  Trips from other months are dropped
+    # secret - the AES key
+    # trip_lines - a list of lines from the trip file
+    # fare_lines - the corresponding lines from the fare file
+# Returns:
+    # (trip_out, fare_out, badmonth, messages) - the lines to write, the number of trips in the wrong month,
+    # and the error messages to log
+def processChunk((year, month, secret, trip_lines, fare_lines)):
+    trip_fields = [line.split(',', 6) for line in trip_lines]
+    fare_fields = [line.split(',', 2) for line in fare_lines]
+    encrypted = encryptIds([f[i] for f in trip_fields + fare_fields for i in (0, 1) if len(f) > 2], secret)
+
+    trip_out = []
+    fare_out = []
+    badmonth = 0
+    messages = []
+    for (tripLine, fareLine, t, f) in zip(trip_lines, fare_lines, trip_fields, fare_fields):
+        # Lines with too few fields or a malformed pickup date are parse errors, not trips in the wrong month
+        try:
+            dt = parseUtc(t[5]) if(len(t) >= 7 and len(f) >= 3) else None
+        except ValueError:
+            dt = None
+
+        if(dt is None):
+            messages.append("Parse error on " + tripLine.rstrip())
+        elif(dt.year != year or dt.month != month):
+            badmonth += 1
+        elif(t[0] not in encrypted or t[1] not in encrypted or f[0] not in encrypted or f[1] not in encrypted):
+            messages.append("Parse error on " + tripLine.rstrip())
+        else:
+            ids = (encrypted[t[0]], encrypted[t[1]], encrypted[f[0]], encrypted[f[1]])
+            if(ids[0]==ids[2] and ids[1]==ids[3]):
+                trip_out.append(ids[0] + ',' + ids[1] + ',' + ','.join(t[2:]))
+                fare_out.append(ids[2] + ',' + ids[3] + ',' + f[2])
+            else:
+                messages.append("MISMATCH ERROR")
+                messages.append("-- " + tripLine.rstrip())
+                messages.append("-- " + fareLine.rstrip())
+
+    return (trip_out, fare_out, badmonth, messages)
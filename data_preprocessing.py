@@ -4,12 +4,12 @@ Created on Tue Mar 31 17:23:32 2015
 
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
-from numpy import ravel, where, matrix, square, sqrt, cov, real, transpose, sum
+from numpy import ravel, where, square, sqrt, cov, real, sum
 from numpy import column_stack, zeros
 
-from numpy.random import rand as rand_array
-from numpy.linalg import inv, eigh, qr
+from numpy.linalg import eigh, qr
 import numpy as np
+from scipy import sparse
 
 from functools import partial
 from tools import DefaultPool
@@ -18,6 +18,62 @@ from sys import stdout
 
 
 
+# Converts a group of observations into a data matrix.  This is the compatibility
+# layer between the old list-of-column-vectors format (including numpy.matrix
+# vectors) and the 2-D arrays that the numerical code works on.  Groups may either
+# be a list of Numpy column vectors, or a matrix/array whose columns are the
+# observations (as returned by remove_bad_dimensions_grouped()), which is not copied.
+# Sparse (scipy.sparse) column vectors are stacked into a sparse CSC matrix, where
+# the stored entries are the observed data.
+# Params:
+    # vectors - a list of Numpy column vectors, or a 2-D Numpy matrix / array,
+        # or the scipy.sparse equivalents
+# Returns:
+    # a 2-D Numpy array (or scipy.sparse matrix) - the columns are observations and
+        # the rows are variables
+def as_data_matrix(vectors):
+    if(sparse.issparse(vectors)):
+        return vectors
+    if(isinstance(vectors, np.ndarray) and vectors.ndim == 2):
+        return np.asarray(vectors)
+    if(len(vectors) > 0 and sparse.issparse(vectors[0])):
+        return sparse.hstack(vectors, format='csc')
+    return np.asarray(column_stack(vectors))
+
+
+# Builds the observation matrix for RPCA - 1 where we have data, 0 where we do not.
+# Sparse data matrices already encode this in their sparsity pattern, so None
+# is returned for them (see op_modified.opursuit())
+# Params:
+    # data_matrix - a 2-D Numpy array or scipy.sparse matrix
+def observation_matrix(data_matrix):
+    if(sparse.issparse(data_matrix)):
+        return None
+    return (data_matrix!=0).astype(data_matrix.dtype)
+
+
+# Counts the missing data in each dimension of a data matrix.  Observations where
+# ALL dimensions are missing are not counted against any dimension
+# Params:
+    # data_matrix - a Numpy matrix that contains the data - the columns of this
+        # matrix are individual observations, and the rows are variables (i.e. dimensions)
+# Returns:
+    # num_missing - an array with the number of missing values in each dimension
+    # num_all_missing - the number of observations where all dimensions are missing
+def count_missing(data_matrix):
+    n_vars, n_obs = data_matrix.shape
+    if(sparse.issparse(data_matrix)):
+        # Only the observed entries are stored, so count them instead
+        num_all_missing = int((data_matrix.getnnz(axis=0)==0).sum())
+        num_missing = n_obs - data_matrix.getnnz(axis=1) - num_all_missing
+        return num_missing, num_all_missing
+    
+    is_missing = (data_matrix==0)
+    num_all_missing = int((is_missing.sum(axis=0)==n_vars).sum())
+    num_missing = ravel(is_missing.sum(axis=1)) - num_all_missing
+    return num_missing, num_all_missing
+
+
 # Deletes dimensions from a data matrix that have too much missing data.
 # Params:
     # data_matrix - a Numpy matrix that contains the data - the columns of this
@@ -34,14 +90,13 @@ def remove_bad_dimensions(data_matrix, perc_missing_allowed=.01):
     # Compute the percentage of missing data in each dimension
     # We want to exclude observations where ALL dimensions are missing
     # while computing this percentage
-    num_all_missing = ((data_matrix==0).sum(axis=0)==n_vars).sum(axis=1) 
+    num_missing, num_all_missing = count_missing(data_matrix)
     print("Num observations where ALL data is  missing: %d " % num_all_missing)
-    num_missing = ((data_matrix==0).sum(axis=1) - num_all_missing)
     perc_missing = num_missing.astype(float) / (n_obs - num_all_missing)
     
     
     # Select only dimensions that have a low enough percentage
-    good_dims = ravel(perc_missing < perc_missing_allowed)
+    good_dims = perc_missing < perc_missing_allowed
     
     # Return the matrix that has rows corresponding to good dimensions
     smaller_data_matrix = data_matrix[good_dims,:]
@@ -52,36 +107,47 @@ def remove_bad_dimensions(data_matrix, perc_missing_allowed=.01):
 
 
 # A wrapper for remove_bad_dimensions which works on groups of vectors, but removes
-# the SAME dimensions from all of them.
+# the SAME dimensions from all of them.  The missing data is counted one group at
+# a time, so the groups are never concatenated into one big matrix.
 # Params:
     # vectors_grouped - a dictionary which maps some group->id to a list of Numpy
-        # column vectors
+        # column vectors (or a matrix whose columns are the vectors)
+    # trip_names - the names of the dimensions, or None
     # perc_missing_allowed - a value between 0 and 1 that tells what fraction of
         # missing data is allowed in a given dimension.
+    # dtype - if given, the groups are converted to this precision (e.g. numpy.float32)
 # Returns:
-    # new_vectors_grouped - a dictionary which has the same structure as vectors_grouped
-        # but the vectors are smaller
-def remove_bad_dimensions_grouped(vectors_grouped, trip_names, perc_missing_allowed=.01):
-    # First, concatenate all pace vectors into one big data matrix (in a reasonable order)
+    # new_vectors_grouped - a dictionary which has the same keys as vectors_grouped,
+        # but maps to matrices whose columns are the (smaller) vectors
+    # new_trip_names - the names of the dimensions that were kept
+def remove_bad_dimensions_grouped(vectors_grouped, trip_names, perc_missing_allowed=.01, dtype=None):
     sorted_keys = sorted(vectors_grouped)
-    all_vects = [vect for key in sorted_keys for vect in vectors_grouped[key]]
-    big_matrix = column_stack(all_vects)
     
-    # Now, remove dimensions that have missing data from the big matrix
-    new_big_matrix, good_dims = remove_bad_dimensions(big_matrix, perc_missing_allowed)
+    # First pass - accumulate the missing data counts of each group
+    num_missing = 0
+    num_all_missing = 0
+    n_obs = 0
+    for key in sorted_keys:
+        group_matrix = as_data_matrix(vectors_grouped[key])
+        group_missing, group_all_missing = count_missing(group_matrix)
+        num_missing = num_missing + group_missing
+        num_all_missing += group_all_missing
+        n_vars, group_n_obs = group_matrix.shape
+        n_obs += group_n_obs
+    
+    print("Full data matrix before cutting: %d x %d" % (n_vars, n_obs))
+    print("Num observations where ALL data is  missing: %d " % num_all_missing)
+    perc_missing = num_missing.astype(float) / (n_obs - num_all_missing)
+    good_dims = perc_missing < perc_missing_allowed
+    print("Full data matrix after cutting: %d x %d" % (good_dims.sum(), n_obs))
+    stdout.flush()
     
-    # Finally, reconstruct a dictionary which has the same structure as vectors_grouped,
-    # but uses the columns of new_big_matrix instead of big_matrix.  We have to be
-    # careful to take the vectors out in the same order that we put them in
+    # Second pass - select the good dimensions (rows) of each group
     new_vectors_grouped = {}
-    i = 0
     for key in sorted_keys:
-        group_size = len(vectors_grouped[key])
-        start=i
-        end=i+group_size
-        new_vectors_grouped[key] = [new_big_matrix[:,j] for j in xrange(start, end)]
-        
-        i = end
+        new_vectors_grouped[key] = as_data_matrix(vectors_grouped[key])[good_dims,:]
+        if(dtype is not None):
+            new_vectors_grouped[key] = new_vectors_grouped[key].astype(dtype)
     
     if(trip_names!=None):
         new_trip_names = [trip_names[j] for j in range(len(good_dims)) if good_dims[j]]
@@ -116,33 +182,62 @@ def impute_missing_data(data_matrix):
 
 
 
+# Prepares a group of vectors for distance-based methods (e.g. LOF), where missing
+# values and differently scaled dimensions would otherwise dominate the distances.
+# Missing values are replaced by the average of the observed values in the same
+# dimension (as in impute_missing_data()), then every dimension is centered and scaled
+# by its standard deviation (as in scale_and_center()).  A missing value therefore ends
+# up at 0, and adds nothing to the distance along that dimension beyond the other
+# point's deviation.  Constant dimensions are only centered.
+# Params:
+    # pace_group - a list of column vectors, or a data matrix whose columns are observations
+# Returns:
+    # a new 2-D float array with the same shape as the data matrix
+def impute_scale_and_center(pace_group):
+    data_matrix = as_data_matrix(pace_group)
+    if(sparse.issparse(data_matrix)):
+        data_matrix = data_matrix.toarray()
+    data_matrix = np.asarray(data_matrix, dtype=float)
+    
+    observed = (data_matrix != 0)
+    counts = observed.sum(axis=1)
+    row_avgs = data_matrix.sum(axis=1) / np.maximum(counts, 1)
+    centered = where(observed, data_matrix - row_avgs[:,None], 0)
+    
+    row_sds = sqrt(square(centered).mean(axis=1))
+    return centered / where(row_sds > 0, row_sds, 1)[:,None]
+
+
+
 # Scales and centers a data matrix.  Specifically, it subtracts the mean
 # observation from all observations, and divides all variables by their standard
 # deviation
 # Params:
-    # data_matrix - a Numpy matrix that contains the data - the columns of this
+    # data_matrix - a 2-D Numpy array that contains the data - the columns of this
         # matrix are individual observations, and the rows are variables (i.e. dimensions)
     # reference_matrix - If provided, the mean and standard deviation will be computed
         # from this matrix, and then APPLIED to data_matrix
 # Returns:
-    # new_matrix - a new scaled matrix of the same size
+    # new_matrix - a new scaled 2-D array of the same size
 def scale_and_center(data_matrix, reference_matrix=None, scale=False):
-    
-    if(reference_matrix==None):
+    data_matrix = np.asarray(data_matrix)
+    if(reference_matrix is None):
         reference_matrix = data_matrix
+    reference_matrix = np.asarray(reference_matrix)
+    
     # First compute the average observation (column vector) and subtract from
     # every other observation.
     (n_vars, n_obs) = data_matrix.shape
     
     
-    row_sums = reference_matrix.sum(axis=1)
+    row_sums = reference_matrix.sum(axis=1).reshape(n_vars, 1)
     row_avgs = row_sums / n_obs
     new_matrix = data_matrix - row_avgs
     
     # Also scale each variable by its standard deviation, if desired    
         # Var[X] = sum( (X - mean_x)^2) / N
     if(scale):
-        sums_of_squares = square(reference_matrix - row_avgs).sum(axis=1)
+        sums_of_squares = square(reference_matrix - row_avgs).sum(axis=1).reshape(n_vars, 1)
         row_sds = sqrt(sums_of_squares / n_obs)
         new_matrix /= row_sds
     
@@ -160,22 +255,112 @@ def sorted_eig(m):
     return evals, evects
 
 
-# Exctracts the top K principal components from a data matrix in the standard (slow)
-# way.  It computes the full covariance matrix and the corresponding eigenvectors
+# Computes the covariance matrix of the observations, keeping the precision of the
+# data.  numpy.cov() always works in float64, so float32 data is handled separately
 # Params:
-    # data_matrix - a Numpy matrix that contains the data - the columns of this
+    # data_matrix - a 2-D Numpy array that contains the data - the columns of this
+        # matrix are individual observations, and the rows are variables (i.e. dimensions)
+def covariance(data_matrix):
+    if(data_matrix.dtype == np.float64):
+        return cov(data_matrix)
+    
+    (n_vars, n_obs) = data_matrix.shape
+    centered = data_matrix - data_matrix.mean(axis=1).reshape(n_vars, 1)
+    return centered.dot(centered.T) / (n_obs - 1)
+
+
+# The smallest eigenvalue (or singular value) that is counted towards the rank.
+# This is .0001, unless the precision of the data is so low (e.g. float32) that
+# rounding errors alone could be larger than that
+# Params:
+    # vals - the eigenvalues or singular values
+    # dtype - the dtype of the matrix they were computed from
+    # size - the largest dimension of that matrix
+def rank_threshold(vals, dtype, size):
+    return max(.0001, np.max(vals) * np.finfo(dtype).eps * size)
+
+
+# Computes the eigenvalues and eigenvectors of the covariance matrix without forming
+# it, via the thin SVD of the centered data.  If the centered data is U*S*V^T, then
+# its covariance is U*(S^2/(n_obs-1))*U^T, so the columns of U are the eigenvectors.
+# This costs O(n_obs^2 * n_vars) instead of O(n_vars^3), which is much cheaper when
+# there are fewer observations than variables (e.g. ~200 weeks and thousands of links)
+# Params:
+    # data_matrix - a 2-D Numpy array that contains the data - the columns of this
+        # matrix are individual observations, and the rows are variables (i.e. dimensions)
+# Returns:
+    # eig_vals - the n_obs largest eigenvalues of the covariance, in descending order
+    # eig_vectors - a n_vars x n_obs array with the corresponding eigenvectors
+def svd_cov_eig(data_matrix):
+    (n_vars, n_obs) = data_matrix.shape
+    centered = data_matrix - data_matrix.mean(axis=1).reshape(n_vars, 1)
+    U, S, Vt = np.linalg.svd(centered, full_matrices=False)
+    return square(S) / (n_obs - 1), U
+
+
+# Same as svd_cov_eig(), but uses the n_obs x n_obs Gram matrix (the centered data
+# times its transpose) instead of the SVD.  If v is an eigenvector of the Gram
+# matrix with eigenvalue lambda*(n_obs-1), then centered*v / sqrt(lambda*(n_obs-1))
+# is a unit eigenvector of the covariance with eigenvalue lambda.  This is the
+# fastest option, but the small eigenvectors lose precision because the Gram matrix
+# squares the condition number of the data.
+def gram_cov_eig(data_matrix):
+    (n_vars, n_obs) = data_matrix.shape
+    centered = data_matrix - data_matrix.mean(axis=1).reshape(n_vars, 1)
+    gram_vals, gram_vectors = sorted_eig(centered.T.dot(centered))
+    gram_vals = np.maximum(gram_vals, 0)
+    
+    # Map back into the original space.  Zero eigenvalues map to zero vectors, but
+    # these are cut off by the rank in pca() anyway
+    norms = sqrt(gram_vals)
+    norms[norms==0] = 1
+    eig_vectors = centered.dot(gram_vectors) / norms
+    return gram_vals / (n_obs - 1), eig_vectors
+
+
+# Exctracts the top K principal components from a data matrix.  If there are at least
+# as many observations as variables, this is done in the standard way - it computes
+# the full covariance matrix and the corresponding eigenvectors.  Otherwise, the
+# covariance has rank < n_obs, and the same components are computed from the thin
+# SVD of the data (or the Gram matrix), which never forms the n_vars x n_vars covariance.
+# Params:
+    # data_matrix - a 2-D Numpy array that contains the data - the columns of this
         # matrix are individual observations, and the rows are variables (i.e. dimensions)
     # n_pcs - the deisred number of Principal components
-def pca(data_matrix, n_pcs):
+    # method - "auto", "cov" (covariance eigendecomposition), "svd" (thin SVD),
+        # "gram" (Gram matrix eigendecomposition), or "em" (iterative, see em_pca()).
+        # "auto" picks "svd" if n_obs < n_vars and "cov" otherwise.  Sparse data
+        # always uses the Gram matrix (see sparse_pca())
+    # seed, init_pcs - the random seed and the optional initial components of the
+        # "em" method (see em_pca()).  Ignored by the other methods
+# Returns:
+    # principal_components - a 2-D array whose columns are the principal components
+    # projected_data - the data projected onto those components
+def pca(data_matrix, n_pcs, method="auto", seed=0, init_pcs=None):
+    if(sparse.issparse(data_matrix)):
+        return sparse_pca(data_matrix, n_pcs)
+    data_matrix = np.asarray(data_matrix)
     (n_vars, n_obs) = data_matrix.shape
     
     n_pcs = min(n_pcs, n_vars)
-    # compute the covariance matrix of the observations
-    cov_matrix = matrix(cov(data_matrix))
-	
-    # compute the spectral decomposition
-    eig_vals, eig_vectors = sorted_eig(cov_matrix)
-    rank = sum(eig_vals > .0001)
+    if(method == "em"):
+        principal_components, projected_data, n_iter = em_pca(data_matrix, n_pcs, seed=seed,
+                                                                  init_pcs=init_pcs)
+        return principal_components, projected_data
+    if(method == "auto"):
+        method = "svd" if n_obs < n_vars else "cov"
+    
+    # compute the spectral decomposition of the covariance matrix
+    if(method == "svd"):
+        eig_vals, eig_vectors = svd_cov_eig(data_matrix)
+    elif(method == "gram"):
+        eig_vals, eig_vectors = gram_cov_eig(data_matrix)
+    elif(method == "cov"):
+        eig_vals, eig_vectors = sorted_eig(covariance(data_matrix))
+    else:
+        raise ValueError("Unknown PCA method: " + str(method))
+    
+    rank = sum(eig_vals > rank_threshold(eig_vals, data_matrix.dtype, n_vars))
     #print ("Nonzero eigvals: %d" % rank)
     trunc_eigs = eig_vals.tolist()[:(rank+5)]
     #print "Eigen vals: " + str(trunc_eigs)
@@ -185,83 +370,127 @@ def pca(data_matrix, n_pcs):
     
     n_pcs = min(n_pcs, rank)
     
-    eig_vectors = matrix(eig_vectors)
     principal_components = real(eig_vectors[:,:n_pcs])
-    projected_data = transpose(principal_components) * data_matrix
+    projected_data = principal_components.T.dot(data_matrix)
     
     return principal_components, projected_data 
 
 
+# Same as pca() with method="gram", but the data matrix is a scipy.sparse matrix,
+# which is never centered or densified.  If mu is the mean observation and s = X^T*mu,
+# the Gram matrix of the centered data is X^T*X - s*1^T - 1*s^T + (mu.mu), and the
+# components are mapped back with X*v - mu*(1^T*v).  Only the n_obs x n_obs Gram
+# matrix and the n_vars x n_pcs components are dense.
+# Params:
+    # data_matrix - a scipy.sparse matrix - the columns are observations
+    # n_pcs - the deisred number of Principal components
+# Returns:
+    # principal_components - a 2-D array whose columns are the principal components
+    # projected_data - the (uncentered) data projected onto those components
+def sparse_pca(data_matrix, n_pcs):
+    (n_vars, n_obs) = data_matrix.shape
+    n_pcs = min(n_pcs, n_vars)
+    
+    row_avgs = ravel(data_matrix.sum(axis=1)) / n_obs
+    s = data_matrix.T.dot(row_avgs)
+    gram = data_matrix.T.dot(data_matrix).toarray() - s[:,None] - s[None,:] + row_avgs.dot(row_avgs)
+    gram_vals, gram_vectors = sorted_eig(gram)
+    gram_vals = np.maximum(gram_vals, 0)
+    eig_vals = gram_vals / (n_obs - 1)
+    
+    rank = sum(eig_vals > rank_threshold(eig_vals, data_matrix.dtype, n_vars))
+    n_pcs = min(n_pcs, rank)
+    
+    # Map the top eigenvectors of the Gram matrix back into the original space
+    gram_vectors = gram_vectors[:,:n_pcs]
+    principal_components = (data_matrix.dot(gram_vectors) -
+                            row_avgs[:,None] * gram_vectors.sum(axis=0)[None,:]) / sqrt(gram_vals[:n_pcs])
+    projected_data = data_matrix.T.dot(principal_components).T
+    
+    return principal_components, projected_data
+
+
 # Extracts the top K principal components from a data matrix, using the iterative
 # approach explained in "EM Algorithms for PCA and SPCA, by Sam Roweis".  If the
 # number of Principal Components is relatively small, this is more efficient than
 # the traditional approach because we don't need to compute the full covariance
-# matrix.
+# matrix - each iteration only costs O(n_vars * n_obs * n_pcs).
+# The loadings are orthonormalized after every M-step, so the E-step is a plain
+# projection, and the squared reconstruction error of the centered data is
+# sum(centered^2) - sum(projected^2).  Once this stops decreasing, the loadings span
+# the principal subspace, and a small n_pcs x n_pcs eigendecomposition rotates
+# them onto the individual principal components.
 # Params:
-    # data_matrix - a Numpy matrix that contains the data - the columns of this
+    # data_matrix - a 2-D Numpy array that contains the data - the columns of this
         # matrix are individual observations, and the rows are variables (i.e. dimensions)
     # n_pcs - the deisred number of Principal components
-def em_pca(data_matrix, n_pcs, tolerance=.000001):
-    [n_vars, n_obs] = data_matrix.shape
+    # tolerance - stop when the error decreases by less than this fraction
+    # max_iter - the maximum number of EM iterations
+    # seed - the random seed for the initial loadings.  If None, the result is not repeatable
+    # init_pcs - an optional n_vars x m array of components from a previous run
+        # (e.g. a neighboring group or a previous time period).  These are used as
+        # the initial loadings, and padded with random columns if m < n_pcs
+# Returns:
+    # principal_components - a 2-D array whose orthonormal columns are the principal
+        # components, sorted by decreasing variance
+    # projected_data - the data projected onto those components
+    # n_iter - the number of EM iterations that were run
+def em_pca(data_matrix, n_pcs, tolerance=.000001, max_iter=1000, seed=0, init_pcs=None):
+    data_matrix = np.asarray(data_matrix)
+    (n_vars, n_obs) = data_matrix.shape
+    centered = data_matrix - data_matrix.mean(axis=1).reshape(n_vars, 1)
+    
+    # The centered data has rank < n_obs, so more components can't be estimated
+    n_pcs = min(n_pcs, n_vars, n_obs - 1)
     
     # Start with an initial guess for the loadings matrix (or eigenvectors)
-    loadings = matrix(rand_array(n_vars, n_pcs))
+    loadings = np.random.RandomState(seed).randn(n_vars, n_pcs).astype(data_matrix.dtype)
+    if(init_pcs is not None):
+        init_pcs = np.asarray(init_pcs)[:,:n_pcs]
+        loadings[:,:init_pcs.shape[1]] = init_pcs
     
+    total_ss = square(centered).sum()
     prev_err = float("inf")
-    while(True):
+    for n_iter in xrange(1, max_iter + 1):
+        loadings, rmat = qr(loadings)
+        
         # E-STEP - compute new scores based on current loadings
         # a.k.a. compute projected data based on current eigenvectors
-        proj_data = inv(loadings.transpose() * loadings) * loadings.transpose() * data_matrix
-    
-        # M-STEP - compute new loadings based on current scores
-        # a.k..a. compute best eigenvectors based on current projected data
-        loadings = data_matrix * proj_data.transpose() * inv(proj_data * proj_data.transpose())
-        
-        # Compute the squared error
-        error = square(data_matrix - loadings * proj_data).sum()
+        proj_data = loadings.T.dot(centered)
         
         # If the error is no longer decreasing, then we have converged
-        error_ratio = error / prev_err
-        print(error_ratio)
-        if (error_ratio > (1 - tolerance)):
+        error = total_ss - square(proj_data).sum()
+        if(error <= tolerance * total_ss or error > prev_err * (1 - tolerance)):
             break
         prev_err = error
-
+        
+        # M-STEP - compute new loadings based on current scores
+        # a.k.a. compute best eigenvectors based on current projected data
+        # lstsq() solves against proj_data * proj_data^T, which may be singular
+        loadings = np.linalg.lstsq(proj_data.T, centered.T, rcond=-1)[0].T
+    else:
+        # Ran out of iterations - project onto the latest loadings
+        loadings, rmat = qr(loadings)
+        proj_data = loadings.T.dot(centered)
+    
     # Now that the EM algorithm has converged, the loadings span the correct lower-
     # dimensional space, and the data is projected into it.  We now use the regular
     # PCA on this lower-dimensional matrix to finish it off and decorrelate the
     # dimensions
-    proj_matrix = inv(loadings.transpose() * loadings) * loadings.transpose()
-    proj_data =  proj_matrix * data_matrix
-    
-
-    new_cov = cov(proj_data)
-    orth_cov, rmat = qr(new_cov)
-    del(rmat)
-    orth_cov = matrix(orth_cov)
-    
-
-
-    """
-    new_pcs, new_projected_data = pca(proj_data, n_pcs)
-
-    print proj_matrix.shape
-    print new_pcs.shape
-    print new_projected_data.shape
-    final_pcs = (new_pcs * proj_matrix).transpose() 
-    new_data = final_pcs.transpose() * data_matrix
-    """
+    eig_vals, eig_vectors = sorted_eig(proj_data.dot(proj_data.T) / (n_obs - 1))
+    rank = sum(eig_vals > rank_threshold(eig_vals, data_matrix.dtype, n_vars))
     
+    principal_components = loadings.dot(eig_vectors[:,:rank])
+    projected_data = principal_components.T.dot(data_matrix)
     
-    import pdb; pdb.set_trace()
-    return final_pcs , new_projected_data
+    return principal_components, projected_data, n_iter
 
 
 
 
 def run_opursuit(pace_group, gamma):
-    data_matrix = column_stack(pace_group)
-    O = (data_matrix!=0)*1 # Observation matrix - 1 where we have data, 0 where we do not
+    data_matrix = as_data_matrix(pace_group)
+    O = observation_matrix(data_matrix) # Observation matrix - 1 where we have data, 0 where we do not
     L,C,term,n_iter = opursuit(data_matrix, O, gamma)
     
     
@@ -278,18 +507,13 @@ def run_opursuit(pace_group, gamma):
     # n_pcs - The number of principal components to use for PCA
     # scale - Whether or not to do scaling after centering - see scale_and_center()
 def preprocess_group(pace_group, n_pcs=0, scale=True):
-    data_matrix = column_stack(pace_group)
+    data_matrix = as_data_matrix(pace_group)
     
-    scale_and_center(data_matrix, scale)
+    data_matrix = scale_and_center(data_matrix, scale=scale)
     pcs, projected_data = pca(data_matrix, n_pcs)
     
-    em_pcs, em_projected_data = em_pca(data_matrix, n_pcs)
-    import pdb; pdb.set_trace()
-        
-    
-    
     # Split the matrix back into vectors
-    new_group = [projected_data[:,i] for i in xrange(len(pace_group))]
+    new_group = [projected_data[:,i:i+1] for i in xrange(data_matrix.shape[1])]
     
     return new_group
 
@@ -314,7 +538,7 @@ def preprocess_data(pace_grouped, n_pcs, perc_missing_allowed=.05, scale=True, p
     
     print(perc_missing_allowed)
     # First, remove the dimensions that have too much missing data.
-    pace_grouped = remove_bad_dimensions_grouped(pace_grouped, perc_missing_allowed)
+    pace_grouped, trip_names = remove_bad_dimensions_grouped(pace_grouped, None, perc_missing_allowed)
     
     
     # Now, prepare the preprocess_group() function to be mapped onto the groups
@@ -18,6 +18,7 @@ import traceback
 from grid import *
 from regions import *
 from trip import *
+from trip_scan import scanMonth, scanMonths, TripConsumer
 
 
 #Global settings
@@ -25,59 +26,54 @@ TMP_DIR = "working_space"            #A directory for intermediate results.  Wil
 FINAL_OUTPUT_DIR = "4year_features"    #A directory for final results
 NUM_PROCESSORS = 8                #Number of cores to employ for parallel processing
 
+#Aggregates the scanned trips into OD features (mean pace vectors, trip counts, etc...) - see trip_scan.py
+#Each month is written to its own tmp directory, and the directories are merged at the end
+class ODFeatureConsumer(TripConsumer):
+    #Arguments:
+        #road_map - a Map object.  flatten() should have already been called
+        #output_dir - the directory where final output will be placed by merge()
+    def __init__(self, road_map, output_dir):
+        self.road_map = road_map
+        self.output_dir = output_dir
+    
+    def begin(self, year, month, header):
+        self.road_map.unflatten()
+        
+        #The month gives us the output directory - make it
+        self.outdir = TMP_DIR + "/slice_" + str(year) + "_" + str(month)
+        shutil.rmtree(self.outdir, ignore_errors=True)
+        os.mkdir(self.outdir)
+        
+        #Begin the RegionSystem for this output directory - this will start outputting files there
+        self.gridSystem = RegionSystem(self.outdir, self.road_map)
+    
+    #Record the trip - if trip==None, an error will be recorded
+    def record(self, trip, line):
+        self.gridSystem.record(trip)
+    
+    #Finalize the output, and return the name of the temporary directory that was created for this month
+    def finish(self):
+        self.gridSystem.close()
+        return self.outdir
+    
+    #Merge intermediate results into large files in one final output folder
+    def merge(self, slice_dirs):
+        mergeTempFiles(slice_dirs, self.output_dir)
+        return self.output_dir
+
+
 #Processes a month of trip data and outputs one month of features (mean pace vectors, trip counts, etc...) to a tmp directory
 #Many of these can be run in parallel
 #Arguments: Takes one tuple for ease of use with Pool.map().  The tuple contains:
     #year - an integer. the year containing the month of interest
     #month - an integer (1 through 12) the month to be processed
-    #slice_id - a unique identifier for this (year,  month) pair.  Used to name the tmp files
+    #slice_id - a unique identifier for this (year,  month) pair.  Not used - tmp directories are named by month
+    #road_map - a Map object.  flatten() should have already been called
 
 #Returns: The name of the tmp directory created for this month
 def processMonth((year, month, slice_id, road_map)):
-    road_map.unflatten()
-    
     try:
-                                                                                            #The year and month give the input file
-        infile = "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"    
-        
-        #The slice_id gives us the output directory - make it
-        outdir = TMP_DIR + "/slice_" + str(slice_id)
-        shutil.rmtree(outdir, ignore_errors=True)
-        os.mkdir(outdir)
-        
-        #Begin the RegionSystem for this output directory - this will start outputting files there
-        gridSystem = RegionSystem(outdir, road_map)
-        
-        logMsg('Parsing file ' + infile)
-        
-        #Open the input file as a CSV
-        with open(infile, 'r') as filePointer:
-            csvReader = csv.reader(filePointer)
-            
-            #Read the header and discard
-            header = csvReader.next()
-            del header
-            
-            #Read the rest of the file
-            for line in csvReader:
-    
-                try:
-                    trip = Trip(line) #Parse the csv line into a trip object
-                except ValueError:
-                    trip = None      #A trip of None indicates a parsing error
-                    
-                
-                #Ignore trips that are placed in the wrong month file
-                if(trip!= None and (year!=trip.pickup_time.year or month!=trip.pickup_time.month)):
-                    trip.has_other_error = True
-                
-                #Record the trip - if trip==None, an error will be recorded
-                gridSystem.record(trip)
-        
-        #Finalize the output
-        gridSystem.close()
-    
-        #Return the name of the temporary directory that was created for this month    
+        [outdir] = scanMonth((year, month, [ODFeatureConsumer(road_map, None)]))
         return outdir
     except Exception as e:
         traceback.print_exc()
@@ -156,7 +152,15 @@ def sliceIterator(road_map):
 #########################################################################################################
 ################################### MAIN CODE BEGINS HERE ###############################################
 #########################################################################################################
-def extractFeatures(road_map, output_dir, pool):
+#Extracts the OD features of all months into output_dir
+#Arguments:
+    #road_map - a Map object, which defines the regions
+    #output_dir - the directory where final output will be placed
+    #pool - a multiprocessing Pool
+    #extra_consumers - other TripConsumers (e.g. feature histograms or error counts - see trip_scan.py)
+        #which are fed during the same pass over the trip files
+#Returns: A list with the merged result of each of the extra_consumers
+def extractFeatures(road_map, output_dir, pool, extra_consumers=[]):
     #Setup temporary directory to store intermediate results for each month
     logMsg("Creating working directory for temp files...")
     shutil.rmtree(TMP_DIR, ignore_errors=True)
@@ -170,18 +174,17 @@ def extractFeatures(road_map, output_dir, pool):
     #Each month will get a subdirectory inside the temporary directory
     logMsg("Processing months in parallel (" + str(NUM_PROCESSORS) + " cores)")
     
-    slice_dirs = pool.map(processMonth, sliceIterator(road_map)) #Map the main function onto each month (slice) in parallel
-    #slice_dirs contains all of the intermediate subdirectories.  These will be merged in the next step
-    
-    
-    #Merge intermediate results into large files in one final output folder
-    logMsg("Merging output files")
-    mergeTempFiles(slice_dirs, output_dir)
+    #Map the scan onto each month (slice) in parallel.  Each month gets an intermediate subdirectory,
+    #and these are merged into large files in one final output folder
+    months = [slice_args[:2] for slice_args in sliceIterator(road_map)]
+    consumers = [ODFeatureConsumer(road_map, output_dir)] + list(extra_consumers)
+    results = scanMonths(months, consumers, pool=pool)
     
     logMsg("Cleaning up")
     shutil.rmtree(TMP_DIR, ignore_errors=True)    
     
     logMsg("Done.")
+    return results[1:]
     
 
 if(__name__=="__main__"):
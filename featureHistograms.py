@@ -5,17 +5,23 @@ Created on Thu Jul  3 12:52:31 2014
 @author: brian
 """
 import csv
-from collections import defaultdict
 from grid import *
 from regions import *
 from multiprocessing import Pool
+from trip_scan import scanMonth, scanMonths, TripConsumer
+from trip_cache import CachedMonth
+from numpy import zeros, asarray, trunc, clip, isfinite, bincount, int64
 
 
 
 NUM_PROCESSORS = 8
 
+#The number of trips which are parsed before their features are recorded as a batch
+CHUNK_SIZE = 1000000
+
 #Class which represents a discrete histogram of some particular feature
-#The bins are specified upfront, and counts are incremented via the record() method
+#The bins are specified upfront, and counts are stored in an integer array (one entry per bin)
+#Values can be recorded one at a time via record(), or in batches via recordArray()
 class Histogram:
 	#A simple constructor for the histogram which specifies the name and the bins
 	#Arguments:
@@ -23,37 +29,72 @@ class Histogram:
 		#granularity - the bin size
 		#lower_bound - the lowest possible value for this histogram to track
 		#upper_bound - the highest possible value for this histogram to track
-		#Note: the total number of bins will be (upper_bound - lower_bound) / granularity
-	def __init__(self, name, granularity, lower_bound=float('-inf'), upper_bound=float('inf')):
+		#Note: the total number of bins will be (upper_bound - lower_bound) / granularity + 1
+		#Both bounds are required and must be finite, since the bins are allocated upfront
+	def __init__(self, name, granularity, lower_bound, upper_bound):
+		if(not isfinite(lower_bound) or not isfinite(upper_bound)):
+			raise ValueError("Histogram '%s' needs finite lower and upper bounds" % name)
 		self.name = name
 		self.granularity = granularity
 		self.lower_bound = lower_bound
 		self.upper_bound = upper_bound
-		self.counts = defaultdict(int)
-	
+
+		#Bins are multiples of the granularity - bin i holds the value (lo_bin + i) * granularity
+		self.lo_bin = int(round(float(lower_bound) / granularity))
+		self.hi_bin = int(round(float(upper_bound) / granularity))
+		self.counts = zeros(self.hi_bin - self.lo_bin + 1, dtype=int64)
+
 	#Record a value in the histogram by incrementing the appropriate bin
 	#Arguments:
 		#value - the feature value to record
 	def record(self, value):
-		
 		#Use rounding to determine the appropriate bin
-		rounded = int(value/self.granularity)*self.granularity
-		rounded = max(self.lower_bound, rounded)
-		rounded = min(self.upper_bound, rounded)
-		
+		bin_id = int(value/self.granularity)
+		bin_id = min(max(self.lo_bin, bin_id), self.hi_bin)
+
 		#Increment that bin
-		self.counts[rounded] += 1
-	
+		self.counts[bin_id - self.lo_bin] += 1
+
+	#Record many values at once.  Same rounding as record(), but done with array operations
+	#Values which are not finite (NaN or inf) are ignored
+	#Arguments:
+		#values - a list or array of feature values
+	def recordArray(self, values):
+		values = asarray(values, dtype=float)
+		values = values[isfinite(values)]
+
+		#Round towards zero, then clamp to the range of the histogram
+		bin_ids = clip(trunc(values / self.granularity), self.lo_bin, self.hi_bin).astype(int64)
+		self.counts += bincount(bin_ids - self.lo_bin, minlength=len(self.counts))
+
+	#Creates an empty histogram with the same name and bins as this one
+	def emptyCopy(self):
+		return Histogram(self.name, self.granularity, self.lower_bound, self.upper_bound)
+
+	#Adds the counts of another histogram (with the same bins) into this one
+	#Arguments:
+		#other - another Histogram
+	def merge(self, other):
+		if(other.lo_bin != self.lo_bin or other.hi_bin != self.hi_bin or other.granularity != self.granularity):
+			raise ValueError("Cannot merge histogram '%s' - the bins do not match" % other.name)
+		self.counts += other.counts
+
+	#Returns a dictionary which maps each non-empty bin value to its frequency
+	def countsByValue(self):
+		return dict((bin_id * self.granularity, int(self.counts[bin_id - self.lo_bin]))
+			for bin_id in self.counts.nonzero()[0] + self.lo_bin)
+
 	#Saves the histogram into a CSV file - first column contains values, second column contains frequencies
+	#Only non-empty bins are written
 	#Arguments:
 		#filename - the name of the file to output
 	def saveToFile(self, filename):
 		w = csv.writer(open(filename, 'w'))
 		w.writerow([self.name, 'frequency'])
-		
+
 		#Loop through values in order and output their frequencies
-		for val in sorted(self.counts):
-			w.writerow([val, self.counts[val]])
+		for i in self.counts.nonzero()[0]:
+			w.writerow([int(i + self.lo_bin) * self.granularity, self.counts[i]])
 
 
 #A simple iterator which gives the (year, month) tuples in the data range
@@ -63,14 +104,9 @@ def monthIterator():
 			yield (year, month)
 
 
-#Computes feature histograms for a given month of the dataset
-#Arguments:
-	#(year,month) - see monthIterator()
-#Returns:
-	#a tuple of Histograms - one for each type of feature
-def computeMonth((year, month)):
-
-	#Initialize the histograms with reasonable ranges and granularities
+#Creates the empty tuple of histograms which is filled in by computeMonth()
+#Initialize the histograms with reasonable ranges and granularities
+def makeHistograms():
 	hist_lon = Histogram('lon', .01, lower_bound=-80, upper_bound = -70)
 	hist_lat = Histogram('lat', .01, lower_bound=35, upper_bound = 45)
 	hist_straightline = Histogram('straightline', .01, lower_bound=0, upper_bound = 100)
@@ -80,61 +116,95 @@ def computeMonth((year, month)):
 	hist_miles = Histogram('miles', 1, lower_bound=0, upper_bound = 100)
 	hist_winding = Histogram('winding', .01, lower_bound=0, upper_bound = 100)
 	hist_pace = Histogram('pace', 5, lower_bound=0, upper_bound = 10*3600)
-	
-	#The name of the trip file that will be read
-	filename = "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
-	
-	logMsg("Reading file " + filename)
-	r = csv.reader(open(filename, "r"))
-	
-	#Read the first line from the input file and use it to initialize the header
-	Trip.initHeader(r.next())
-	i = 0
-	for line in r:
-		try:
-			#Parse the line into a trip
-			trip = Trip(line)
-			
-			#Record longitudes for both the start and end of the trip
-			hist_lon.record(trip.fromLon)
-			hist_lon.record(trip.toLon)
-
-			#Record latitudes for both the start and end of the trip
-			hist_lat.record(trip.fromLat)
-			hist_lat.record(trip.toLat)
-			
-			#Record the stragihtline distance
-			hist_straightline.record(trip.straight_line_dist)
-			
-			#Record the trip time (and rounded trip time)
-			hist_time.record(trip.time)
-			hist_minutes.record(trip.time)
-			
-			#Record the trip distance (and rounded trip distance)
-			hist_dist.record(trip.dist)
-			hist_miles.record(trip.dist)
-			
-			#Record the winding factor
-			hist_winding.record(trip.winding_factor)
-			
-			#Record the pace if it is defined
-			if(trip.dist > 0):
-				hist_pace.record(float(trip.time) / trip.dist)
-				
-		except ValueError:
-			#Parse error - move on
-			pass
-
-		#Intermediate output
-		i += 1
-		if(i%1000000==0):
-			logMsg(filename + " read " + str(i) + " rows")
-
-
-	#Return the tuple of histograms
+
 	return (hist_lon, hist_lat, hist_straightline, hist_time, hist_minutes, hist_dist, hist_miles, hist_winding, hist_pace)
 
 
+#Records a batch of trips in the histograms
+#Arguments:
+	#histTuple - a tuple of histograms, from makeHistograms()
+	#columns - a dictionary of trip feature arrays, from tripColumns() in trip.py
+def recordTrips(histTuple, columns):
+	(hist_lon, hist_lat, hist_straightline, hist_time, hist_minutes, hist_dist, hist_miles, hist_winding, hist_pace) = histTuple
+
+	#Record longitudes and latitudes for both the start and end of the trip
+	hist_lon.recordArray(columns['fromLon'])
+	hist_lon.recordArray(columns['toLon'])
+	hist_lat.recordArray(columns['fromLat'])
+	hist_lat.recordArray(columns['toLat'])
+
+	#Record the stragihtline distance
+	hist_straightline.recordArray(columns['straight_line_dist'])
+
+	#Record the trip time (and rounded trip time)
+	hist_time.recordArray(columns['time'])
+	hist_minutes.recordArray(columns['time'])
+
+	#Record the trip distance (and rounded trip distance)
+	hist_dist.recordArray(columns['dist'])
+	hist_miles.recordArray(columns['dist'])
+
+	#Record the winding factor
+	hist_winding.recordArray(columns['winding_factor'])
+
+	#Record the pace if it is defined
+	has_dist = columns['dist'] > 0
+	hist_pace.recordArray(columns['time'][has_dist] / columns['dist'][has_dist])
+
+
+#Records the feature histograms of each scanned trip - see trip_scan.py
+#Trips are buffered in chunks of CHUNK_SIZE, and each chunk is recorded with array operations
+class HistogramConsumer(TripConsumer):
+	def begin(self, year, month, header):
+		self.histTuple = makeHistograms()
+		self.trips = []
+
+	def record(self, trip, line):
+		#Parse errors are skipped
+		if(trip is None):
+			return
+		self.trips.append(trip)
+		if(len(self.trips) >= CHUNK_SIZE):
+			self.flush()
+
+	#Records the buffered trips as a batch
+	def flush(self):
+		if(len(self.trips) > 0):
+			recordTrips(self.histTuple, tripColumns(self.trips))
+			self.trips = []
+
+	def finish(self):
+		self.flush()
+		return self.histTuple
+
+	def merge(self, results):
+		return mergeHistogramTuples(results)
+
+
+#Computes feature histograms for a given month of the dataset
+#Arguments:
+	#(year,month) - see monthIterator()
+#Returns:
+	#a tuple of Histograms - one for each type of feature
+def computeMonth((year, month)):
+	[histTuple] = scanMonth((year, month, [HistogramConsumer()]))
+	return histTuple
+
+
+#Computes feature histograms for a month which has been converted by trip_cache.py
+#The columns are read from the cache in chunks of CHUNK_SIZE trips
+#Arguments:
+	#(cache_dir, year, month) - the root of the cache, and the month to read
+#Returns:
+	#a tuple of Histograms - one for each type of feature
+def computeCachedMonth((cache_dir, year, month)):
+	histTuple = makeHistograms()
+	cached = CachedMonth(cache_dir, year, month)
+	for start in range(0, len(cached), CHUNK_SIZE):
+		recordTrips(histTuple, cached.tripColumns(slice(start, start + CHUNK_SIZE)))
+	return histTuple
+
+
 #This function merges the tuples of histograms generated by computeMonth()
 #The general idea is that each month can be computed in parallel, and the answers can be merged here.
 #Arguments:
@@ -142,68 +212,68 @@ def computeMonth((year, month)):
 #Returns:
 	#A single histogram tuple
 def mergeHistogramTuples(histTupleList):
-	
+
 	#Initialize a tuple of histograms -all counts set to 0
-	mergedHistList = []
-	for hist in histTupleList[0]: #Mirror the first tuple in the histTupleList
-		histCopy =  Histogram(hist.name, hist.granularity, hist.lower_bound, hist.upper_bound)
-		mergedHistList.append(histCopy)
-	mergedHistTuple = tuple(mergedHistList)
-		
-	
-	#Iterate through all tuples in the list
+	#Mirror the first tuple in the histTupleList
+	mergedHistTuple = tuple(hist.emptyCopy() for hist in histTupleList[0])
+
+	#Sum the counts of the smaller histograms
 	for histTuple in histTupleList:
-		#Iterate through all histograms in the tuple
 		for i in range(len(histTuple)):
-			#Update the counts of the appropriate merged Histogram
-			#This is performed by summing the values from the smaller histograms
-			for val in histTuple[i].counts:
-				mergedHistTuple[i].counts[val] += histTuple[i].counts[val]
-	
-	return mergedHistTuple
-
-
-
-
-
+			mergedHistTuple[i].merge(histTuple[i])
 
+	return mergedHistTuple
 
-logMsg("Computing histograms for each month")
 
-#Create a multiprocessing pool
-pool = Pool(NUM_PROCESSORS)
+#Computes the feature histograms over all months and saves them to CSV files
+#Arguments:
+	#out_dir - the directory where the histograms are saved (one CSV file per feature)
+	#months - a list of (year, month) tuples.  Default is all months from monthIterator()
+	#pool - a multiprocessing Pool, used to process the months in parallel
+	#cache_dir - if given, the trips are read from this trip cache (see trip_cache.py) instead of the CSV files
+#Returns:
+	#The merged histogram tuple
+def computeHistograms(out_dir="hist_results", months=None, pool=DefaultPool(), cache_dir=None):
+	if(months is None):
+		months = list(monthIterator())
 
-#Compute the tuple of feature histograms for each month (slice)
-slicedHists = pool.map(computeMonth, monthIterator())
+	logMsg("Computing histograms for each month")
 
+	#Compute the tuple of feature histograms for each month (slice), and merge them
+	if(cache_dir is None):
+		[histTuple] = scanMonths(months, [HistogramConsumer()], pool=pool)
+	else:
+		slicedHists = pool.map(computeCachedMonth, [(cache_dir, year, month) for (year, month) in months])
+		histTuple = mergeHistogramTuples(slicedHists)
 
-logMsg("Merging histograms across months")
+	#unpack the tuple into individual histograms
+	(hist_lon, hist_lat, hist_straightline, hist_time, hist_minutes, hist_dist, hist_miles, hist_winding, hist_pace) = histTuple
 
-#Merge the months into one single feature histogram tuple
-histTuple = mergeHistogramTuples(slicedHists)
+	#Save each histogram to a file
+	logMsg('Saving...')
 
-#unpack the tuple into individual histograms
-(hist_lon, hist_lat, hist_straightline, hist_time, hist_minutes, hist_dist, hist_miles, hist_winding, hist_pace) = histTuple
+	try:
+		os.mkdir(out_dir)
+	except:
+		pass
 
-		
+	hist_lon.saveToFile(os.path.join(out_dir, 'lon.csv'))
+	hist_lat.saveToFile(os.path.join(out_dir, 'lat.csv'))
+	hist_straightline.saveToFile(os.path.join(out_dir, 'straightline.csv'))
+	hist_time.saveToFile(os.path.join(out_dir, 'time.csv'))
+	hist_minutes.saveToFile(os.path.join(out_dir, 'minutes.csv'))
+	hist_dist.saveToFile(os.path.join(out_dir, 'dist.csv'))
+	hist_miles.saveToFile(os.path.join(out_dir, 'miles.csv'))
+	hist_winding.saveToFile(os.path.join(out_dir, 'winding.csv'))
+	hist_pace.saveToFile(os.path.join(out_dir, 'pace.csv'))
 
-#Save each histogram to a file
-logMsg('Saving...')
+	logMsg('Done.')
+	return histTuple
 
-try:
-	os.mkdir("hist_results")
-except:
-	pass
 
 
-hist_lon.saveToFile('hist_results/lon.csv')
-hist_lat.saveToFile('hist_results/lat.csv')
-hist_straightline.saveToFile('hist_results/straightline.csv')
-hist_time.saveToFile('hist_results/time.csv')
-hist_minutes.saveToFile('hist_results/minutes.csv')
-hist_dist.saveToFile('hist_results/dist.csv')
-hist_miles.saveToFile('hist_results/miles.csv')
-hist_winding.saveToFile('hist_results/winding.csv')
-hist_pace.saveToFile('hist_results/pace.csv')
 
-logMsg('Done.')
\ No newline at end of file
+if(__name__=="__main__"):
+	#Create a multiprocessing pool
+	pool = Pool(NUM_PROCESSORS)
+	computeHistograms(pool=pool)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Array-based access to the global pace timeseries (global_features.csv).  The
+pace column is loaded once per feature directory and kept in a module-level
+cache, so outlier scoring and event detection can share it.  The weekly periodic
+pattern (leave-one-out mean and standard deviation for each (weekday, hour)) is
+computed with grouped sums over a weekday*24+hour index.
+
+@author: Brian Donovan (briandonovan100@gmail.com)
+"""
+import os, csv
+from numpy import array, bincount, sqrt, errstate
+
+from tools import getHeaderIds
+
+
+WEEKDAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+WEEKDAY_IDS = dict((name, i) for i, name in enumerate(WEEKDAY_NAMES))
+NUM_GROUPS = 7*24
+
+# Maps a feature directory --> GlobalPaceSeries, so each file is only parsed once
+_global_pace_cache = {}
+
+
+
+# Computes the group index (weekday*24 + hour) of each timeslice
+# Params:
+    # weekdays - a list of weekday names (e.g. "Monday")
+    # hours - a list or array of integer hours
+# Returns:
+    # an integer array with one group id per timeslice
+def group_ids(weekdays, hours):
+    weekday_ids = array([WEEKDAY_IDS[w] for w in weekdays], dtype=int)
+    return weekday_ids*24 + array(hours, dtype=int)
+
+
+# Computes leave-one-out mean and standard deviation of each value, relative to
+# the other values in the same group.  For example, the expected pace for Friday,
+# January 1st at 8am is the average of all Fridays at 8am EXCEPT for January 1st
+# Params:
+    # values - a float array
+    # ids - an integer array of the same length, giving the group of each value
+    # num_groups - the total number of groups
+# Returns:
+    # (loo_mean, loo_sd) - two float arrays with the same length as values
+def grouped_leave1_stats(values, ids, num_groups=NUM_GROUPS):
+    # Leave-one-IN counts, sums, and sums of squares for each group
+    grouped_count = bincount(ids, minlength=num_groups).astype(float)
+    grouped_sum = bincount(ids, weights=values, minlength=num_groups)
+    grouped_ss = bincount(ids, weights=values**2, minlength=num_groups)
+
+    # Subtract each observation from its own group to get leave-one-out stats
+    loo_count = grouped_count[ids] - 1
+    with errstate(divide='ignore', invalid='ignore'):
+        loo_mean = (grouped_sum[ids] - values) / loo_count
+        loo_ss = grouped_ss[ids] - values**2
+        loo_sd = sqrt(loo_ss / loo_count - loo_mean**2)
+
+    return loo_mean, loo_sd
+
+
+
+# The global pace timeseries stored as parallel arrays, along with its expected
+# pace and standard deviation (see grouped_leave1_stats())
+class GlobalPaceSeries:
+    # Params:
+        # keys - a list of (date, hour, weekday) tuples
+        # paces - the global pace at each of these timeslices
+    def __init__(self, keys, paces):
+        self.keys = list(keys)
+        self.pace = array(paces, dtype=float)
+        self.group_id = group_ids([weekday for (date, hour, weekday) in self.keys],
+                                  [hour for (date, hour, weekday) in self.keys])
+        self.expected_pace, self.sd_pace = grouped_leave1_stats(self.pace, self.group_id)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+
+    # Builds a GlobalPaceSeries from a dictionary which maps (date, hour, weekday) --> pace
+    @staticmethod
+    def from_dict(pace_timeseries):
+        keys = list(pace_timeseries)
+        return GlobalPaceSeries(keys, [pace_timeseries[key] for key in keys])
+
+    # Looks up the array positions of a list of (date, hour, weekday) keys
+    def lookup(self, keys):
+        return array([self.index[key] for key in keys], dtype=int)
+
+    # Converts the arrays back into dictionaries keyed by (date, hour, weekday)
+    # Returns:
+        # (pace_timeseries, expected_pace_timeseries, sd_pace_timeseries)
+    def as_dicts(self):
+        return (dict(zip(self.keys, self.pace.tolist())),
+                dict(zip(self.keys, self.expected_pace.tolist())),
+                dict(zip(self.keys, self.sd_pace.tolist())))
+
+
+
+# Reads global_features.csv into a GlobalPaceSeries.  Results are cached, so
+# repeated calls with the same directory do not re-read the file.
+# Params:
+    # dirName - the directory which contains time-series features (produced by extractRegionFeaturesParallel.py)
+    # use_cache - if False, the file is re-read even if it was loaded before
+# Returns:
+    # a GlobalPaceSeries
+def load_global_pace(dirName, use_cache=True):
+    if(use_cache and dirName in _global_pace_cache):
+        return _global_pace_cache[dirName]
+
+    paceFileName = os.path.join(dirName, "global_features.csv")
+    with open(paceFileName, "r") as f:
+        r = csv.reader(f)
+        colIds = getHeaderIds(r.next())
+        (date_id, hour_id, weekday_id, pace_id) = (colIds["Date"], colIds["Hour"],
+                                                    colIds["Weekday"], colIds["Pace"])
+        rows = [(line[date_id], int(line[hour_id]), line[weekday_id], line[pace_id]) for line in r]
+
+    keys = [(date, hour, weekday) for (date, hour, weekday, pace) in rows]
+    paces = array([pace for (date, hour, weekday, pace) in rows], dtype=float)
+    series = GlobalPaceSeries(keys, paces)
+
+    _global_pace_cache[dirName] = series
+    return series
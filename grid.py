@@ -9,12 +9,15 @@ Created on Sat May  3 12:33:42 2014
 """
 
 from datetime import date, datetime, timedelta
-from sets import Set
 import csv
 import os
+from itertools import chain
+from array import array as IntArray
+from numpy import array, arange, repeat, int64
 
 from tools import *
 from trip import *
+from id_dictionary import IdDictionary, uniqueCounts
 
 weekdayname = ['Monday','Tuesday','Wednesday','Thursday','Friday','Saturday','Sunday']
 
@@ -63,7 +66,7 @@ class Entry:
 		self.ss_wind = 0
 		
 		
-		self.drivers = Set()			#The set of unique drivers
+		self.drivers = IntArray('L')		#The driver of each trip (integer ids from the GridSystem's driver dictionary) - see countDrivers()
 		
 		#self.trips = []
 		
@@ -76,7 +79,8 @@ class Entry:
 	#Records a trip into this entry by updating the features
 	#Arguments:
 		#trip - the Trip to be recorded
-	def record(self, trip):
+		#driver - the integer id of the trip's driver (see id_dictionary.py)
+	def record(self, trip, driver):
 		self.numtrips += 1
 		self.s_time += trip.time
 		self.ss_time += trip.time**2
@@ -84,7 +88,7 @@ class Entry:
 		self.ss_dist += trip.dist**2
 		self.ss_time_over_dist += (trip.time**2 / trip.dist)
 		
-		self.drivers.add(trip.driver_id)
+		self.drivers.append(driver)
 		#self.trips.append(trip)
 		
 
@@ -94,6 +98,16 @@ class Entry:
 		
 		self.error_counts[Trip.VALID] += 1
 	
+#Counts the unique drivers of many entries at once (see id_dictionary.uniqueCounts())
+#Arguments:
+	#entries - a list of Entries
+#Returns:
+	#an integer array with the number of unique drivers in each entry
+def countDrivers(entries):
+	group_ids = repeat(arange(len(entries)), [len(entry.drivers) for entry in entries])
+	driver_ids = array(list(chain.from_iterable(entry.drivers for entry in entries)), dtype=int64)
+	return uniqueCounts(group_ids, driver_ids, len(entries))
+
 #The time granularity of analysis - this timedelta object will be used a lot, so let's just generate it once...	
 HOUR_GRANULARITY = timedelta(hours = 1)
 
@@ -143,6 +157,9 @@ class GridSystem:
 	#Initialize the GridSystem for outputting features.  Opens a file for each type of feature.
 	#This method should be called before record()
 	def begin(self):
+		#Drivers are counted by integer id, instead of by hack_license string
+		self.driver_dict = IdDictionary()
+		
 		try:
 			os.mkdir(self.dirName)
 		except:
@@ -298,8 +315,9 @@ class GridSystem:
 		
 		#Update that entry's features using this trip's data
 		if(entry != None and trip.isValid()==Trip.VALID):	
-			entry.record(trip)
-			self.globalEntry.record(trip)
+			driver = self.driver_dict.encode(trip.driver_id)
+			entry.record(trip, driver)
+			self.globalEntry.record(trip, driver)
 		else:
 			self.recordError(trip)
 
@@ -376,10 +394,8 @@ class GridSystem:
 			
 			#Write unique driver count features - one value for each entry (pair of regions)
 			line = [str(self.currentTime.date()), self.currentTime.hour, weekday]
-			for fromCell in self.cells:
-				for toCell in self.cells:
-					entry = self.entries[(fromCell, toCell)]
-					line.append(len(entry.drivers))
+			entries = [self.entries[(fromCell, toCell)] for fromCell in self.cells for toCell in self.cells]
+			line.extend(countDrivers(entries).tolist())
 			self.driversF.writerow(line)
 			self.driversFp.flush()
 			
@@ -401,7 +417,7 @@ class GridSystem:
 				avg_wind = 0
 				sdev_wind = 0
 			
-			self.globalF.writerow([str(self.currentTime.date()), self.currentTime.hour, weekday, self.globalEntry.numtrips, pace, self.globalEntry.s_dist, len(self.globalEntry.drivers), avg_wind, sdev_wind] + self.globalEntry.error_counts)
+			self.globalF.writerow([str(self.currentTime.date()), self.currentTime.hour, weekday, self.globalEntry.numtrips, pace, self.globalEntry.s_dist, countDrivers([self.globalEntry])[0], avg_wind, sdev_wind] + self.globalEntry.error_counts)
 			self.globalFp.flush()
 		else:
 			print("self.currentTime is None")
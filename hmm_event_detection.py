@@ -5,12 +5,14 @@ Created on Tue May  5 12:31:30 2015
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
 
-from hmmlearn.hmm import MultinomialHMM
-from numpy import array
+from numpy import array, asarray, log, diff, where, int8, frombuffer, partition
+from numpy import maximum, minimum, concatenate
+from collections import deque
+import math
 
 from tools import *
-from measureOutliers import readGlobalPace, getExpectedPace
-import csv
+from global_pace import load_global_pace
+import csv, os, pickle
 
 
 #Read the time-series outlier scores from file.  Note that this file should be generated by measureOutliers.py
@@ -34,44 +36,151 @@ def readOutlierScores(filename):
 
 
 
-def get_event_properties(start_id, end_id, dates_list, mahal_list, 
+# Set up the hidden markov model.  We are modeling the non-event states as "0"
+# and event states as "1"
+
+# Transition matrix with heavy weight on the diagonals ensures that the model
+# is likely to stick in the same state rather than rapidly switching.  In other
+# words, the predictions will be relatively "smooth"
+TRANS_MATRIX = array([[.999, .001],
+                      [.001, .999]])
+
+# Emission matrix - state 0 is likely to emit symbol 0, and vice versa
+# In other words, events are likely to be outliers
+EMISSION_MATRIX = array([[.95, .05],
+                         [.4, .6]])
+
+# Both states are equally likely at the start
+START_PROB = array([.5, .5])
+
+
+
+# Finds a quantile of an unsorted array, with the same linear interpolation as
+# tools.getQuantile().  Only the two values around the quantile are found (with
+# a partial sort), instead of sorting the whole array
+def array_quantile(vals, quant):
+    i = int(math.floor(len(vals) * quant))
+    j = int(math.ceil(len(vals) * quant))
+    part = partition(vals, (i, j))
+    lowV = part[i]
+    hiV = part[j]
+    return lowV + (hiV - lowV) * (len(vals)*quant - i)
+
+
+
+# Finds the most likely sequence of hidden states of a two-state HMM, using the
+# Viterbi algorithm.  This is done in log-space, so long sequences do not underflow.
+# Ties are broken in favor of state 0 (the first state), like hmmlearn does.
+# Params:
+    # symbols - an integer array of observed symbols
+    # trans_matrix - the 2x2 transition matrix
+    # emission_matrix - a 2 x (num symbols) matrix of emission probabilities
+    # start_prob - the probabilities of the first state
+# Returns:
+    # (lnl, states) - the log-likelihood of the best path, and an int8 array of
+        # the states (0 or 1) along it
+def viterbi(symbols, trans_matrix=TRANS_MATRIX, emission_matrix=EMISSION_MATRIX,
+            start_prob=START_PROB):
+    ((t00, t01), (t10, t11)) = log(trans_matrix).tolist()
+    (emit0, emit1) = log(emission_matrix).tolist()
+    (start0, start1) = log(start_prob).tolist()
+    symbols = asarray(symbols).tolist()
+    n = len(symbols)
+    if(n == 0):
+        return 0.0, array([], dtype=int8)
+    
+    # Back pointers - the best previous state for state 0 and state 1 at each time
+    from0 = bytearray(n)
+    from1 = bytearray(n)
+    
+    # Forward pass - the log-probability of the best path ending in each state
+    d0 = start0 + emit0[symbols[0]]
+    d1 = start1 + emit1[symbols[0]]
+    for t in xrange(1, n):
+        s = symbols[t]
+        stay0 = d0 + t00
+        switch0 = d1 + t10
+        stay1 = d1 + t11
+        switch1 = d0 + t01
+        if(stay0 >= switch0):
+            new_d0 = stay0
+        else:
+            new_d0 = switch0
+            from0[t] = 1
+        if(switch1 >= stay1):
+            new_d1 = switch1
+        else:
+            new_d1 = stay1
+            from1[t] = 1
+        d0 = new_d0 + emit0[s]
+        d1 = new_d1 + emit1[s]
+    
+    # Backward pass - follow the back pointers from the best final state
+    states = bytearray(n)
+    state = 0 if d0 >= d1 else 1
+    lnl = max(d0, d1)
+    for t in xrange(n - 1, -1, -1):
+        states[t] = state
+        state = from1[t] if state else from0[t]
+    
+    return lnl, frombuffer(states, dtype=int8).copy()
+
+
+
+# Finds the events (runs of state 1) in a state sequence.  Only events that end
+# before the sequence does are returned
+# Params:
+    # states - an integer array of states (0 or 1)
+# Returns:
+    # (start_ids, end_ids) - integer arrays.  Event i covers [start_ids[i], end_ids[i])
+def get_event_ranges(states):
+    changes = diff(asarray(states, dtype=int8))
+    start_ids = where(changes == 1)[0] + 1
+    end_ids = where(changes == -1)[0] + 1
+    if(len(states) > 0 and states[0] == 1):
+        start_ids = concatenate([[0], start_ids])
+    return start_ids[:len(end_ids)], end_ids
+
+
+def get_event_date(dates_list, i):
+    (date, hour, weekday) = dates_list[i]
+    return datetime.strptime(date, "%Y-%m-%d") + timedelta(hours = int(hour))
+
+
+# Computes the properties of all events at once, using segment-wise reductions
+# Params:
+    # start_ids, end_ids - see get_event_ranges()
+    # dates_list - the (date, hour, weekday) of each timeslice
+    # mahal_list, global_pace_list, expected_pace_list - arrays with one value per timeslice
+# Returns:
+    # a list of [start_date, end_date, duration, max_mahal, max_pace_dev, min_pace_dev]
+def get_event_properties(start_ids, end_ids, dates_list, mahal_list,
                          global_pace_list, expected_pace_list):
-    duration = end_id - start_id
+    if(len(start_ids) == 0):
+        return []
     
-    pace_devs = [global_pace_list[i] - expected_pace_list[i] for i in xrange(start_id, end_id)]
-    min_pace_dev = min(pace_devs) / 60
-    max_pace_dev = max(pace_devs) / 60
-    max_mahal = max(mahal_list[start_id:end_id])
+    # Each event ends before the next one starts, so the boundaries are increasing
+    boundaries = concatenate([start_ids, end_ids])
+    boundaries.sort()
     
-    (date, hour, weekday) = dates_list[start_id]
-    start_date = datetime.strptime(date, "%Y-%m-%d") + timedelta(hours = int(hour))
+    pace_devs = asarray(global_pace_list) - asarray(expected_pace_list)
+    min_pace_devs = minimum.reduceat(pace_devs, boundaries)[::2] / 60
+    max_pace_devs = maximum.reduceat(pace_devs, boundaries)[::2] / 60
+    max_mahals = maximum.reduceat(asarray(mahal_list), boundaries)[::2]
+    durations = end_ids - start_ids
     
-    (date, hour, weekday) = dates_list[end_id - 1]
-    end_date = datetime.strptime(date, "%Y-%m-%d") + timedelta(hours = int(hour))
-    return [start_date, end_date, duration, max_mahal, max_pace_dev, min_pace_dev]
+    return [[get_event_date(dates_list, start_id), get_event_date(dates_list, end_id - 1),
+             duration, max_mahal, max_pace_dev, min_pace_dev]
+            for (start_id, end_id, duration, max_mahal, max_pace_dev, min_pace_dev) in
+            zip(start_ids.tolist(), end_ids.tolist(), durations.tolist(), max_mahals.tolist(),
+                max_pace_devs.tolist(), min_pace_devs.tolist())]
     
 
 
 def get_all_events(states, dates_list, mahal_list, global_pace_list, expected_pace_list):
-    currently_in_event = False
-    events = []
-    for i in xrange(len(states)):
-        
-        if(not currently_in_event and states[i]==1):
-            event_start_id = i
-            currently_in_event = True
-        
-        if(currently_in_event and states[i] == 0):
-            event_end_id = i
-            currently_in_event = False
-            
-            event_properties = get_event_properties(event_start_id, event_end_id,
-                                    dates_list, mahal_list, global_pace_list,
-                                    expected_pace_list)
-            
-            events.append(event_properties)
-    
-    return events
+    (start_ids, end_ids) = get_event_ranges(states)
+    return get_event_properties(start_ids, end_ids, dates_list, mahal_list,
+                                global_pace_list, expected_pace_list)
             
             
             
@@ -95,54 +204,41 @@ def augment_outlier_scores(in_file, out_file, predictions):
 
 
 
-def detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries, threshold_quant=.95):
+# Params:
+    # mahal_timeseries, c_timeseries - see readOutlierScores()
+    # global_pace - a global_pace.GlobalPaceSeries, which already contains the expected paces
+    # threshold_quant - the quantile of mahalanobis distances that is considered an outlier
+    # mahal_sketch - an optional tools.QuantileSketch of the mahalanobis distances, merged from
+        # the per-group sketches (see readMahalSketch()).  If not given, the exact quantile of
+        # mahal_timeseries is used
+def detect_events_hmm(mahal_timeseries, c_timeseries, global_pace, threshold_quant=.95,
+                      mahal_sketch=None):
     #Sort the keys of the timeseries chronologically    
     sorted_dates = sorted(mahal_timeseries)
-    
-    
-    (expected_pace_timeseries, sd_pace_timeseries) = getExpectedPace(global_pace_timeseries)    
 
-    #Generate the list of values of R(t)
-    mahal_list = [mahal_timeseries[d] for d in sorted_dates]
-    c_list = [c_timeseries[d] for d in sorted_dates]
-    global_pace_list = [global_pace_timeseries[d] for d in sorted_dates]
-    expected_pace_list = [expected_pace_timeseries[d] for d in sorted_dates]
+    #Generate the arrays of values of R(t)
+    mahal_list = array([mahal_timeseries[d] for d in sorted_dates])
+    c_list = array([c_timeseries[d] for d in sorted_dates])
+    
+    #The global and expected paces are looked up from the arrays in chronological order
+    pace_ids = global_pace.lookup(sorted_dates)
+    global_pace_list = global_pace.pace[pace_ids]
+    expected_pace_list = global_pace.expected_pace[pace_ids]
 
     
     #Use the quantile to determine the threshold
-    sorted_mahal = sorted(mahal_list)
-    threshold = getQuantile(sorted_mahal, threshold_quant)
+    if(mahal_sketch is None):
+        threshold = array_quantile(mahal_list, threshold_quant)
+    else:
+        threshold = mahal_sketch.quantile(threshold_quant)
     
     
     # The symbols array contains "1" if there is an outlier, "0" if there is not
-    symbols = []
-    for i in range(len(mahal_list)):
-        if(mahal_list[i] > threshold or c_list[i]==1):
-            symbols.append(1)
-        else:
-            symbols.append(0)
-    
-    
-    # Set up the hidden markov model.  We are modeling the non-event states as "0"
-    # and event states as "1"
+    symbols = ((mahal_list > threshold) | (c_list == 1)).astype(int8)
     
-    # Transition matrix with heavy weight on the diagonals ensures that the model
-    # is likely to stick in the same state rather than rapidly switching.  In other
-    # words, the predictions will be relatively "smooth"
-    trans_matrix = array([[.999, .001],
-                      [.001,.999]])
-
-    # Emission matrix - state 0 is likely to emit symbol 0, and vice versa
-    # In other words, events are likely to be outliers
-    emission_matrix = array([[.95, .05],
-                             [.4, .6]])
-    
-    # Actually set up the hmm
-    model = MultinomialHMM(n_components=2, transmat=trans_matrix)
-    model.emissionprob_ = emission_matrix
     
-    # Make the predictions
-    lnl, predictions = model.decode(symbols)
+    # Make the predictions - see TRANS_MATRIX and EMISSION_MATRIX
+    lnl, predictions = viterbi(symbols)
     
     events = get_all_events(predictions, sorted_dates, mahal_list, global_pace_list,
                             expected_pace_list)
@@ -152,11 +248,230 @@ def detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries, th
     return events, predictions
 
 
+# Estimates a quantile of a stream of values in O(1) memory, using the P-square
+# algorithm (Jain and Chlamtac, 1985).  Five markers track the minimum, the
+# maximum, the desired quantile and two quantiles halfway to it, and are moved
+# with piecewise-parabolic interpolation as values arrive.
+class P2Quantile:
+    # Params:
+        # quant - the desired quantile, between 0 and 1
+    def __init__(self, quant):
+        self.quant = quant
+        self.count = 0
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2*quant, 4*quant, 2 + 2*quant, 4]
+        self.increments = [0, quant/2, quant, (1 + quant)/2, 1]
+    
+    def insert(self, x):
+        self.count += 1
+        q = self.heights
+        
+        # The first five values are just stored in sorted order
+        if(self.count <= 5):
+            q.append(x)
+            q.sort()
+            return
+        
+        # Find the cell that x falls into, and update the extreme markers
+        if(x < q[0]):
+            q[0] = x
+            k = 0
+        elif(x >= q[4]):
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while(x >= q[k+1]):
+                k += 1
+        
+        n = self.positions
+        for i in xrange(k + 1, 5):
+            n[i] += 1
+        for i in xrange(5):
+            self.desired[i] += self.increments[i]
+        
+        # Move the middle markers towards their desired positions
+        for i in xrange(1, 4):
+            d = self.desired[i] - n[i]
+            if((d >= 1 and n[i+1] - n[i] > 1) or (d <= -1 and n[i-1] - n[i] < -1)):
+                d = 1 if d > 0 else -1
+                qp = q[i] + float(d) / (n[i+1] - n[i-1]) * (
+                        (n[i] - n[i-1] + d) * (q[i+1] - q[i]) / (n[i+1] - n[i]) +
+                        (n[i+1] - n[i] - d) * (q[i] - q[i-1]) / (n[i] - n[i-1]))
+                if(not (q[i-1] < qp < q[i+1])):
+                    # The parabolic estimate is out of order - use linear instead
+                    qp = q[i] + float(d) * (q[i+d] - q[i]) / (n[i+d] - n[i])
+                q[i] = qp
+                n[i] += d
+    
+    # The current estimate of the quantile
+    def quantile(self):
+        if(self.count == 0):
+            return float('nan')
+        if(self.count <= 5):
+            return getQuantile(self.heights, min(self.quant, (self.count - 1.0) / self.count))
+        return self.heights[2]
+
+
+
+# Tracks the event state of the HMM (see TRANS_MATRIX and EMISSION_MATRIX) online,
+# as hours are scored, instead of decoding the whole time series at once.  Each
+# call to update() costs O(lag) time, and the memory does not grow over time.
+#   - Forward filtering gives the probability that the current hour is in an event.
+#     Its most likely state gives PROVISIONAL event boundaries, with no delay.
+#   - Fixed-lag Viterbi decodes the state of the hour that was scored lag hours ago,
+#     using the best path that ends at the current hour.  These states give the
+#     CONFIRMED event boundaries, which match the batch Viterbi of detect_events_hmm()
+#     once lag is long enough for the paths to merge.
+#   - The outlier threshold is a running quantile of the Mahalanobis distances seen
+#     so far (see P2Quantile), so the history never has to be sorted.
+class OnlineEventTracker:
+    # Params:
+        # threshold_quant - the quantile of mahalanobis distances that is considered an outlier
+        # lag - how many hours the confirmed states lag behind the current hour
+        # trans_matrix, emission_matrix, start_prob - the HMM parameters
+    def __init__(self, threshold_quant=.95, lag=48, trans_matrix=TRANS_MATRIX,
+                 emission_matrix=EMISSION_MATRIX, start_prob=START_PROB):
+        self.threshold_estimator = P2Quantile(threshold_quant)
+        self.lag = lag
+        self.trans = trans_matrix.tolist()
+        self.emit = emission_matrix.tolist()
+        self.start_prob = start_prob.tolist()
+        ((self.t00, self.t01), (self.t10, self.t11)) = log(trans_matrix).tolist()
+        (self.emit0, self.emit1) = log(emission_matrix).tolist()
+        
+        self.num_steps = 0
+        self.filtered = None      # P(state | symbols so far), normalized
+        self.delta = None         # Viterbi log-probabilities, shifted so the max is 0
+        self.back_pointers = deque(maxlen=lag)  # (from0, from1) of the last lag steps
+        self.keys = deque(maxlen=lag + 1)       # The keys of the last lag+1 hours
+        self.provisional_state = 0
+        self.confirmed_state = 0
+    
+    # The probability that the current hour is in an event
+    def event_prob(self):
+        return self.filtered[1]
+    
+    # Scores a new hour
+    # Params:
+        # key - the (date, hour, weekday) of this hour
+        # mahal - the mahalanobis distance of this hour
+        # c_val - 1 if RPCA marked this hour as an outlier, 0 otherwise
+    # Returns:
+        # a list of (boundary_type, key) tuples, where boundary_type is
+        # "provisional_start", "provisional_end", "start", or "end".  Starts are
+        # the first hour of an event, and ends are the first hour after it
+    def update(self, key, mahal, c_val):
+        self.threshold_estimator.insert(mahal)
+        s = 1 if (mahal > self.threshold_estimator.quantile() or c_val == 1) else 0
+        self.keys.append(key)
+        self.num_steps += 1
+        boundaries = []
+        
+        if(self.num_steps == 1):
+            (p0, p1) = self.start_prob
+            (d0, d1) = (math.log(p0) + self.emit0[s], math.log(p1) + self.emit1[s])
+        else:
+            # Forward filtering
+            (f0, f1) = self.filtered
+            p0 = f0*self.trans[0][0] + f1*self.trans[1][0]
+            p1 = f0*self.trans[0][1] + f1*self.trans[1][1]
+            
+            # Viterbi step - ties are broken in favor of state 0, like viterbi()
+            (d0, d1) = self.delta
+            (stay0, switch0) = (d0 + self.t00, d1 + self.t10)
+            (switch1, stay1) = (d0 + self.t01, d1 + self.t11)
+            from0 = 0 if stay0 >= switch0 else 1
+            from1 = 0 if switch1 >= stay1 else 1
+            self.back_pointers.append((from0, from1))
+            d0 = max(stay0, switch0) + self.emit0[s]
+            d1 = max(switch1, stay1) + self.emit1[s]
+        
+        p0 *= self.emit[0][s]
+        p1 *= self.emit[1][s]
+        self.filtered = (p0 / (p0 + p1), p1 / (p0 + p1))
+        self.delta = (d0 - max(d0, d1), d1 - max(d0, d1))
+        
+        new_state = 1 if self.filtered[1] > self.filtered[0] else 0
+        if(new_state != self.provisional_state):
+            boundaries.append(("provisional_start" if new_state else "provisional_end", key))
+            self.provisional_state = new_state
+        
+        # Decode the hour from lag steps ago, once there is enough history
+        if(self.num_steps > self.lag):
+            state = self.best_final_state()
+            for (from0, from1) in reversed(self.back_pointers):
+                state = from1 if state else from0
+            boundaries += self.confirm(state, self.keys[0])
+        
+        return boundaries
+    
+    def best_final_state(self):
+        return 0 if self.delta[0] >= self.delta[1] else 1
+    
+    def confirm(self, state, key):
+        if(state == self.confirmed_state):
+            return []
+        self.confirmed_state = state
+        return [("start" if state else "end", key)]
+    
+    # Confirms the states of the last lag hours, as if the time series ended now
+    # Returns:
+        # a list of (boundary_type, key) tuples - see update()
+    def finish(self):
+        # Backtrack over the hours that have not been confirmed yet
+        num_pending = min(self.lag, self.num_steps)
+        states = [self.best_final_state()]
+        pointers = list(self.back_pointers)
+        for i in xrange(num_pending - 1):
+            (from0, from1) = pointers[len(pointers) - 1 - i]
+            states.append(from1 if states[-1] else from0)
+        states.reverse()
+        
+        keys = list(self.keys)[-num_pending:]
+        boundaries = []
+        for (state, key) in zip(states, keys):
+            boundaries += self.confirm(state, key)
+        return boundaries
+
+
+
+# Replays a time series through an OnlineEventTracker, as if the hours were scored one by one
+# Params:
+    # mahal_timeseries, c_timeseries - see readOutlierScores()
+    # threshold_quant, lag - see OnlineEventTracker
+# Returns:
+    # a list of (boundary_type, key, key_when_emitted) tuples, in the order they were emitted
+def track_events_online(mahal_timeseries, c_timeseries, threshold_quant=.95, lag=48):
+    tracker = OnlineEventTracker(threshold_quant=threshold_quant, lag=lag)
+    boundaries = []
+    for key in sorted(mahal_timeseries):
+        for (boundary_type, boundary_key) in tracker.update(key, mahal_timeseries[key], c_timeseries[key]):
+            boundaries.append((boundary_type, boundary_key, key))
+    for (boundary_type, boundary_key) in tracker.finish():
+        boundaries.append((boundary_type, boundary_key, None))
+    return boundaries
+
+
+# Reads the QuantileSketch of the mahal10 scores which was saved next to an outlier
+# score file by measureOutliers.generateTimeSeriesOutlierScores()
+# Returns:
+    # a tools.QuantileSketch, or None if the scores were written without one
+def readMahalSketch(outlier_score_file):
+    sketch_file = outlier_score_file.replace("_robust_outlier_scores.csv", "_mahal_sketch.pickle")
+    if(sketch_file == outlier_score_file or not os.path.exists(sketch_file)):
+        return None
+    with open(sketch_file, "rb") as f:
+        return pickle.load(f)
+
+
 def process_events(outlier_score_file, feature_dir, output_file):
     mahal_timeseries, c_timeseries = readOutlierScores(outlier_score_file)
-    global_pace_timeseries = readGlobalPace(feature_dir)
+    global_pace = load_global_pace(feature_dir)
 
-    events, predictions = detect_events_hmm(mahal_timeseries, c_timeseries, global_pace_timeseries)
+    events, predictions = detect_events_hmm(mahal_timeseries, c_timeseries, global_pace,
+                                            mahal_sketch=readMahalSketch(outlier_score_file))
     
     new_scores_file = output_file.split(".")[0] + "_scores.csv"
     augment_outlier_scores(outlier_score_file, new_scores_file, predictions)
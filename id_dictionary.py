@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Dictionary encoding of string identifiers (medallions and hack_licenses).  Each
+distinct string gets a dense integer id, in order of first appearance, so ids
+can be stored in uint32 arrays and counted with array operations.  The mapping
+is saved as a text file with one string per line (the line number is the id).
+
+@author: Brian Donovan (briandonovan100@gmail.com)
+"""
+from numpy import array, asarray, uint32, int64, unique, bincount
+from numpy.random import RandomState
+
+
+# Maps strings <--> dense integer ids
+class IdDictionary:
+    # Params:
+        # names - an optional list of strings, which get the ids 0, 1, 2, ...
+    def __init__(self, names=[]):
+        self.names = []
+        self.ids = {}
+        for name in names:
+            self.encode(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    # The id of a string.  New strings are added to the dictionary.
+    def encode(self, name):
+        if(name not in self.ids):
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    # The ids of a list of strings, as a uint32 array
+    def encodeAll(self, names):
+        return array([self.encode(name) for name in names], dtype=uint32)
+
+    # The strings of a list or array of ids
+    def decode(self, ids):
+        return [self.names[i] for i in asarray(ids).tolist()]
+
+    # A random relabeling of the ids, for anonymized output.  The ids in an array are
+    # anonymized with one lookup (perm[ids]) instead of encrypting every row
+    # Params:
+        # seed - a seed for the random number generator.  If None, the relabeling is not repeatable
+    # Returns:
+        # perm - a uint32 array, where perm[i] is the anonymous id of id i
+    def permutation(self, seed=None):
+        return RandomState(seed).permutation(len(self)).astype(uint32)
+
+    # Saves the dictionary to a text file - line i contains the string with id i
+    def save(self, filename):
+        with open(filename, "w") as f:
+            for name in self.names:
+                f.write(name + "\n")
+
+    # Loads a dictionary which was written by save()
+    @staticmethod
+    def load(filename):
+        with open(filename, "r") as f:
+            return IdDictionary([line.rstrip("\n") for line in f])
+
+
+
+# Counts the number of distinct ids in each group (e.g. the number of unique drivers per
+# OD pair and hour), without building a set per group
+# Params:
+    # group_ids - an integer array, giving the group of each observation
+    # ids - an integer array of the same length, giving the id of each observation
+    # num_groups - the total number of groups
+# Returns:
+    # an integer array with one count per group
+def uniqueCounts(group_ids, ids, num_groups):
+    group_ids = asarray(group_ids, dtype=int64)
+    ids = asarray(ids, dtype=int64)
+    if(len(ids) == 0):
+        return bincount(group_ids, minlength=num_groups)
+    num_ids = ids.max() + 1
+    pairs = unique(group_ids * num_ids + ids)
+    return bincount(pairs // num_ids, minlength=num_groups)
@@ -6,10 +6,11 @@ Created on Tue Sep 30 19:28:30 2014
 """
 from tools import *
 from numpy import transpose, matrix, nonzero, ravel, diag, sqrt, where, square
-from numpy import zeros, multiply, column_stack, arange
+from numpy import zeros, multiply, column_stack, arange, maximum
 from numpy.linalg import inv, eig
+from scipy.sparse import issparse
 
-from data_preprocessing import pca, scale_and_center
+from data_preprocessing import pca, scale_and_center, as_data_matrix, observation_matrix
 from op_modified import opursuit
 from tuneparameters import increasing_tolerance_search
 
@@ -22,6 +23,11 @@ from random import random, uniform
 import csv
 from sys import stdout
 
+# The largest number of PCs that iterative (EM) PCA may be asked for.  The
+# Mahalanobis distances only use the top 50 components
+MAX_EM_PCS = 50
+
+
 
 #Represents a set of statistics for a group of mean pace vectors
 #Technically, it stores the moments, sum(1), sum(x), sum(x**2)
@@ -403,22 +409,50 @@ def computeMahalanobisDistances(vectors, independent=False, group_of_weights=Non
 
 
 
+# Computes the Mahalanobis distance of every column of centered_corrupt, using
+# only the first keep_dims principal components.  This is a vectorized version of
+# IndependentGroupedStats.mahalanobisDistance() - entries that are exactly 0 are
+# treated as missing, and are left out of the stats and the distances
+# Params:
+    # pcs - a 2-D array whose columns are the principal components
+    # robust_lowdim_data - the data used to estimate the mean and variance, already
+        # projected onto the principal components
+    # centered_corrupt - the data to measure, a 2-D array whose columns are observations
+    # keep_dims - the number of principal components to use
+# Returns:
+    # a list of Mahalanobis distances, one for each column of centered_corrupt
 def lowdim_mahalanobis_distance(pcs, robust_lowdim_data, centered_corrupt, keep_dims):
-    new_pcs = pcs[:,0:keep_dims]
+    corrupt_lowdim_data = pcs[:,0:keep_dims].T.dot(centered_corrupt)
+    return projected_mahalanobis_distance(robust_lowdim_data, corrupt_lowdim_data, keep_dims)
+
+
+# Same as lowdim_mahalanobis_distance(), but the data to measure is already projected
+# onto the principal components
+# Params:
+    # robust_lowdim_data - see lowdim_mahalanobis_distance()
+    # corrupt_lowdim_data - the centered data to measure, projected onto the principal components
+    # keep_dims - the number of principal components to use
+def projected_mahalanobis_distance(robust_lowdim_data, corrupt_lowdim_data, keep_dims):
     new_rld = robust_lowdim_data[0:keep_dims,:]
+    corrupt_lowdim_data = corrupt_lowdim_data[0:keep_dims,:]
     
+    # Diagonal covariance assumption is valid since we did PCA
+    count = (new_rld!=0).sum(axis=1)
+    mean = new_rld.sum(axis=1) / count
+    biased_var = square(new_rld).sum(axis=1) / count - square(mean)
+    var = biased_var * (count / (count - 1.0))
     
-    vects = [new_rld[:,i] for i in xrange(new_rld.shape[1])]
-    stats = IndependentGroupedStats(vects) # Diagonal covariance assumption is valid since we did PCA
-    
-    corrupt_lowdim_data = new_pcs.transpose() * centered_corrupt
-    vects = [corrupt_lowdim_data[:,i] for i in xrange(corrupt_lowdim_data.shape[1])]
-    mahals = [stats.mahalanobisDistance(vect) for vect in vects]
+    sq_dists = square(corrupt_lowdim_data - mean[:,None]) / var[:,None]
+    sq_dists[corrupt_lowdim_data==0] = 0
+    mahals = sqrt(sq_dists.sum(axis=0))
     
-    return mahals
+    return mahals.tolist()
 
 
 def get_zscore_matrix(M,L):
+    if(issparse(M)):
+        return get_sparse_zscore_matrix(M, L)
+    
     # Compute z-scores by scaling and centering the records
     # scaling and centering is done with respect to L matrix instead of M, so
     # outliers are discarded
@@ -432,18 +466,48 @@ def get_zscore_matrix(M,L):
     return z_matrix
 
 
+# Same as get_zscore_matrix(), but M is a scipy.sparse matrix whose stored entries
+# are the observed data.  Only the observed entries are standardized - the rest
+# are left at 0, which is how missing data is encoded.  L may be dense or sparse.
+# Returns:
+    # a sparse CSC matrix with the same sparsity pattern as M
+def get_sparse_zscore_matrix(M, L):
+    (n_vars, n_obs) = L.shape
+    row_avgs = ravel(L.sum(axis=1)) / n_obs
+    if(issparse(L)):
+        # Var[X] = E[X^2] - E[X]^2, so the missing entries never have to be filled in
+        row_vars = ravel(L.multiply(L).sum(axis=1)) / n_obs - square(row_avgs)
+        row_sds = sqrt(maximum(row_vars, 0))
+    else:
+        row_sds = sqrt(ravel(square(L - row_avgs[:,None]).sum(axis=1)) / n_obs)
+    
+    z_matrix = M.tocsc().astype(L.dtype)
+    z_matrix.eliminate_zeros()
+    rows = z_matrix.indices
+    z_matrix.data = (z_matrix.data - row_avgs[rows]) / row_sds[rows]
+    return z_matrix
+
+
 
 
 # Compute the Mahalanobis Distances of a group of vectors in order to quantify
 # how unusual they are.  PCA approximation is used for high dimensional data,
 # and Robust PCA via Outlier Pursuit is available.
 # Params:
-    # vectors - a list of Numpy column vectors
+    # vectors - a list of Numpy column vectors, or a 2-D array whose columns are the vectors
     # robust - True if RPCA via OP is desired
     # k - Number of PCs to use in PCA
     # gamma - gamma parameter for RPCA
-def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol_perc=1e-06):
-    data_matrix = column_stack(vectors)
+    # pca_method - how the PCs are computed - see data_preprocessing.pca().  "em"
+        # (iterative PCA) is only allowed if k <= MAX_EM_PCS
+    # em_seed - the random seed of iterative PCA, so the scores are repeatable
+    # init_pcs - optional initial components for iterative PCA, e.g. the components
+        # of a neighboring group (see data_preprocessing.em_pca())
+def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol_perc=1e-06,
+                                pca_method="auto", em_seed=0, init_pcs=None):
+    if(pca_method == "em" and k > MAX_EM_PCS):
+        raise ValueError("Iterative PCA needs k <= %d, got k=%d" % (MAX_EM_PCS, k))
+    data_matrix = as_data_matrix(vectors)
     if(robust):
         
         if(gamma=="tune"):
@@ -451,15 +515,18 @@ def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol
             (weekday, hour) = key
             logMsg("Successfully tuned %s @ %d  after %d guesses : gamma=%f, tol=%f"%(weekday, hour, num_guesses, gamma, tol_perc))
         else:
-            O = (data_matrix!=0)*1 # Observation matrix - 1 where we have data, 0 where we do not
+            O = observation_matrix(data_matrix) # Observation matrix - 1 where we have data, 0 where we do not
              # Use outlier pursuit to get robust low-rank approximation of data
             L,C,term,n_iter = opursuit(data_matrix, O, gamma, tol_perc=tol_perc)
+            num_guesses = 0
+            hi_num_pcs = 0
         
         
         #logMsg("PCA")
         # Perform PCA on the low-rank approximation, and estimate the statistics
         centered_L = scale_and_center(L, scale=False)
-        pcs, robust_lowdim_data = pca(centered_L, k)
+        pcs, robust_lowdim_data = pca(centered_L, k, method=pca_method, seed=em_seed,
+                                       init_pcs=init_pcs)
         num_pca_dimensions = pcs.shape[1]
         logMsg("Num eigenvalues : %d" % num_pca_dimensions)
         
@@ -475,7 +542,7 @@ def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol
  
  
  
-        c_vals = [(sum(square(C[:,i]))!=0)*1 for i in  xrange(C.shape[1])]
+        c_vals = ((square(C).sum(axis=0)!=0)*1).tolist()
         gamma_vals = [gamma for i in xrange(C.shape[1])]
         tol_vals = [tol_perc for i in xrange(C.shape[1])]
         n_pca_d = [num_pca_dimensions for i in xrange(C.shape[1])]
@@ -483,17 +550,20 @@ def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol
         hi_pcs = [hi_num_pcs for i in xrange(C.shape[1])]
         
         z_matrix = get_zscore_matrix(data_matrix,L)
-        z_scores = [z_matrix[:,i] for i in xrange(C.shape[1])]
+        z_scores = [z_matrix[:,i:i+1] for i in xrange(C.shape[1])]
 
         return mahals5, mahals10, mahals20, mahals50, c_vals, z_scores, gamma_vals, tol_vals, n_pca_d, n_guess, hi_pcs
     else:
-        pcs, lowdim_data = pca(data_matrix, k)
+        pcs, lowdim_data = pca(data_matrix, k, method=pca_method, seed=em_seed, init_pcs=init_pcs)
         
-        centered_data = scale_and_center(data_matrix, scale=False)
-        mahals5 = lowdim_mahalanobis_distance(pcs, lowdim_data, centered_data, 5)
-        mahals10 = lowdim_mahalanobis_distance(pcs, lowdim_data, centered_data, 10)
-        mahals20 = lowdim_mahalanobis_distance(pcs, lowdim_data, centered_data, 20)
-        mahals50 = lowdim_mahalanobis_distance(pcs, lowdim_data, centered_data, 50)
+        # The data is centered after it is projected:  pcs^T * (X - mu) = pcs^T * X - pcs^T * mu
+        # For sparse data, this avoids forming the dense centered matrix
+        row_avgs = ravel(data_matrix.sum(axis=1)) / data_matrix.shape[1]
+        centered_lowdim = lowdim_data - pcs.T.dot(row_avgs)[:,None]
+        mahals5 = projected_mahalanobis_distance(lowdim_data, centered_lowdim, 5)
+        mahals10 = projected_mahalanobis_distance(lowdim_data, centered_lowdim, 10)
+        mahals20 = projected_mahalanobis_distance(lowdim_data, centered_lowdim, 20)
+        mahals50 = projected_mahalanobis_distance(lowdim_data, centered_lowdim, 50)
 
     
         c_vals = [0 for i in  xrange(data_matrix.shape[1])]
@@ -504,7 +574,7 @@ def computeMahalanobisDistances((key,vectors), robust=False, k=10, gamma=.5, tol
         hi_pcs = [0 for i in xrange(data_matrix.shape[1])]
         
         z_matrix = get_zscore_matrix(data_matrix,data_matrix)
-        z_scores = [z_matrix[:,i] for i in xrange(data_matrix.shape[1])]
+        z_scores = [z_matrix[:,i:i+1] for i in xrange(data_matrix.shape[1])]
       
         return mahals5, mahals10, mahals20, mahals50, c_vals, z_scores, gamma_vals, tol_vals, n_pca_d, n_guess, hi_pcs
 
@@ -8,7 +8,8 @@ Created on Fri Jan 30 13:25:25 2015
 Functions to load link-by-link traffic conditions as vectors, for use in measureOutliers.py
 """
 from db_functions import db_main, db_travel_times
-from numpy import matrix, zeros
+from numpy import zeros
+from scipy.sparse import csc_matrix
 from routing.Map import Map
 from tools import DefaultPool, splitList, logMsg, dateRange
 from datetime import datetime
@@ -100,9 +101,11 @@ def load_consistent_link_set(dates, perc_obs_threshold):
     # consistent_link_set - a list of (origin_node_id, dest_node_id) tuples, which each
         # represent a link in the graph.  These are the links which will be used to
         # build the pace vectors (in the same order)
+    # sparse - if True, the vectors are scipy.sparse CSC column vectors which only
+        # store the links that have data.  Useful when most links are missing
 # Returns:
     # vects - a list of vectors in the same order as the dates
-def load_pace_vectors(dates, consistent_link_set):
+def load_pace_vectors(dates, consistent_link_set, sparse=False):
     # Map (begin_node,connecting_node) --> ID in the pace vector
     link_id_map = defaultdict(lambda : -1) # -1 indicates an invalid ID number    
     for i in xrange(len(consistent_link_set)):
@@ -113,20 +116,35 @@ def load_pace_vectors(dates, consistent_link_set):
     vects = []
     weights = []
     for date in dates:
-        # Initialize to zero
-        vect = matrix(zeros((len(consistent_link_set), 1)))
-        weight = matrix(zeros((len(consistent_link_set), 1)))
-        
-        
         # Get the travel times for this datetime
         curs = db_travel_times.get_travel_times_cursor(date)
         
-        # Assign travel times into the vector, if this link is in the consistant link set
-        for (begin_node_id, end_node_id, date_time, travel_time, num_trips) in curs:
-            i = link_id_map[begin_node_id, end_node_id] # i will be -1 if the link is not in the consistant link set
-            if(i>=0):
-                vect[i] = travel_time
-                weight[i] = num_trips
+        if(sparse):
+            # Only store the links in the consistent link set that have data
+            ids, travel_times, trip_counts = [], [], []
+            for (begin_node_id, end_node_id, date_time, travel_time, num_trips) in curs:
+                i = link_id_map[begin_node_id, end_node_id]
+                if(i>=0 and travel_time!=0):
+                    ids.append(i)
+                    travel_times.append(travel_time)
+                    trip_counts.append(num_trips)
+            
+            shape = (len(consistent_link_set), 1)
+            col_ids = zeros(len(ids), dtype=int)
+            vect = csc_matrix((travel_times, (ids, col_ids)), shape=shape)
+            weight = csc_matrix((trip_counts, (ids, col_ids)), shape=shape)
+        else:
+            # Initialize to zero
+            vect = zeros((len(consistent_link_set), 1))
+            weight = zeros((len(consistent_link_set), 1))
+            
+            # Assign travel times into the vector, if this link is in the consistant link set
+            for (begin_node_id, end_node_id, date_time, travel_time, num_trips) in curs:
+                i = link_id_map[begin_node_id, end_node_id] # i will be -1 if the link is not in the consistant link set
+                if(i>=0):
+                    vect[i] = travel_time
+                    weight[i] = num_trips
+        
         vects.append(vect)
         weights.append(weight)
     
@@ -141,10 +159,12 @@ def load_pace_vectors(dates, consistent_link_set):
 # to significantly boost performance
 # Params:
     # num_trips_threshold - Used to determine the consistent link set
+    # sparse - if True, scipy.sparse column vectors are used, so memory is proportional
+        # to the amount of observed data (see load_pace_vectors())
 # Returns:
-    # a list of Numpy column vectors, each element of these vectors represents
-    # the travel time on a specific link of the road network
-def load_pace_data(perc_data_threshold=.95, pool=DefaultPool()):
+    # a list of Numpy column vectors (2-D arrays with one column), each element of
+    # these vectors represents the travel time on a specific link of the road network
+def load_pace_data(perc_data_threshold=.95, pool=DefaultPool(), sparse=False):
     weekday_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
     
     # Connect to the database adn get hte available dates
@@ -177,7 +197,8 @@ def load_pace_data(perc_data_threshold=.95, pool=DefaultPool()):
     # vectors for each of these dates.  We will use a partial function to hold the
     # consistent_link_set constant across all dates
     it = splitList(dates, pool._processes)
-    load_pace_vectors_consistent = partial(load_pace_vectors, consistent_link_set=consistent_link_set)
+    load_pace_vectors_consistent = partial(load_pace_vectors, consistent_link_set=consistent_link_set,
+                                           sparse=sparse)
     list_of_lists = pool.map(load_pace_vectors_consistent, it)
     
     logMsg("Merging outputs.")
@@ -244,7 +265,11 @@ def drawFigure(filename, road_map, num_obs):
                                    end_node.lat, end_node.long, num_obs[begin_node_id, end_node_id]])
 
 
-def test():
+# Loads the link-level pace data from the database, and pickles it to tmp_vectors.pickle
+# (see load_from_file())
+# Params:
+    # sparse - if True, the vectors are scipy.sparse column vectors (see load_pace_data())
+def test(sparse=False):
     pool = Pool(8)
 
     print("Connecting")
@@ -264,7 +289,7 @@ def test():
 
 
     print("Loading Pace Data")
-    data = load_pace_data(perc_data_threshold=.95, pool=pool)
+    data = load_pace_data(perc_data_threshold=.95, pool=pool, sparse=sparse)
     with open('tmp_vectors.pickle', 'w') as f:
         pickle.dump(data, f)
 
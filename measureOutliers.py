@@ -6,12 +6,14 @@ Created on Wed Sep 24 12:34:53 2014
 """
 import numpy
 from numpy import matrix, transpose, zeros
-import os, csv
+import os, csv, time, heapq, shutil
 from collections import defaultdict
 from multiprocessing import Pool
 from functools import partial
 
-from data_preprocessing import preprocess_data, remove_bad_dimensions_grouped
+from data_preprocessing import preprocess_data, remove_bad_dimensions_grouped, as_data_matrix, impute_scale_and_center
+from global_pace import load_global_pace, GlobalPaceSeries
+from zscore_array import create_zscore_array, datetime_index, ZscoreArray
 from mahalanobis import *
 from traffic_estimation.plot_estimates import make_video, build_speed_dicts
 from lof import *
@@ -21,6 +23,7 @@ from measureLinkOutliers import load_pace_data, load_from_file
 from sys import stdout
 
 import pickle
+from scipy.sparse import save_npz, load_npz, hstack as sparse_hstack
 
 NUM_PROCESSORS = 2
 
@@ -28,6 +31,7 @@ NUM_PROCESSORS = 2
 #Reads time-series pace data from a file, and sorts it into a convenient format.
 #Arguments:
     #dirName - the directory which contains time-series features (produced by extractGridFeatures.py)
+    #dtype - the precision of the vectors.  numpy.float32 halves the memory
 #Returns:  (pace_timeseries, var_timeseries, count_timeseries, pace_grouped).  Breakdown:
     #pace_timeseries - a dictionary which maps (date, hour, weekday) to the corresponding average pace vector (average pace of each trip type)
     #var_timeseries - a dictionary which maps (date, hour, weekday) to the corresponding pace variance vector (variance of paces of each trip type)
@@ -35,7 +39,7 @@ NUM_PROCESSORS = 2
     #pace_grouped - a dictionary which maps (weekday, hour) to the list of corresponding pace vectors
     #        for example, ("Wednesday", 5) maps to the list of all pace vectors that occured on a Wednesday at 5am.
     #trip_names - the names of the trips, which correspond to the dimensions in the vectors (e.g. "E-E")
-def readPaceData(dirName):
+def readPaceData(dirName, dtype=numpy.float64):
     logMsg("Reading files from " + dirName + " ...")
     #Create filenames
     paceFileName = os.path.join(dirName, "pace_features.csv")
@@ -63,7 +67,7 @@ def readPaceData(dirName):
         paces = map(float, line[3:])
         
         #Convert to numpy column vector
-        v = transpose(matrix(paces))
+        v = numpy.array(paces, dtype=dtype).reshape(len(paces), 1)
         #Save vector in the timeseries
         pace_timeseries[(date, hour, weekday)] = v
         
@@ -81,101 +85,203 @@ def readPaceData(dirName):
 
 
 #Reads the time-series global pace from a file and sorts it into a convenient format
+#The file is parsed once per directory and cached - see global_pace.load_global_pace()
 #Arguments:
     #dirName - the directory which contains time-series features (produced by extractGridFeatures.py)
 #Returns: - a dictionary which maps (date, hour, weekday) to the average pace of all taxis in that timeslice
 def readGlobalPace(dirName):
-    paceFileName = os.path.join(dirName, "global_features.csv")
-    
-    #Read the pace file
-    r = csv.reader(open(paceFileName, "r"))
-    colIds = getHeaderIds(r.next())
-    
-    pace_timeseries = {}
-
-        
-    
-    for line in r:
-        #Extract info
-        #First 3 columns
-        date = line[colIds["Date"]]
-        hour = int(line[colIds["Hour"]])
-        weekday = line[colIds["Weekday"]]
-        #Last 16 columns
-        pace = float(line[colIds["Pace"]])
-        
-
-        #Save vector in the timeseries and the group
-        pace_timeseries[(date, hour, weekday)] = pace
-
+    (pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) = load_global_pace(dirName).as_dicts()
     return pace_timeseries
     
     
     
 #Given a pace timeseries, compute the expected value for each timeslice (based on the weekly periodic pattern)
 #This is a leave-one-out estimate (e.g. The expected pace for Friday, January 1st at 8am is the average of all Fridays at 8am EXCEPT for Friday January 1st)
+#The grouped sums are computed with arrays - see global_pace.grouped_leave1_stats()
 #Arguments:
-	#global_pace_timeseries - see likelihood_test_parallel.readGlobalPace()
+	#global_pace_timeseries - see readGlobalPace()
 #Returns:
 	#A tuple (expected_pace_timeseries, sd_pace_timeseries).  Breakdown:
 		#expected_pace_timeseries - A dictionary keyed by (date, hour, weekday) which contains expected paces for each hour of the timeseries
 		#expected_pace_timeseries - A dictionary keyed by (date, hour, weekday) which contains the standard deviation of paces at that hour of the time series
 def getExpectedPace(global_pace_timeseries):
-	#First computed grouped counts, sums, and sums of squares
-	#Note that these are leave-one-IN estimates.  This will be converted to leave-one-out in the next step
-	grouped_sum = defaultdict(float)
-	grouped_ss = defaultdict(float)	
-	grouped_count = defaultdict(float)
-	#Iterate through all days, updating the corresponding sums
-	for (date, hour, weekday) in global_pace_timeseries:
-		grouped_sum[weekday, hour] += global_pace_timeseries[date,hour,weekday]
-		grouped_ss[weekday, hour] += global_pace_timeseries[date,hour,weekday] ** 2
-		
-		grouped_count[weekday, hour] += 1
-	
-	expected_pace_timeseries = {}
-	sd_pace_timeseries = {}
-	#Now that the grouped stats are computed, iterate through the timeseries again
-	for (date, hour, weekday) in global_pace_timeseries:
-		#The updated count, sum, and sum of squares are computed by subtracting the observation at hand
-		#i.e. a leave-one-out estimate
-		updated_sum = grouped_sum[weekday, hour] - global_pace_timeseries[date, hour, weekday]
-		updated_ss = grouped_ss[weekday, hour] - global_pace_timeseries[date, hour, weekday] ** 2
-		updated_count = grouped_count[weekday, hour] - 1
-		
-		#Compute the average and standard deviation from these sums
-		expected_pace_timeseries[date, hour, weekday] = updated_sum / updated_count
-		sd_pace_timeseries[date, hour, weekday] = sqrt((updated_ss / updated_count) - expected_pace_timeseries[date, hour, weekday] ** 2)
-	
-	#Return the computed time series dictionaries
+	(pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) = GlobalPaceSeries.from_dict(global_pace_timeseries).as_dicts()
 	return (expected_pace_timeseries, sd_pace_timeseries)    
     
     
     
-def reduceOutlierScores(scores, sorted_keys, dates_grouped):
-    #weekday_strs = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-    #mahals - list of lists
-    # dates_grouped - dict of lists
+# The file where the z-scores of one (weekday, hour) group are saved - see saveGroupZscores()
+# Sparse z-scores are saved as .npz files, and dense ones as .npy files
+def zscoreGroupFile(zscore_dir, (weekday, hour), is_sparse=False):
+    return os.path.join(zscore_dir, "%s_%d.%s" % (weekday, hour, "npz" if is_sparse else "npy"))
+
+
+# Saves the z-scores of one group as a binary (num_dates x num_dimensions) array,
+# so they do not have to stay in memory until all of the groups are done.  Each
+# row is one timeslice, so it can be read back as a contiguous slice.
+# Arguments:
+    # zscore_dir - the directory to save into
+    # key - the (weekday, hour) of the group
+    # z_scores - a list of column vectors, as returned by computeMahalanobisDistances()
+    # is_sparse - True if the vectors are scipy.sparse vectors.  Only their observed entries are saved
+def saveGroupZscores(zscore_dir, key, z_scores, is_sparse=False):
+    if(is_sparse):
+        save_npz(zscoreGroupFile(zscore_dir, key, True), sparse_hstack(z_scores).T.tocsr())
+    else:
+        # The stacked columns are Fortran-ordered - copy them so each row is contiguous on disk
+        numpy.save(zscoreGroupFile(zscore_dir, key), numpy.ascontiguousarray(numpy.hstack(z_scores).T))
+
+
+# Reads the z-scores of one group, which were saved by saveGroupZscores()
+# Arguments:
+    # zscore_dir, key, is_sparse - the same as the arguments of saveGroupZscores()
+# Returns:
+    # a (num_dates x num_dimensions) array (memory-mapped), or a sparse CSR matrix
+def loadGroupZscores(zscore_dir, key, is_sparse=False):
+    if(is_sparse):
+        return load_npz(zscoreGroupFile(zscore_dir, key, True))
+    return numpy.load(zscoreGroupFile(zscore_dir, key), mmap_mode='r')
+
+
+# Yields the outlier scores of one (weekday, hour) group in time order
+# Arguments:
+    # key - the (weekday, hour) of the group
+    # scores - the output of computeMahalanobisDistances() for this group
+    # dates - the date of each observation in the group
+# Yields:
+    # (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, gamma, tol,
+    #  n_pca_dim, n_guess, hi_pcs, j) tuples, where j is the row of this timeslice
+    # in the group's z-score file
+def groupScoreStream(key, scores, dates):
+    (this_weekday, this_hour) = key
+    mahals5, mahals10, mahals20, mahals50, c_vals, z_scores, gamma_vals, tol_vals, n_pca_d, n_guess, hi_pcs = scores
+    for j in sorted(xrange(len(dates)), key=lambda j: dates[j]):
+        yield (dates[j], this_hour, this_weekday, mahals5[j], mahals10[j], mahals20[j],
+               mahals50[j], c_vals[j], gamma_vals[j], tol_vals[j], n_pca_d[j], n_guess[j],
+               hi_pcs[j], j)
+
+
+# Merges the outlier scores of all groups into one time-ordered stream.  Each group
+# is already sorted by time, so a k-way merge is enough - the entries are never
+# collected into one big list.
+# Arguments:
+    # scores_by_key - a dictionary which maps (weekday, hour) to the output of
+        # computeMahalanobisDistances() for that group
+    # dates_grouped - a dictionary which maps (weekday, hour) to the list of dates
+# Returns:
+    # an iterator over the entries of groupScoreStream(), sorted by (date, hour)
+def mergeOutlierScores(scores_by_key, dates_grouped):
+    streams = [groupScoreStream(key, scores_by_key[key], dates_grouped[key])
+               for key in sorted(scores_by_key)]
+    return heapq.merge(*streams)
+
+
+
+# Runs one group through func, and measures how long it took
+# Arguments:
+    # func - a function of (key, vectors), e.g. a partial of computeMahalanobisDistances()
+    # (key, vectors) - the group
+# Returns:
+    # (key, seconds, result)
+def timeGroup(func, (key, vectors)):
+    start = time.time()
+    result = func((key, vectors))
+    return (key, time.time() - start, result)
+
+
+# Runs func on one group, and also builds a QuantileSketch of the group's mahal10
+# scores, so the main process only has to merge the small per-group sketches (see
+# generateTimeSeriesOutlierScores()).  Meant to run in the worker processes
+# Arguments:
+    # func - a partial of computeMahalanobisDistances()
+    # (key, vectors) - the group
+# Returns:
+    # the output of func, with the sketch appended as the last element
+def computeScoresAndSketch(func, (key, vectors)):
+    scores = func((key, vectors))
+    return scores + (QuantileSketch.fromValues(scores[1]),)
+
+
+# The file where the merged QuantileSketch of the mahal10 scores is saved, next to
+# the outlier scores with the same prefix (see generateTimeSeriesOutlierScores())
+def mahalSketchFile(file_prefix):
+    return "results/%s_mahal_sketch.pickle" % file_prefix
+
+
+# Reads the running time of each group from a previous run (see writeGroupTimes())
+# Arguments:
+    # filename - the CSV file written by writeGroupTimes()
+# Returns:
+    # a dictionary which maps (weekday, hour) --> (seconds, num_guess), empty if
+    # there is no history yet
+def readGroupTimes(filename):
+    group_times = {}
+    if(not os.path.exists(filename)):
+        return group_times
+    with open(filename, "r") as f:
+        r = csv.reader(f)
+        colIds = getHeaderIds(r.next())
+        for line in r:
+            key = (line[colIds["weekday"]], int(line[colIds["hour"]]))
+            group_times[key] = (float(line[colIds["seconds"]]), int(line[colIds["num_guess"]]))
+    return group_times
+
+
+# Saves the running time of each group, so the next run can schedule the slow
+# groups first
+# Arguments:
+    # filename - the CSV file to write
+    # group_times - a dictionary which maps (weekday, hour) --> (seconds, num_guess)
+def writeGroupTimes(filename, group_times):
+    with open(filename, "w") as f:
+        w = csv.writer(f)
+        w.writerow(['weekday', 'hour', 'seconds', 'num_guess'])
+        for (weekday, hour) in sorted(group_times):
+            (seconds, num_guess) = group_times[(weekday, hour)]
+            w.writerow([weekday, hour, seconds, num_guess])
+
+
+# Runs func on many groups in parallel, scheduling the groups that are expected
+# to be slowest first, so that no worker is left with a long group at the end.
+# The expected cost is the running time (and number of gamma guesses) recorded in
+# group_times, or the size of the group if there is no history for it.  Results are
+# yielded as soon as each group finishes, in no particular order.
+# Arguments:
+    # func - a function of (key, vectors), e.g. a partial of computeMahalanobisDistances()
+    # groups - a list of (key, vectors) tuples
+    # pool - the pool to run in.  Must support imap_unordered()
+    # group_times - a dictionary which maps key --> (seconds, num_guess) from a
+        # previous run (see readGroupTimes()).  The times of this run are added to it
+    # chunksize - how many groups are sent to a worker at a time.  Groups are large,
+        # so 1 keeps the longest-first order without noticeable dispatch overhead
+# Yields:
+    # (key, result) tuples
+def runGroupsLongestFirst(func, groups, pool, group_times, chunksize=1):
+    def expected_cost((key, vectors)):
+        (seconds, num_guess) = group_times.get(key, (0, 0))
+        return (seconds, num_guess, numpy.prod(as_data_matrix(vectors).shape))
+    scheduled = sorted(groups, key=expected_cost, reverse=True)
     
-    all_entries = []
-    for i in xrange(len(sorted_keys)):
-        this_weekday, this_hour = sorted_keys[i]
-        mahals5, mahals10, mahals20, mahals50, c_vals, z_scores, gamma_vals, tol_vals, n_pca_d, n_guess, hi_pcs = scores[i]
-        for j in xrange(len(mahals5)):
-            this_date = dates_grouped[sorted_keys[i]][j]
-            entry = (this_date, this_hour, this_weekday, mahals5[j], mahals10[j],
-                    mahals20[j], mahals50[j], c_vals[j], z_scores[j], gamma_vals[j],
-                    tol_vals[j], n_pca_d[j], n_guess[j], hi_pcs[j])
-            all_entries.append(entry)
+    start = time.time()
+    total_group_time = 0
+    for (key, seconds, result) in pool.imap_unordered(partial(timeGroup, func), scheduled,
+                                                      chunksize=chunksize):
+        num_guess = result[9][0] if len(result[9]) > 0 else 0
+        group_times[key] = (seconds, num_guess)
+        total_group_time += seconds
+        yield (key, result)
     
-    all_entries.sort()
-    return all_entries
+    wall_time = time.time() - start
+    logMsg("Ran %d groups in %.1fs on %d processes (%.1fs of group time, %.1fs if perfectly balanced)" % (
+        len(scheduled), wall_time, pool._processes, total_group_time,
+        total_group_time / pool._processes))
+
 
-    
 
 def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_pcs=10,
                                     gamma=.5, tol_perc=1e-06, perc_missing_allowed=.05,
-                                    make_zscore_vid=False, pool = DefaultPool()):
+                                    make_zscore_vid=False, pool = DefaultPool(), dtype=numpy.float64,
+                                    sparse=False):
                                  
 
 
@@ -187,15 +293,18 @@ def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_
     if(use_link_db):
         file_prefix = "link_"
         
-        #pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_pace_data(
-        #    num_trips_threshold=consistent_threshold, pool=pool)
-        
-        pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_from_file(use_link_db)
+        if(sparse):
+            # Load from the database as scipy.sparse vectors, so memory is proportional
+            # to the observed links (see measureLinkOutliers.load_pace_data())
+            pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_pace_data(
+                pool=pool, sparse=True)
+        else:
+            pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_from_file(use_link_db)
 
 
     else:
         file_prefix = "coarse_"
-        (pace_timeseries, pace_grouped, dates_grouped, trip_names) = readPaceData(inDir)
+        (pace_timeseries, pace_grouped, dates_grouped, trip_names) = readPaceData(inDir, dtype=dtype)
         
 
 
@@ -208,16 +317,19 @@ def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_
         robustStr = "PCA"
 
     file_prefix += "%s_%s_%dpcs_%dpercmiss" % (inDir, robustStr, num_pcs, perc_missing_allowed*100)
+    if(dtype != numpy.float64):
+        file_prefix += "_%s" % numpy.dtype(dtype).name
 
     #pace_grouped = preprocess_data(pace_grouped, num_pcs,
     #                               perc_missing_allowed=perc_missing_allowed)
-    pace_grouped, trip_names = remove_bad_dimensions_grouped(pace_grouped, trip_names, perc_missing_allowed)
+    pace_grouped, trip_names = remove_bad_dimensions_grouped(pace_grouped, trip_names, perc_missing_allowed,
+                                                             dtype=dtype)
     logMsg(trip_names)
 
 
     #Also get global pace information
-    global_pace_timeseries = readGlobalPace(inDir)
-    (expected_pace_timeseries, sd_pace_timeseries) = getExpectedPace(global_pace_timeseries)
+    (global_pace_timeseries, expected_pace_timeseries,
+        sd_pace_timeseries) = load_global_pace(inDir).as_dicts()
 
     logMsg("Starting processes")
     if(gamma=="tune"):
@@ -226,29 +338,56 @@ def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_
         logMsg("Doing RPCA with gamma=%f, k=%d" % (gamma, num_pcs))
     stdout.flush()
 
-    # Freeze the parameters of the computeMahalanobisDistances() function
-    mahalFunc = partial(computeMahalanobisDistances, robust=robust, k=num_pcs,
-                        gamma=gamma, tol_perc=tol_perc)
+    # Freeze the parameters of the computeMahalanobisDistances() function.  Each worker
+    # also sketches the distribution of its group's scores
+    mahalFunc = partial(computeScoresAndSketch,
+                        partial(computeMahalanobisDistances, robust=robust, k=num_pcs,
+                                gamma=gamma, tol_perc=tol_perc))
     
-    # Compute all mahalanobis distances
+    # Compute all mahalanobis distances.  The slowest groups (according to the
+    # previous run) are started first
     sorted_keys = sorted(pace_grouped)    
-    groups = [(key,pace_grouped[key]) for key in sorted_keys]    
-    outlier_scores = pool.map(mahalFunc, groups) #Run all of the groups, using as much parallel computing as possible
-
-    logMsg("Merging output")
-    #Merge outputs from all of the threads
-    entries = reduceOutlierScores(outlier_scores, sorted_keys, dates_grouped)
+    groups = [(key,pace_grouped[key]) for key in sorted_keys]
+    times_file = "results/%s_group_times.csv" % file_prefix
+    group_times = readGroupTimes(times_file)
+    
+    # The z-scores of each group are saved to disk as soon as it is finished, and
+    # merged into one array once all groups are done.  The directory is recreated, so
+    # files left over by an earlier (e.g. crashed) run are never merged into this one
+    zscore_dir = "results/%s_zscores" % file_prefix
+    sparse_zscores = use_link_db and sparse
+    shutil.rmtree(zscore_dir, ignore_errors=True)
+    os.makedirs(zscore_dir)
+    scores_by_key = {}
+    sketches_by_key = {}
+    for (key, scores) in runGroupsLongestFirst(mahalFunc, groups, pool, group_times):
+        saveGroupZscores(zscore_dir, key, scores[5], sparse_zscores)
+        scores_by_key[key] = scores[:5] + (None,) + scores[6:11]
+        sketches_by_key[key] = scores[11]
+    writeGroupTimes(times_file, group_times)
+    
+    # Merge the sketches in key order (not in the order the groups finished), so the
+    # compactions and the resulting thresholds are repeatable.  The event detectors
+    # read the merged sketch instead of sorting all of the scores again
+    mahal_sketch = QuantileSketch()
+    for key in sorted_keys:
+        mahal_sketch.merge(sketches_by_key[key])
+    with open(mahalSketchFile(file_prefix), "wb") as f:
+        pickle.dump(mahal_sketch, f, pickle.HIGHEST_PROTOCOL)
 
     
     logMsg("Writing file")
-    #Output outlier scores to file
+    #Output outlier scores to file, merging the groups in time order
     scoreWriter = csv.writer(open("results/%s_robust_outlier_scores.csv"%file_prefix, "w"))
     scoreWriter.writerow(['date','hour','weekday', 'mahal5', 'mahal10', 'mahal20',
                           'mahal50' ,'c_val', 'gamma', 'tol', 'pca_dim', 'num_guess',
                           'hi_pcs', 'global_pace', 'expected_pace', 'sd_pace'])
     
-    for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
-         n_pca_dim, n_guess, hi_pcs) in sorted(entries):
+    all_cvals = []
+    all_dates = []
+    all_hours = []
+    for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, gamma, tol,
+         n_pca_dim, n_guess, hi_pcs, j) in mergeOutlierScores(scores_by_key, dates_grouped):
         try:
             gl_pace = global_pace_timeseries[(date, hour, weekday)]
             exp_pace = expected_pace_timeseries[(date, hour, weekday)]
@@ -261,35 +400,38 @@ def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_
         scoreWriter.writerow([date, hour, weekday,  mahal5, mahal10, mahal20, mahal50,
                               c_val, gamma, tol, n_pca_dim, n_guess, hi_pcs, 
                               gl_pace, exp_pace, sd_pace])
-
-
-    all_cvals = [c_val for(date, hour, weekday, mahal5, mahal10, mahal20, mahal50,
-                    c_val, z_scores, gamma, tol,n_pca_dim, n_guess, hi_pcs) in sorted(entries)]
-
+        all_cvals.append(c_val)
+        all_dates.append(date)
+        all_hours.append(hour)
+
+
+    # Copy the z-scores of each group (read back from the memory-mapped group files)
+    # into one (hours x dimensions) float32 array - see zscore_array.py
+    logMsg("Writing z-scores")
+    zscore_arrays = dict((key, loadGroupZscores(zscore_dir, key, sparse_zscores)) for key in sorted_keys)
+    zscore_matrix = create_zscore_array("results/%s" % file_prefix,
+                                        datetime_index(all_dates, all_hours), trip_names)
+    i = 0
+    for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, gamma, tol,
+         n_pca_dim, n_guess, hi_pcs, j) in mergeOutlierScores(scores_by_key, dates_grouped):
+        row = zscore_arrays[(weekday, hour)][j]
+        zscore_matrix[i] = row.toarray().ravel() if sparse_zscores else row
+        i += 1
+    del zscore_matrix, zscore_arrays
+    shutil.rmtree(zscore_dir)
     
-    zscoreWriter= csv.writer(open("results/%s_zscore.csv"%file_prefix, "w"))
-    zscoreWriter.writerow(['Date','Hour','Weekday'] + trip_names)
-    #Output zscores to file
-    for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
-         n_pca_dim, n_guess, hi_pcs) in sorted(entries):
-        std_vect = z_scores
-        zscoreWriter.writerow([date, hour, weekday] + ravel(std_vect).tolist())
+    #Also export the z-scores as a CSV file, which is used by the R scripts
+    zscores = ZscoreArray("results/%s" % file_prefix)
+    zscores.export_csv("results/%s_zscore.csv"%file_prefix)
     
     
 
     #def make_video(tmp_folder, filename_base, pool=DefaultPool(), dates=None, speed_dicts=None)
     if(make_zscore_vid):
         logMsg("Making speed dicts")
-        #zscore_list = [zscores[key] for key in sorted(zscores)]
-        date_list = []
-        zscore_list = []
-        
-        for (date, hour, weekday, mahal5, mahal10, mahal20, mahal50, c_val, z_scores, gamma, tol,
-             n_pca_dim, n_guess, hi_pcs) in sorted(entries):
-            if(date >= '2012-10-21' and date < '2012-11-11'):
-                dt = datetime.strptime(date, '%Y-%m-%d') + timedelta(hours=int(hour))
-                date_list.append(dt)
-                zscore_list.append(z_scores)
+        (times, frames) = zscores.window(datetime(2012, 10, 21), datetime(2012, 11, 11))
+        date_list = [t.astype(datetime) for t in times]
+        zscore_list = [frames[i].reshape(-1, 1) for i in xrange(len(frames))]
                 
         speed_dicts = build_speed_dicts(consistent_link_set, zscore_list)
         logMsg("Making video with %d frames" % len(zscore_list))
@@ -310,6 +452,131 @@ def generateTimeSeriesOutlierScores(inDir, use_link_db=False, robust=False, num_
 
 
 
+# The neighborhood sizes of the LOF outlier scores
+LOF_KS = [1, 3, 5, 10, 20, 30, 50]
+
+# Computes the local outlier factor of each vector in one (weekday, hour) group,
+# relative to the other vectors in the group - see lof.getLocalOutlierFactorsForKs()
+# Missing paces are imputed and every dimension is scaled and centered first (see
+# data_preprocessing.impute_scale_and_center()), so neither missing entries nor
+# high-variance links dominate the neighbor distances
+# Arguments:
+    # (key, vectors) - the group
+    # ks - the neighborhood sizes
+# Returns:
+    # a list with one array of local outlier factors per k
+def computeLofScores((key, vectors), ks=LOF_KS):
+    lofs = getLocalOutlierFactorsForKs(impute_scale_and_center(vectors), ks)
+    return [lofs[k] for k in ks]
+
+
+# Computes local outlier factors for every timeslice, as an alternative to the
+# Mahalanobis outlier scores of generateTimeSeriesOutlierScores().  Each (weekday,
+# hour) group is scored separately, and the scores are written in time order to
+# results/<prefix>_lof_scores.csv
+# Arguments:
+    # inDir, use_link_db, perc_missing_allowed, pool - see generateTimeSeriesOutlierScores()
+    # ks - the neighborhood sizes, one output column per k
+# Returns:
+    # a list of rows [date, hour, weekday, lof for each k]
+def generateTimeSeriesLofScores(inDir, use_link_db=False, ks=LOF_KS, perc_missing_allowed=.05,
+                                pool=DefaultPool()):
+    logMsg("Reading files...")
+    if(use_link_db):
+        file_prefix = "link_"
+        pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_from_file(use_link_db)
+    else:
+        file_prefix = "coarse_"
+        (pace_timeseries, pace_grouped, dates_grouped, trip_names) = readPaceData(inDir)
+    file_prefix += "%s_%dpercmiss" % (inDir, perc_missing_allowed*100)
+    pace_grouped, trip_names = remove_bad_dimensions_grouped(pace_grouped, trip_names, perc_missing_allowed)
+    
+    (global_pace_timeseries, expected_pace_timeseries,
+        sd_pace_timeseries) = load_global_pace(inDir).as_dicts()
+    
+    logMsg("Computing LOF with k=%s" % str(ks))
+    sorted_keys = sorted(pace_grouped)
+    groups = [(key, pace_grouped[key]) for key in sorted_keys]
+    lofs_by_group = pool.map(partial(computeLofScores, ks=ks), groups)
+    
+    rows = []
+    for ((weekday, hour), lofs) in zip(sorted_keys, lofs_by_group):
+        for j in xrange(len(dates_grouped[(weekday, hour)])):
+            rows.append([dates_grouped[(weekday, hour)][j], hour, weekday] + [lof[j] for lof in lofs])
+    rows.sort(key=lambda row: (row[0], row[1]))
+    
+    logMsg("Writing file")
+    with open("results/%s_lof_scores.csv" % file_prefix, "w") as f:
+        w = csv.writer(f)
+        w.writerow(['date', 'hour', 'weekday'] + ['lof%d' % k for k in ks] +
+                   ['global_pace', 'expected_pace', 'sd_pace'])
+        for row in rows:
+            key = tuple(row[:3])
+            w.writerow(row + [global_pace_timeseries.get(key, 0), expected_pace_timeseries.get(key, 0),
+                              sd_pace_timeseries.get(key, 0)])
+    
+    logMsg("Done.")
+    return rows
+
+
+
+# Measures how closely the float32 compute mode agrees with float64.  RPCA is run
+# on every (weekday, hour) group in both precisions, with the same fixed gamma and
+# tolerance (tuning is randomized, so it would not be a fair comparison)
+# Arguments:
+    # inDir, use_link_db, num_pcs, perc_missing_allowed, pool - see generateTimeSeriesOutlierScores()
+    # gamma, tol_perc - the RPCA parameters used for both precisions
+    # out_file - a CSV file where the per-group comparison is written
+# Returns:
+    # a list of rows [weekday, hour, rank64, rank32, c_perc64, c_perc32, mahal10_corr]
+def comparePrecision(inDir, use_link_db=False, num_pcs=10000000, gamma=.5, tol_perc=.01,
+                     perc_missing_allowed=.05, pool=DefaultPool(),
+                     out_file="results/precision_agreement.csv"):
+    if(use_link_db):
+        pace_timeseries, pace_grouped, weights_grouped, dates_grouped, trip_names, consistent_link_set = load_from_file(use_link_db)
+    else:
+        (pace_timeseries, pace_grouped, dates_grouped, trip_names) = readPaceData(inDir)
+    pace_grouped, trip_names = remove_bad_dimensions_grouped(pace_grouped, trip_names, perc_missing_allowed)
+    
+    mahalFunc = partial(computeMahalanobisDistances, robust=True, k=num_pcs,
+                        gamma=gamma, tol_perc=tol_perc)
+    sorted_keys = sorted(pace_grouped)
+    
+    # Run the whole analysis in each precision
+    outlier_scores = {}
+    for dtype in [numpy.float64, numpy.float32]:
+        logMsg("Computing outlier scores with %s" % numpy.dtype(dtype).name)
+        groups = [(key, pace_grouped[key].astype(dtype)) for key in sorted_keys]
+        outlier_scores[dtype] = pool.map(mahalFunc, groups)
+    
+    rows = []
+    for i in xrange(len(sorted_keys)):
+        (weekday, hour) = sorted_keys[i]
+        mahals5, mahals10_64, mahals20, mahals50, c_vals_64, z_scores, gamma_vals, tol_vals, n_pca_d_64, n_guess, hi_pcs = outlier_scores[numpy.float64][i]
+        mahals5, mahals10_32, mahals20, mahals50, c_vals_32, z_scores, gamma_vals, tol_vals, n_pca_d_32, n_guess, hi_pcs = outlier_scores[numpy.float32][i]
+        
+        mahal_corr = numpy.corrcoef(mahals10_64, mahals10_32)[0,1]
+        rows.append([weekday, hour, n_pca_d_64[0], n_pca_d_32[0], numpy.mean(c_vals_64),
+                     numpy.mean(c_vals_32), mahal_corr])
+    
+    with open(out_file, "w") as f:
+        w = csv.writer(f)
+        w.writerow(['weekday', 'hour', 'rank64', 'rank32', 'c_perc64', 'c_perc32', 'mahal10_corr'])
+        for row in rows:
+            w.writerow(row)
+    
+    # Summarize the agreement over all groups
+    same_rank = sum([rank64==rank32 for (weekday, hour, rank64, rank32, c64, c32, corr) in rows])
+    max_c_diff = max([abs(c64 - c32) for (weekday, hour, rank64, rank32, c64, c32, corr) in rows])
+    corrs = [corr for (weekday, hour, rank64, rank32, c64, c32, corr) in rows]
+    logMsg("Same rank in %d/%d groups, max c_perc difference %f, mahal10 correlation min=%f mean=%f" % (
+            same_rank, len(rows), max_c_diff, min(corrs), numpy.mean(corrs)))
+    
+    return rows
+
+
+
+
 if(__name__=="__main__"):
     
     
@@ -328,6 +595,13 @@ if(__name__=="__main__"):
     
     
     
+    """
+    # This compares the float32 compute mode against float64 on the link-level data
+    comparePrecision("features_imb20_k10", use_link_db="tmp_vectors.pickle", num_pcs=10000000,
+                     perc_missing_allowed=.05, pool=pool)
+    """
+    
+    
     """
     # This performs the link-level analysis
     generateTimeSeriesOutlierScores("features_imb20_k10", use_link_db="tmp_vectors.pickle", num_pcs=10000000,
@@ -6,9 +6,12 @@ Created on Fri May 30 09:20:24 2014
 """
 from math import exp
 from random import random, uniform, gauss
-from numpy import matrix
+import time
+import numpy
+from numpy import matrix, zeros, flatnonzero
+from numpy.random import RandomState
 from tools import *
-from multiprocessing import Process, Queue
+from multiprocessing import Pool
 
 
 
@@ -69,7 +72,7 @@ def mcmcMaximize(lnlFun, initialguess, MAX_PERTURB=.1, MIN_PERTURB=.002, NUM_ITE
 	
 	#This is the best state so far because it is the only state so far
 	bestAnswer = Answer()
-	besAnswer.x = currentState
+	bestAnswer.x = currentState
 	bestAnswer.fun = currentLnl
 	
 	energy = 1.0 #Simulated Annealing - start at full energy
@@ -110,84 +113,213 @@ def mcmcMaximize(lnlFun, initialguess, MAX_PERTURB=.1, MIN_PERTURB=.002, NUM_ITE
 
 
 
-#A process which runs mcmcMaximize several times and returns the best answer of any
-#The purpose of this class is that many runs of mcmcMaximize can be divided between processes and computed in parallel
-class WorkerProcess(Process):
-	#Custructor
-	#Params:
-		#lnlFun - the log-likelihood function to be maximized
-		#initialguess - the starting point for the Markov Chain.  Will be randomly overwritten in each iteration - the input value serves as an example
-		#MAX_PERTURB - how much to perturb the current state for the proposal?  Decays over iterations
-		#MIN_PERTURB - perturbation size will eventually decay to this on the last iteration
-		#NUM_ITER - the number of iterations per chain
-		#NUM_TRIES - the number of chains to compute (in series - use multiple instances of this class to use parallel)
-		#args - additional arguments to the lnlFun
-	def __init__(self, lnlFun, initialguess, MAX_PERTURB=.1, MIN_PERTURB=.002, NUM_ITER=1000, NUM_TRIES=1, args=[]):
-		super(WorkerProcess, self).__init__()
-		self.lnlFun = lnlFun
-		self.initialguess = initialguess
-		self.MAX_PERTURB = MAX_PERTURB
-		self.NUM_ITER = NUM_ITER
-		self.NUM_TRIES=NUM_TRIES
-		self.args = args
-		self.q = Queue()
-	
-	#Run the process
-	def run(self):
-		bestAns = None
-		#Run N chains, one after another
-		for i in range(self.NUM_TRIES):
-			#Start with a random guess
-			initialguess = [random() for i in range(len(self.initialguess))]
-			#Run the maximization
-			ans = mcmcMaximize(self.lnlFun, initialguess, self.MAX_PERTURB, self.MIN_PERTURB, NUM_ITER=self.NUM_ITER, args=self.args)
-			#Keep track of the best answer so far
-			if(bestAns ==None or ans.fun > bestAns.fun):
-				bestAns = ans
-				
-		#Push the answer into the queue, so the calling process can retrieve it
-		self.q.put(bestAns)
+#The log-likelihood function and its arguments in a worker process of likelihoodPool()
+_installed_lnl = None
+
+#Stores the log-likelihood function and its arguments in a worker process.  Called once per worker,
+#so the arguments (e.g. the data set) are not sent again with every state
+def installLikelihood(lnlFun, args):
+	global _installed_lnl
+	_installed_lnl = (lnlFun, args)
+
+#Evaluates the installed log-likelihood function at one state - a module-level function for use with Pool.map()
+def evaluateInstalled(state):
+	(lnlFun, args) = _installed_lnl
+	return lnlFun(state, args)
+
+#Creates a pool of processes which evaluate one log-likelihood function - see evaluateStates()
+#Params:
+	#lnlFun - the log-likelihood function
+	#args - additional arguments to the lnlFun
+	#num_processes - the number of worker processes
+def likelihoodPool(lnlFun, args, num_processes):
+	return Pool(num_processes, initializer=installLikelihood, initargs=(lnlFun, args))
+
+#Evaluates a log-likelihood function at many states at once
+#Params:
+	#lnlFun - the log-likelihood function.  If vectorized, it is called as lnlFun(states, args) and must
+	#		  return one log-likelihood per row.  Otherwise it is called as lnlFun(list(state), args) for each row
+	#states - an (n x d) array, with one state per row
+	#args - additional arguments to the lnlFun
+	#vectorized - whether lnlFun can evaluate a whole array of states in one call
+	#pool - a pool made by likelihoodPool() for the same lnlFun and args, or None to evaluate in this process.
+	#		Only used if lnlFun is not vectorized.  Only the states are sent to the workers
+#Returns:
+	#an array of n log-likelihoods
+def evaluateStates(lnlFun, states, args, vectorized, pool):
+	if(vectorized):
+		return numpy.asarray(lnlFun(states, args), dtype=float).reshape(len(states))
+	if(pool is None):
+		return numpy.array([lnlFun(state, args) for state in states.tolist()], dtype=float)
+	chunksize = int(numpy.ceil(float(len(states)) / pool._processes))
+	return numpy.array(pool.map(evaluateInstalled, states.tolist(), chunksize=max(chunksize, 1)), dtype=float)
+
+
+#Estimates the effective sample size of a Markov chain, from its autocorrelation
+#The autocorrelation is summed until the first pair of lags whose sum is negative (Geyer's initial positive sequence)
+#Params:
+	#trace - an (n x k) array - n samples from each of k independent chains of the same distribution
+#Returns:
+	#the effective sample size of all k chains combined
+def effectiveSampleSize(trace):
+	(n, k) = trace.shape
+	if(n < 4):
+		return float(n*k)
+	centered = trace - trace.mean(axis=0)
+	variance = (centered**2).mean()
+	if(variance == 0):
+		return float(n*k)
+
+	#Autocorrelation of each chain with an FFT (zero-padded to avoid wrapping), averaged over chains
+	size = 2**int(numpy.ceil(numpy.log2(2*n)))
+	f = numpy.fft.rfft(centered, n=size, axis=0)
+	acov = numpy.fft.irfft(f * numpy.conj(f), n=size, axis=0)[:n].mean(axis=1) / n
+	rho = acov / variance
+
+	#Sum consecutive pairs of autocorrelations while they are positive
+	pair_sums = rho[1:-1:2] + rho[2::2]
+	negative = flatnonzero(pair_sums < 0)
+	last = negative[0] if len(negative) > 0 else len(pair_sums)
+	tau = -1 + 2*(rho[0] + pair_sums[:last].sum())
+	return n*k / max(tau, 1.0)
+
+
+#The "answer" of temperingMaximize().  In addition to the arg max (.x) and the maximum (.fun), it
+#contains diagnostics of the sampler:
+	#temperatures - the temperature ladder
+	#acceptance_rates - the fraction of accepted proposals at each temperature
+	#swap_rates - the fraction of accepted swaps between each pair of adjacent temperatures
+	#samples - an (NUM_ITER x NUM_CHAINS x d) array with the states of the chains at temperature 1
+	#ess - the effective sample size of the temperature-1 chains (the minimum over parameters)
+	#elapsed - the running time in seconds
+	#ess_per_sec - effective samples per second
+class TemperingAnswer(Answer):
+	def summary(self):
+		lines = ["fun: " + str(self.fun),
+			"acceptance rates: " + ", ".join("T=%g: %.3f" % (t, a) for t, a in zip(self.temperatures, self.acceptance_rates)),
+			"swap rates: " + ", ".join("%.3f" % s for s in self.swap_rates),
+			"effective samples: %.1f in %.2f s (%.1f per second)" % (self.ess, self.elapsed, self.ess_per_sec)]
+		return "\n".join(lines)
+
+
+#Uses parallel tempering (replica exchange) Metropolis Hastings to maximize a log-likelihood function
+#NUM_CHAINS chains run at each temperature, and all of them are advanced at once as an array.  Each
+#iteration proposes a perturbation of every chain (with the same simulated annealing schedule as
+#mcmcMaximize()), evaluates all proposals in one batch, then proposes swaps between adjacent temperatures.
+#Hot chains explore freely and hand good states down to the temperature 1 chains
+#Params:
+	#lnlFun - the log-likelihood function to be maximized.  See evaluateStates()
+	#initialguess - a starting point, used by the first chain at each temperature.  The other chains start at random
+	#temperatures - the temperature ladder.  The first temperature should be 1
+	#NUM_CHAINS - the number of chains at each temperature
+	#MAX_PERTURB - how much to perturb the current state for the proposal?  Decays over iterations
+	#MIN_PERTURB - perturbation size will eventually decay to this on the last iteration
+	#NUM_ITER - the number of iterations
+	#vectorized - whether lnlFun can evaluate an array of states in one call
+	#pool - a pool made by likelihoodPool(), used to evaluate lnlFun in parallel if it is not vectorized.  If None,
+	#	   lnlFun is evaluated in this process
+	#args - additional arguments to the lnlFun
+	#seed - a seed for the random number generator
+#Returns:
+	#a TemperingAnswer
+def temperingMaximize(lnlFun, initialguess, temperatures=[1.0, 2.0, 4.0, 8.0], NUM_CHAINS=4, MAX_PERTURB=.1,
+		MIN_PERTURB=.002, NUM_ITER=1000, vectorized=False, pool=None, args=[], seed=None):
+	start_time = time.time()
+	rand = RandomState(seed)
+	temps = numpy.array(temperatures, dtype=float)
+	num_temps = len(temps)
+	dims = len(initialguess)
+
+	#The chains are stored as a (NUM_CHAINS x num_temps x dims) array
+	states = rand.random_sample((NUM_CHAINS, num_temps, dims))
+	states[0,:] = initialguess
+	lnls = evaluateStates(lnlFun, states.reshape(-1, dims), args, vectorized, pool).reshape(NUM_CHAINS, num_temps)
+
+	#If the log-likelihood is -infinity, then the state is not in the feasible set
+	#Keep guessing until every chain has a valid point
+	infeasible = (lnls == float('-inf'))
+	while(infeasible.any()):
+		states[infeasible] = rand.random_sample((infeasible.sum(), dims))
+		lnls[infeasible] = evaluateStates(lnlFun, states[infeasible], args, vectorized, pool)
+		infeasible = (lnls == float('-inf'))
+
+	best = numpy.unravel_index(lnls.argmax(), lnls.shape)
+	bestAnswer = TemperingAnswer()
+	bestAnswer.x = list(states[best])
+	bestAnswer.fun = lnls[best]
+
+	accepted = zeros(num_temps)
+	swaps_accepted = zeros(max(num_temps-1, 0))
+	swaps_proposed = zeros(max(num_temps-1, 0))
+	samples = zeros((NUM_ITER, NUM_CHAINS, dims))
+
+	cooling_rate = (MIN_PERTURB / MAX_PERTURB) ** (1.0 / NUM_ITER)
+	for i in range(NUM_ITER):
+		#Propose a new state for every chain by slightly perturbing the current one
+		sigma = MAX_PERTURB * cooling_rate**i
+		proposals = numpy.clip(states + rand.normal(0, sigma, states.shape), 0, 1)
+		proposalLnls = evaluateStates(lnlFun, proposals.reshape(-1, dims), args, vectorized, pool).reshape(NUM_CHAINS, num_temps)
+
+		#Keep track of the maximum
+		best = numpy.unravel_index(proposalLnls.argmax(), proposalLnls.shape)
+		if(proposalLnls[best] > bestAnswer.fun):
+			bestAnswer.x = list(proposals[best])
+			bestAnswer.fun = proposalLnls[best]
+
+		#Metropolis acceptance at each chain's temperature - P(proposal)^(1/T) / P(current)^(1/T)
+		with numpy.errstate(invalid='ignore', over='ignore'):
+			log_ratio = (proposalLnls - lnls) / temps
+		accept = numpy.log(rand.random_sample(lnls.shape)) < log_ratio
+		states[accept] = proposals[accept]
+		lnls[accept] = proposalLnls[accept]
+		accepted += accept.sum(axis=0)
+
+		#Propose swaps between adjacent temperatures - the even pairs on even iterations and the odd pairs on odd ones
+		for t in range(i % 2, num_temps-1, 2):
+			log_ratio = (1.0/temps[t] - 1.0/temps[t+1]) * (lnls[:,t+1] - lnls[:,t])
+			swap = numpy.log(rand.random_sample(NUM_CHAINS)) < log_ratio
+			states[swap, t], states[swap, t+1] = states[swap, t+1], states[swap, t]
+			lnls[swap, t], lnls[swap, t+1] = lnls[swap, t+1], lnls[swap, t]
+			swaps_accepted[t] += swap.sum()
+			swaps_proposed[t] += NUM_CHAINS
+
+		samples[i] = states[:,0]
+
+	bestAnswer.temperatures = list(temperatures)
+	bestAnswer.acceptance_rates = list(accepted / (NUM_ITER * NUM_CHAINS))
+	bestAnswer.swap_rates = list(swaps_accepted / numpy.maximum(swaps_proposed, 1))
+	bestAnswer.samples = samples
+	bestAnswer.ess = min(effectiveSampleSize(samples[:,:,d]) for d in range(dims))
+	bestAnswer.elapsed = time.time() - start_time
+	bestAnswer.ess_per_sec = bestAnswer.ess / max(bestAnswer.elapsed, 1e-9)
+	return bestAnswer
+
+
 
 #Uses the Metropolis Hastings algorithm to maximize a log-likelihood function (determine the MLE)
-#Runs multiple chains to ensure mixing, and can make use of parallel processing (run a fixed number of chains on each processor)
+#Runs multiple independent chains to ensure mixing.  The chains are advanced together by temperingMaximize(),
+#with a single temperature, and the likelihood is evaluated on a pool of NUM_PROCESSORS processes
 #Params:
-	#lnlFun - the log-likelihood function to be maximized
+	#lnlFun - the log-likelihood function to be maximized.  Must be a module-level (picklable) function if NUM_PROCESSORS > 1
 	#initialguess - the starting point for the Markov Chain.  Will be randomly overwritten in each iteration - the input value serves as an example
 	#MAX_PERTURB - how much to perturb the current state for the proposal?  Decays over iterations
 	#MIN_PERTURB - perturbation size will eventually decay to this on the last iteration
 	#NUM_ITER - the number of iterations per chain
 	#NUM_TRIES - the total number of independent chains to run
-	#NUM_PROCESSORS - the number of processors to use for processing these chains.
-	#		  Each processor will compute (NUM_TRIES / NUM_PROCESSORS) chains
+	#NUM_PROCESSORS - the number of processors used to evaluate the likelihood of the chains
 	#args - additional arguments to the lnlFun
-	
-def mc3Maximize(lnlFun, initialguess, MAX_PERTURB=.1, MIN_PERTURB = .002, NUM_ITER=1000, NUM_TRIES=10, NUM_PROCESSORS=2, args=[]):
-	#Each processor will compute some portion of the chains
-	chainsPerProcess = int(floor(NUM_TRIES/NUM_PROCESSORS))
-	
-	#Create the worker processes
-	workers = []
-	for i in range(NUM_PROCESSORS):
-		
-		#How many chains should run on this processor?
-		#There is a special case if NUM_TRIES is not divisible by NUM_PROCESSORS
-		if(NUM_PROCESSORS * chainsPerProcess + i < NUM_TRIES):
-			nTry = chainsPerProcess
-		else:
-			nTry = chainsPerProcess + 1
-		
-		#Start the worker and add it to the list
-		worker = WorkerProcess(lnlFun, initialguess, MAX_PERTURB=MAX_PERTURB, MIN_PERTURB=MIN_PERTURB, NUM_ITER=NUM_ITER, NUM_TRIES=nTry, args=args)
-		worker.start()
-		workers.append(worker)
-	
-	#Once workers are complete, we start receiving answers from their queues
-	bestAns = None
-	for w in workers:
-		#Get the answer, then terminate the process
-		ans = w.q.get()
-		w.terminate()
-		#Keep track of the best answer across processes
-		if(bestAns==None or ans.fun > bestAns.fun):
-			bestAns = ans
-	return bestAns
\ No newline at end of file
+	#vectorized - whether lnlFun can evaluate an array of states in one call.  If so, no processes are started
+def mc3Maximize(lnlFun, initialguess, MAX_PERTURB=.1, MIN_PERTURB = .002, NUM_ITER=1000, NUM_TRIES=10, NUM_PROCESSORS=2, args=[], vectorized=False):
+	#lnlFun and args are sent to each worker once, when it starts - see likelihoodPool()
+	if(vectorized or NUM_PROCESSORS <= 1):
+		pool = None
+	else:
+		pool = likelihoodPool(lnlFun, args, NUM_PROCESSORS)
+
+	#The initial guess only serves as an example - every chain starts at random
+	initialguess = [random() for i in range(len(initialguess))]
+	bestAns = temperingMaximize(lnlFun, initialguess, temperatures=[1.0], NUM_CHAINS=NUM_TRIES, MAX_PERTURB=MAX_PERTURB,
+		MIN_PERTURB=MIN_PERTURB, NUM_ITER=NUM_ITER, vectorized=vectorized, pool=pool, args=args)
+	if(pool is not None):
+		pool.close()
+	return bestAns
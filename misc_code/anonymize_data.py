@@ -7,87 +7,66 @@ Created on Thu Aug 14 14:00:47 2014
 Much credit goes to:
 """
 
-from Crypto.Cipher import AES
 import os
-import csv
 import shutil
+from itertools import islice
 from multiprocessing import Pool
 
 
 from tools import *
+from anonymize import processChunk, CHUNK_LINES
 BLOCK_SIZE=32
 NUM_PROCESSORS = 8
 
 
-#Use a cipher to encrypt a hex string as another hex string
-def code(orig, cipher):
-	b64 = orig.decode('hex')
-	b64Enc = cipher.encrypt(b64)
-	return b64Enc.encode('hex').upper()
+#Reads the trip and fare files in lockstep, and splits them into aligned chunks of CHUNK_LINES lines
+#Reading stops at the end of the shorter file
+def chunkIterator(year, month, secret, tripInFp, fareInFp):
+	while(True):
+		trip_lines = list(islice(tripInFp, CHUNK_LINES))
+		fare_lines = list(islice(fareInFp, CHUNK_LINES))
+		n = min(len(trip_lines), len(fare_lines))
+		if(n==0):
+			break
+		yield (year, month, secret, trip_lines[:n], fare_lines[:n])
 
-	
 
 #Encrypt all medallions and hack_licenses in the file
-def processMonth((year, month, secret)):
+#Chunks are encrypted in parallel, and written in order.  Only a few chunks per process are
+#read ahead, so memory use does not grow with the size of the file
+#Arguments:
+	#(year, month, secret) - see monthIterator()
+	#pool - a multiprocessing Pool
+def processMonth((year, month, secret), pool=DefaultPool()):
 	tripInFile = "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
 	tripOutFile = "../anon/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
 	fareInFile = "../new_chron/FOIL" + str(year) + "/trip_fare_" + str(month) + ".csv"
 	fareOutFile = "../anon/FOIL" + str(year) + "/trip_fare_" + str(month) + ".csv"
-	
-	tripInFp = open(tripInFile, "r")
-	tripOutFp = open(tripOutFile, "w")
-	fareInFp = open(fareInFile, "r")
-	fareOutFp = open(fareOutFile, "w")
-	
-	tripInCsv = csv.reader(tripInFp)
-	tripOutCsv = csv.writer(tripOutFp)
-	fareInCsv = csv.reader(fareInFp)
-	fareOutCsv = csv.writer(fareOutFp)
-	
-	
-	
-	
-	logMsg("Processing " + str(year) + "-" + str(month))
-	cipher = AES.new(secret)
 
-	
-	#Write the header
-	tripOutCsv.writerow(tripInCsv.next())
-	fareOutCsv.writerow(fareInCsv.next())
+	logMsg("Processing " + str(year) + "-" + str(month))
 	badmonth = 0
-	try:	
+	with open(tripInFile, "r") as tripInFp, open(fareInFile, "r") as fareInFp, \
+			open(tripOutFile, "w") as tripOutFp, open(fareOutFile, "w") as fareOutFp:
+		#Write the header
+		tripOutFp.write(tripInFp.next())
+		fareOutFp.write(fareInFp.next())
+
+		chunks = chunkIterator(year, month, secret, tripInFp, fareInFp)
+		batch_size = 2 * pool._processes
 		while(True):
-			tripLine = tripInCsv.next()
-			fareLine = fareInCsv.next()
-			try:
-				dt = parseUtc(tripLine[5])
-				if(dt.year==year and dt.month==month):
-					tripLine[0] = code(tripLine[0], cipher)
-					tripLine[1] = code(tripLine[1], cipher)
-					fareLine[0] = code(fareLine[0], cipher)
-					fareLine[1] = code(fareLine[1], cipher)
-					
-					if(tripLine[0]==fareLine[0] and tripLine[1] == fareLine[1]):
-						tripOutCsv.writerow(tripLine)
-						fareOutCsv.writerow(fareLine)
-					else:
-						logMsg("MISMATCH ERROR")
-						logMsg("-- " + str(tripLine))
-						logMsg("-- " + str(fareLine))
-				else:
-					badmonth += 1
-			except:
-				logMsg("Parse error on " + str(tripLine))
-	except StopIteration:
-		logMsg("Done with " + str(year) + "-" + str(month))
-		
-	
-	tripInFp.close()
-	tripOutFp.close()
-	fareInFp.close()
-	fareOutFp.close()
+			batch = list(islice(chunks, batch_size))
+			if(len(batch)==0):
+				break
+			for (trip_out, fare_out, chunk_badmonth, messages) in pool.map(processChunk, batch):
+				tripOutFp.writelines(trip_out)
+				fareOutFp.writelines(fare_out)
+				badmonth += chunk_badmonth
+				for msg in messages:
+					logMsg(msg)
+
+	logMsg("Done with " + str(year) + "-" + str(month))
 	return tripInFile + "  :  " + str(badmonth)
-	
+
 
 
 def monthIterator():
@@ -95,24 +74,25 @@ def monthIterator():
 	secrets = {}
 	for y in range(2010, 2014):
 		secrets[y] = os.urandom(BLOCK_SIZE)
-	
-	
+
+
 	for y in range(2010, 2014):
 		for m in range(1, 13):
 			yield (y, m, secrets[y])
 
 
 
-shutil.rmtree("../anon", ignore_errors=True)
-os.mkdir("../anon")
-os.mkdir("../anon/FOIL2010")
-os.mkdir("../anon/FOIL2011")
-os.mkdir("../anon/FOIL2012")
-os.mkdir("../anon/FOIL2013")
+if(__name__=="__main__"):
+	shutil.rmtree("../anon", ignore_errors=True)
+	os.mkdir("../anon")
+	os.mkdir("../anon/FOIL2010")
+	os.mkdir("../anon/FOIL2011")
+	os.mkdir("../anon/FOIL2012")
+	os.mkdir("../anon/FOIL2013")
 
-pool = Pool(NUM_PROCESSORS)
-output = pool.map(processMonth, monthIterator())
+	pool = Pool(NUM_PROCESSORS)
+	output = [processMonth(args, pool) for args in monthIterator()]
 
 
-for line in output:
-	print line
\ No newline at end of file
+	for line in output:
+		print line
@@ -8,7 +8,8 @@ Created on Fri Jun 27 15:30:51 2014
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
 from datetime import datetime, timedelta
-from Queue import PriorityQueue
+import heapq
+import numpy
 from math import sqrt
 from collections import defaultdict
 import csv
@@ -37,165 +38,52 @@ OUT_FILTERED_EVENTS = "results/link_20_normalize_events_sorted.csv"
 
 #Represents a single segment of time - either an event or a space between events
 #Contains a start_id and end_id, which refer to points in time and are INCLUSIVE
-#Functions as a node in a doubly-linked-list.  Has methods to merge consecutive segments
+#These are produced when iterating through a TimeSegmentList - the segments themselves
+#are stored in arrays
 class TimeSegment:
     #Simple constructor
     #Arguments:
         #start_id - The start time of this event, refers to an index in the lnp_list
         #end_id - The end time of this event, refers to an index in the lnp_list
+        #state - True if the segment is above the threshold (an event), False otherwise
     def __init__(self, start_id, end_id, state):
         self.start_id= start_id
         self.end_id = end_id
         self.state = state
-        self.prev = None
-        self.next = None
 
     #For debugging    
     def __str__(self):
         return str(self.start_id) + "," + str(self.end_id) + " : " + str(self.state)
-    
-    #A comparator for sorting times by duration 
-    def __cmp__(self, other):
-        
-        if(other==None):
-            return 1
-        
-        if(self.duration() > other.duration()):
-            return 1
-        elif(self.duration() < other.duration()):
-            return -1
-        
-        if(self.state < other.state):
-            return 1
-        elif(self.state > other.state):
-            return -1
-        
-        return 0
 
     #Compute duration of this segment
     def duration(self):
         return self.end_id - self.start_id + 1 # Start and end are both inclusive, so +1
     
-    #Merges a segment with its two neighbors.  Used to "fill gaps" between nearby events.
-    #Imagine that the middle (S)pace is merged with its two neighboring (E)vents:
-    # From:  E<-->S<-->E<-->S<-->E<-->S<-->E
-    #  To :  E<-->S<--------E-------->S<-->E
-    #Event, space, event becomes one large event.  Pointers must be updated
-    #IMPORTANT : In general, this method should only be called via TimeSegmentList.mergeSegment(), because that method also does some bookkeeping
-    #Returns: The newly generated larger segment    
-    def mergeWithNeighbors(self):
-        #Build the new segment.  there are 3 cases
-        if(self.prev==None):
-            #This is the first segment - merge with the next segment
-            newSegment = TimeSegment(self.start_id, self.next.end_id, self.next.state)
-        elif(self.next==None):
-            #This is the last segment - merge with the previous segment
-            newSegment = TimeSegment(self.prev.start_id, self.end_id, self.prev.state)
-        else:
-            #General case - merge with the previous AND next segments
-            newSegment = TimeSegment(self.prev.start_id, self.next.end_id, self.prev.state)
-        
-        #Update the links to and from the previous item (if they exist)
-        if(self.prev!=None):            
-            if(self.prev.prev !=None):
-                self.prev.prev.next = newSegment
-            newSegment.prev = self.prev.prev
-        
-        #Update the links to and form the next item (if they e)xist)
-        if(self.next!=None):
-            if(self.next.next != None):
-                self.next.next.prev = newSegment
-            newSegment.next = self.next.next
-
-        return newSegment
-    
     
 #Represents a timeline of many events and spaces between events.
-#Contains many TimeSegments. Supports iteration and high-level operations
+#The segments are stored in three parallel arrays (start_ids, end_ids, states), in
+#chronological order.  Supports iteration and high-level operations
 class TimeSegmentList:
     #Constructor - builds a TimeSegmentList from a list of values and a threshold
-    #New TimeSegments are added sequentially each time the value crosses the threshold
+    #A new TimeSegment starts each time the value crosses the threshold
     def __init__(self, lnp_list, threshold):
-        #prev_state describes whether the threshold is currently above or below the threshold
-        prev_state = (lnp_list[0] > threshold) #Grab the first state
-        
-        prevSegment = None #Stores the last TimeSegment that was created
-        self.head = None #Points to the first TimeSegment
-        self.iter_segment = None #Used by the __iter__() and next() methods to support Python syntax iteration
-        self.lookup_table = {} #A dictionary to support fast lookup of timesegments.  Maps (start_id, end_id) to the relevant TimeSegment object
-        
-        #Iterate through the list of values
-        for i in range(len(lnp_list)):
-            #Determine whether the current value is below or above the threshold
-            aboveThreshold = lnp_list[i] > threshold
-            #If this is different from the previous state, the threshold has been "crossed" - a new TimeSegment will be generated
-            if(aboveThreshold != prev_state):
-
-                if(prevSegment==None):
-                    #This is the first TimeSegment
-                    start_id = 0
-                else:
-                    #This is not the first TimeSegment - it starts right after the previous one
-                    start_id = prevSegment.end_id + 1
-                
-                #Make a new TimeSegment which goes UP TO the point where the threshold was crossed
-                segment = TimeSegment(start_id, i-1, prev_state)
-                
-                #Link it to the previous TimeSegment
-                if(prevSegment != None):
-                    prevSegment.next = segment
-                segment.prev = prevSegment
-                
-                #Update the prev_state and prevSegment
-                prev_state = aboveThreshold
-                prevSegment = segment
-                
-                if(self.head == None):
-                    #If this is the first TimeSegment, it is the head
-                    self.head = segment
-                
-                #Add to the lookup_table for fast lookup
-                self.lookup_table[(start_id, i-1)] = segment
-        
-        #When we reach the end of the timeseries, we need to generate one last TimeSegment
-        #Same rules as before...
-        if(prevSegment==None):
-            #This is the first TimeSegment - happens only if the threshold is never crossed
-            start_id = 0
-        else:
-            #This is not the first TimeSegment - it starts right after the previous one
-            start_id = prevSegment.end_id + 1
+        #Whether each value is above the threshold, and the places where this changes
+        above = numpy.asarray(lnp_list) > threshold
+        crossings = numpy.flatnonzero(numpy.diff(above.astype(numpy.int8))) + 1
         
-        #Make a new TimeSegment and link it to the previous one
-        segment = TimeSegment(start_id, i, prev_state)
-        segment.prev = prevSegment
-        if(prevSegment != None):
-            prevSegment.next = segment
-        if(self.head == None):
-            self.head = segment
-        
-        #Add to the lookup table
-        self.lookup_table[(start_id, i)] = segment
-    
+        self.start_ids = numpy.concatenate([[0], crossings])
+        self.end_ids = numpy.concatenate([crossings - 1, [len(above) - 1]])
+        self.states = above[self.start_ids]
+        self.sorted_dates = None
     
-    #The following two methods are to support Python syntax iteration
+    def __len__(self):
+        return len(self.start_ids)
     
-    #Initialize the iterator - The TimeSegmentList itself serves as the iterator object
+    #Python syntax iteration - yields TimeSegment objects in chronological order
     def __iter__(self):
-        #Begin iteration at the head
-        self.iter_segment = self.head
-        return self
-    
-    #Scan forward through the linked list and return the next element
-    def next(self):
-        if(self.iter_segment==None):
-            raise StopIteration
-        else:
-            tmp = self.iter_segment
-            #Move the iterator forward            
-            self.iter_segment = self.iter_segment.next
-            #Return the next object
-            return tmp
+        for (start_id, end_id, state) in zip(self.start_ids.tolist(), self.end_ids.tolist(),
+                                             self.states.tolist()):
+            yield TimeSegment(start_id, end_id, state)
     
     #For debugging
     def __str__(self):
@@ -207,75 +95,106 @@ class TimeSegmentList:
                 output += str(segment) + " " + str(self.sorted_dates[segment.start_id]) + " " + str(self.sorted_dates[segment.end_id]) + '\n'
         return output
     
-    #Wrapper for TimeSegment.mergeWithNeighbors(), which also updates the lookup table (bookkeeping)
+    #The duration of each segment (start and end are inclusive)
+    def durations(self):
+        return self.end_ids - self.start_ids + 1
+    
+    #Changes the states of some segments, and then joins neighboring segments which have the same state
     #Arguments:
-        #segment - the segment to be merged
-    #Returns:
-        #The new, large segment that replaces it
-    def mergeSegment(self, segment):
-        #Remove self and neighbors from lookup table
-        del self.lookup_table[segment.start_id, segment.end_id]
-        if(segment.prev!=None):
-            del self.lookup_table[segment.prev.start_id, segment.prev.end_id]
-        if(segment.next!=None):
-            del self.lookup_table[segment.next.start_id, segment.next.end_id]
-        
-        #Actually perform the merge
-        new_seg = segment.mergeWithNeighbors()
-        
-        #Add the NEW segment into the lookup table
-        self.lookup_table[new_seg.start_id, new_seg.end_id] = new_seg
-        
-        #If the first or second elements are merged, the head needs to be updated
-        if(new_seg.prev==None):
-            self.head = new_seg
-        
-        #Return the new segment
-        return new_seg
+        #new_states - a boolean array with the new state of each segment
+    def relabel(self, new_states):
+        is_first = numpy.concatenate([[True], new_states[1:] != new_states[:-1]])
+        last_end = self.end_ids[-1]
+        self.start_ids = self.start_ids[is_first]
+        self.end_ids = numpy.concatenate([self.start_ids[1:] - 1, [last_end]])
+        self.states = new_states[is_first]
     
     #Removes all segments of a certain type, which are shorter than a threshold
     #For example, we might want to remove all non-events which are less than 6 hours
+    #A removed segment is merged with its neighbors (e.g. event, short space, event becomes
+    #one large event).  Segments of the other type never shrink, so this is the same as
+    #flipping the state of all of the short segments at once
     #Arguments:
         #threshold - The minimum size of timesegments in hours
         #state - are we removing events or non-events.  Specify:
             #True - remove things that are ABOVE the threshold (non-events)
             #False - remove things that are BELOW the threshold (events)
     def removeSmallSegmentsWithState(self, threshold, state):
-        current_segment = self.head
-        #We must iterate manually (e.g. not Python syntax iteration) to avoid concurrent modification
-        while(current_segment != None):
-            #Find segments which match the state and are shorter than the threshold
-            if(current_segment.state==state and current_segment.duration() < threshold):
-                current_segment = self.mergeSegment(current_segment)
-            else:
-                current_segment = current_segment.next
+        if(len(self) < 2):
+            return
+        new_states = self.states.copy()
+        new_states[(self.states == state) & (self.durations() < threshold)] = not state
+        self.relabel(new_states)
     
     #Similar to the previous method, but DOES NOT CARE about the type of event
-    #Since the order of removal matters, short events are performed first, using a Priority Queue
+    #Since the order of removal matters, the shortest segments are merged first, using a heap.
+    #A merged segment which is still too short goes back into the heap.  Merged segments are
+    #tracked with a union-find structure (each segment points to the one that absorbed it)
+    #and a linked list of the surviving segments, stored in arrays.
     #Arguments:
         #threshold - The minimum size of timesegments in hours
     def removeSmallSegmentsInOrder(self, threshold):
+        num_segments = len(self)
+        start_ids = self.start_ids.tolist()
+        end_ids = self.end_ids.tolist()
+        states = self.states.tolist()
+        prev_ids = range(-1, num_segments - 1)
+        next_ids = range(1, num_segments) + [-1]
+        parent = range(num_segments)
         
-        #Initialize the Priority Queue with the elements less than the threshold
-        pq = PriorityQueue()
-        for segment in self:
-            if(segment.duration() < threshold):
-                pq.put(segment)
+        def find(i):
+            root = i
+            while(parent[root] != root):
+                root = parent[root]
+            while(parent[i] != root):
+                (parent[i], i) = (root, parent[i])
+            return root
+        
+        #Heap entries are (duration, event segments first, start, segment id)
+        def heap_entry(i):
+            return (end_ids[i] - start_ids[i] + 1, not states[i], start_ids[i], i)
+        heap = [heap_entry(i) for i in xrange(num_segments)
+                if end_ids[i] - start_ids[i] + 1 < threshold]
+        heapq.heapify(heap)
         
-        #Repeatedly pull the smallest element out of the Priority Queue until it is empty
-        while(not pq.empty()):
-            segment = pq.get()
+        while(heap):
+            entry = heapq.heappop(heap)
+            i = entry[3]
+            #Skip segments which were absorbed or have changed since they were added
+            if(find(i) != i or heap_entry(i) != entry):
+                continue
+            (prev_id, next_id) = (prev_ids[i], next_ids[i])
+            if(prev_id == -1 and next_id == -1):
+                break
             
-            #Recall that mergeSegment() deletes items from the TimeSegmentList and the lookup_table
-            #But not necessarily from the Priority Queue.  Thus, we need to use the lookup_table to verify
-            #That the TimeSegment still exists before we do anything with it
-            if((segment.start_id, segment.end_id) in self.lookup_table):
-                #If the TimeSegment is valid, merge it with neighbors
-                new_seg = self.mergeSegment(segment)
-                
-                #If this merged TimeSegment is still too small, add it back to the Priority Queue
-                if(new_seg.duration() < threshold):
-                    pq.put(segment)
+            #Merge with the previous AND next segments, or only one of them at the ends
+            #The merged segment takes the id (and the state) of the first of them
+            first = i if prev_id == -1 else prev_id
+            last = i if next_id == -1 else next_id
+            keep = prev_id if prev_id != -1 else next_id
+            for j in set([first, i, last]) - set([keep]):
+                parent[j] = keep
+            start_ids[keep] = start_ids[first]
+            end_ids[keep] = end_ids[last]
+            prev_ids[keep] = prev_ids[first]
+            next_ids[keep] = next_ids[last]
+            if(prev_ids[keep] != -1):
+                next_ids[prev_ids[keep]] = keep
+            if(next_ids[keep] != -1):
+                prev_ids[next_ids[keep]] = keep
+            
+            if(end_ids[keep] - start_ids[keep] + 1 < threshold):
+                heapq.heappush(heap, heap_entry(keep))
+        
+        #Walk the linked list of surviving segments to rebuild the arrays
+        survivors = []
+        i = find(0)
+        while(i != -1):
+            survivors.append(i)
+            i = next_ids[i]
+        self.start_ids = numpy.array([start_ids[i] for i in survivors])
+        self.end_ids = numpy.array([end_ids[i] for i in survivors])
+        self.states = numpy.array([states[i] for i in survivors])
 
 
 
@@ -307,6 +226,9 @@ for orig in ['E','U','M','L']:
     #global_pace_timeseries - See likelihood_test_parallel.GlobalPace()
     #expected_pace_timeseries - See getExpectedPace()
     #zscore_Timeseries - See readZScoresTimeseries()
+    #sorted_mahal - a sorted array of the mahalanobis distances, used to compute the
+        #quantile of the max mahalanobis distance.  Built from mahal_timeseries if not given
+    #mahal_threshold - the threshold used to count the hours above threshold
 #Returns: A list [start_date, end_date, duration, max_pace_dev, min_pace_dev, worst_trip] describing properties of the event. Breakdonwn:
     #start_date - a datetime object
     #end_date - a datetime object
@@ -378,8 +300,8 @@ def computeEventProperties(start_key, end_key, mahal_timeseries, global_pace_tim
             max_votes_id = trip_id
             
     #Determine the corresponding quantile for the max mahalanobis value
-    if(sorted_mahal==None):
-        sorted_mahal = sorted([mahal_timeseries[k] for k in mahal_timeseries])
+    if(sorted_mahal is None):
+        sorted_mahal = numpy.sort(mahal_timeseries.values())
  
     mahal_quant = findQuantile(sorted_mahal, max_mahal)
     
@@ -459,7 +381,8 @@ def detectEventsSwitching(mahal_timeseries, zscore_timeseries, global_pace_times
 
     
     #Use the quantile to determine the threshold
-    sorted_mahal = sorted(mahal_list)
+    #The whole series is in memory, so it is sorted once (in numpy) and the quantile is exact
+    sorted_mahal = numpy.sort(mahal_list)
     threshold = getQuantile(sorted_mahal, threshold_quant)
     
     
@@ -6,39 +6,45 @@ Created on Tue Jul 22 20:10:23 2014
 """
 
 from mvGaussian import *
-from numpy import matrix, array_equal, diag, concatenate, cov
+from numpy import matrix, array, diag, concatenate, cov, full
+from scipy.linalg import solve_triangular
+
+#The number of query observations which are compared to all of the kernels at once in logliks_scaled()
+KDE_BLOCK_SIZE = 512
+
+#The log-density given to a kernel which is left out (same as the original per-kernel loop)
+LEFT_OUT_LOGLIK = -100000
 
 #A class that represents a probability distribution, given by a kernel density estimate
 #The kernel is Gaussian, and the bandwidth matrix is chosen by the "normal optimal smoothing" method
 #Given by Bowman and Azzalini.  See "Applied Smoothing Techniques for Data Analysis"
+#All kernels share the same bandwidth matrix, so it is only factorized once (see MVGaussian), and the
+#kernel centers are stored as one matrix.  Queries are evaluated in blocks with matrix products
 class MVGaussianKernel:
 	#Constructor which initializes the distribution from a set of observations
 	#Arguments:
 		#obs - a list of Numpy column vectors
 	def __init__(self, obs):
-		
-		#diag_list = [spherical_bandwidth**2] * len(obs)
-		#sig = matrix(diag(diag_list))
-		
+
 		#Compute the optimal bandwidth
 		sig = self.computeBandwidthMatrix(obs)
 
-		#Temporary distribution which will be copied
-		#This is faster than calling the MVGaussian.__init__() over and over
-		#because there is no need to invert the covariance matrix repeatedly
-		reference_distribution = MVGaussian(obs[0], sig)
-		
-		#Each observation gets one small gaussian distribution - the KDE is the average of all of these densities
-		self.distributions = []
-		for vect in obs:
-			if(allNonzero(vect)):
-				#As mentioned before, the distributions are copied instead of generated indepedently
-				#They all have the same covariance matrix, but different means
-				distribution = reference_distribution.copy()
-				distribution.mu = vect	#alter the mean
-				self.distributions.append(distribution)
-	
-	#Chooses a bandwidth (i.e. length-scale, smoothing parameter, etc...) which is appropriate for the given data	
+		#The bandwidth distribution (centered at 0).  Its factorizations, including those of
+		#subsets of dimensions for queries with missing values, are cached and reused by every kernel
+		self.bandwidth = MVGaussian(matrix(zeros((len(obs[0]), 1))), sig)
+
+		#Each complete observation gets one small gaussian distribution - the KDE is the average of all
+		#of these densities.  The centers are stored as rows of a matrix
+		self.centers = array([asarray(vect, dtype=float).ravel() for vect in obs if allNonzero(vect)])
+		self.centers = self.centers.reshape(-1, len(obs[0]))
+
+		#Maps the bytes of each center --> the ids of the kernels with that center.  Used for the
+		#leave one out estimate
+		self.center_ids = {}
+		for i in xrange(len(self.centers)):
+			self.center_ids.setdefault(self.centers[i].tostring(), []).append(i)
+
+	#Chooses a bandwidth (i.e. length-scale, smoothing parameter, etc...) which is appropriate for the given data
 	#The bandwidth matrix is chosen by the "normal optimal smoothing" method
 	#Given by Bowman and Azzalini.  See "Applied Smoothing Techniques for Data Analysis"
 	#Arguments:
@@ -50,33 +56,87 @@ class MVGaussianKernel:
 		data_matrix = concatenate(obs, axis=1)
 		cov_matrix =  matrix(cov(data_matrix))
 		diag_cov = diag(diag(cov_matrix))
-		
+
 		n = len(obs)		#Number of observations
 		p = len(obs[0])	#Dimension of observations
-		
+
 		#Given by the formula in the book.
 		#Note that the exponent becomes 2/(p+4) instead of(1/p+4) because we are computing variance.
 		#The book gives an equation for standard deviation - we have to square it
-		scaling_factor = (4.0/((p+2)*n)) ** ((2.0)/(p+4)) 
-		
+		scaling_factor = (4.0/((p+2)*n)) ** ((2.0)/(p+4))
+
 		#Scale the diagonal covariance matrix
-		return diag_cov * scaling_factor	
-		
-	
+		return diag_cov * scaling_factor
+
+
+	#Leave one out estimate of the log-density of one observation - kernels centered exactly at the
+	#observation are ignored.  See logliks_scaled()
+	#Arguments:
+		#obs - a Numpy column vector
+	#Returns:
+		#a log-probability density
 	def loglik_scaled(self, obs):
-		#Initialize the probabilities with really low numbers
-		log_ps = [-100000] * len(self.distributions)
-		count = 0
-		for i in range(len(self.distributions)):
-			#Leave one out estimate - ignore the observation itself when computing the density from its neighbors
-			if(not array_equal(obs, self.distributions[i].mu)):
-				#Compute the log-probability-density due to one of the distributions
-				log_ps[i] = self.distributions[i].gaussian_loglik(obs)
-				count += 1
-		
-		#Compute the mean of all of these probabilities (note that they are in log-space)
-		return addLogs(log_ps) - count
+		return self.logliks_scaled(obs)[0]
+
+	#Leave one out estimate of the log-density of every observation that the kernels were built from
+	#(i.e. every complete observation), in one call
+	#Returns:
+		#an array with one log-probability density per kernel
+	def leave_one_out_logliks(self):
+		return self.logliks_scaled(self.centers.T)
+
+	#Leave one out estimates of the log-density of many observations.  For each observation, kernels
+	#centered exactly at it are ignored, and the log-densities of the other kernels are combined in
+	#log-space.  Observations are grouped by missingness pattern, whitened with the factorization of
+	#the bandwidth matrix, and compared to all kernels in blocks of KDE_BLOCK_SIZE
+	#Arguments:
+		#obs_matrix - a PxM array (or list of Px1 column vectors) - each column is an observation.  0 is missing
+	#Returns:
+		#an array with M log-probability densities
+	def logliks_scaled(self, obs_matrix):
+		obs_matrix = as_column_array(obs_matrix)
+		(p, m) = obs_matrix.shape
+		n = len(self.centers)
+		if(n==0):
+			return full(m, float('-inf'))
+
+		#The log-density of each observation, combined over all of the kernels
+		lnl = zeros(m)
+		patterns, pattern_ids = numpy.unique((obs_matrix != 0).T, axis=0, return_inverse=True)
+		for pat in xrange(len(patterns)):
+			cols = flatnonzero(pattern_ids==pat)
+			if(not patterns[pat].any()):
+				#Every kernel gives a log-likelihood of 0 (see MVGaussian.logpdf())
+				lnl[cols] = log(n) - n
+				continue
+
+			(valid_ids, chol, log_determ) = self.bandwidth.factor_subset(patterns[pat])
+			log_norm = -.5*len(valid_ids) * log(2*pi) - .5*log_determ
+
+			#Whiten the kernel centers and the observations, so the Mahalanobis distance is a Euclidean distance
+			white_centers = solve_triangular(chol, self.centers[:,valid_ids].T, lower=True)
+			center_norms = (white_centers**2).sum(axis=0)
+
+			for start in xrange(0, len(cols), KDE_BLOCK_SIZE):
+				block = cols[start:start+KDE_BLOCK_SIZE]
+				white_obs = solve_triangular(chol, obs_matrix[numpy.ix_(valid_ids, block)], lower=True)
+				sq_dists = (white_obs**2).sum(axis=0)[:,None] + center_norms[None,:] - 2*white_obs.T.dot(white_centers)
+				log_ps = log_norm - .5*numpy.maximum(sq_dists, 0)
+
+				#Leave one out - kernels centered exactly at the observation are ignored.  Observations
+				#with missing values can not equal a kernel center, since the centers are complete
+				counts = full(len(block), n)
+				if(len(valid_ids)==p):
+					for row, col in enumerate(block):
+						left_out = self.center_ids.get(obs_matrix[:,col].tostring(), [])
+						log_ps[row, left_out] = LEFT_OUT_LOGLIK
+						counts[row] -= len(left_out)
+
+				#Stable log-sum-exp over the kernels (see tools.addLogs())
+				log_max = log_ps.max(axis=1)
+				lnl[block] = numpy.log(numpy.exp(log_ps - log_max[:,None]).sum(axis=1)) + log_max - counts
+		return lnl
 
 
 if (__name__=="__main__"):
-	pass		
\ No newline at end of file
+	pass
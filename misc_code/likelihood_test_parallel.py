@@ -8,10 +8,11 @@ Created on Wed May 21 17:37:25 2014
 """
 import numpy
 from numpy import matrix, transpose, diag
-import os, csv
+import os, csv, shutil, tempfile
 from collections import defaultdict
 from multiprocessing import Pool
 from gaussian_kernel import *
+from scipy.linalg import solve_triangular
 import traceback
 
 from mvGaussian import *
@@ -30,130 +31,69 @@ COMPUTE_KERNEL = True
 
 
 
-#Produces the probability timeseries for a slice of the data
-#Many slices can be run in parallel
+#Produces the probability timeseries for one group of time slices (e.g. all Mondays at 3pm)
+#Groups are independent, so many groups can be run in parallel.  The pace vectors are read from a
+#shared memory-mapped file (see writePaceMatrix()), so only the row ids are sent to each process
 #Arguments: Takes a tuple for ease of use with Pool.map().  Breakdown:
-	#pace_timeseries - a dictionary which maps (date, hour, weekday) -> mean pace vector for that time slice
-	#pace_grouped - a dictionary which maps (weekday, hour) -> list of mean pace vectors for that point in the periodic pattern
-	#groupedStats - a dictionary which maps (weekday, hour) -> the 0th, 1st, and 2nd moments of the data. see computeGroupedStats()
-	#start_id - the start of the slice to be computed by this thread
-	#end_id - the end of the slice to be computed by this thread
-def generateTimeSlice((pace_timeseries, pace_grouped, groupedStats, start_id, end_id)):
+	#pace_file - the file written by writePaceMatrix()
+	#shape - the shape of the pace matrix (number of time slices, number of trip types)
+	#row_ids - the rows of the pace matrix in this group
+#Returns: a tuple (row_ids, full_lnl, ind_lnl, kern_lnl, zscores).  Breakdown:
+	#row_ids - the same as the input
+	#full_lnl - an array with the leave-1-out log-likelihood of each row, using the full covariance matrix
+	#ind_lnl - the same, but only using the diagonal of the covariance matrix (independence assumption)
+	#kern_lnl - the leave-1-out log-likelihood of each row, given by the kernel density estimate.  1 if COMPUTE_KERNEL is False
+	#zscores - a matrix with the standardized pace vector of each row (one row per time slice)
+def processGroup((pace_file, shape, row_ids)):
 	try:
-		(s_x, s_xxt, count) = groupedStats
-			
-		
-		
-		if(COMPUTE_KERNEL):
-			kernels = {}
-			for key in pace_grouped:
-				kernels[key] = MVGaussianKernel(pace_grouped[key])
-		
-		#Dictionaries which will store the output for this slice
-		#These dictionaries are all keyed by (date, hour, weekday)
-		full_timeseries = {}
-		ind_timeseries = {}
-		kernel_timeseries = {}
-		zscore_timeseries = {}	
-		
-		#Iterate through the time-series in chronological order
-		sorted_dates = sorted(pace_timeseries)
-		#But only consider the slice assigned to this iprocess		
-		for i in range(start_id, end_id):
-			(date, hour, weekday) = sorted_dates[i] 
-	
-			#Progress message
-			logPerc(i - start_id, end_id - start_id, 1)
-			
-			
-			obs = pace_timeseries[(date, hour, weekday)] #The observed mean pace vector at a given point in time
-						
-			
-			#Use the grouped stats and the current vector (obs) to compute the leave-1-out mean and covariance
-			(mu, sig_full) = computeLeave1Stats(s_x, s_xxt, count, obs, weekday, hour)
-	
-			
-			
-			
-			#Extract diagonal components of the covariance matrix (independence assumption)
-			sig_diag = diag(diag(sig_full))
-			
-	
-			#Create the distributions for both covariance matrices
-			fullDistrib = MVGaussian(mu, sig_full)
-			indDistrib = MVGaussian(mu, sig_diag)
-	
-			
-			#Compute standardized pace vector (zscores) and save it
-			std_pace_vect = fullDistrib.standardize_vector(obs)
-			#print std_pace_vect
-			zscores = [float(std_pace_vect[i]) for i in range(len(std_pace_vect))]		
-			zscore_timeseries[date, hour, weekday] = zscores
-			
-	
-			#Use the two gaussian distributions to compute the log-probability
-			try:
-				full_timeseries[(date, hour, weekday)] = fullDistrib.gaussian_loglik_scaled(obs)
-				ind_timeseries[(date, hour, weekday)] = indDistrib.gaussian_loglik_scaled(obs)
-									
-			except (ZeroDivisionError):
-				full_timeseries[(date, hour,weekday)] = 1
-				ind_timeseries[(date, hour,weekday)] = 1
-			
-			#If desired, also compute the kernel density estimate
-			if(COMPUTE_KERNEL):
-				kernel = kernels[weekday, hour]
-				kernel_timeseries[date, hour, weekday] = kernel.loglik_scaled(obs)
-			else:
-				kernel_timeseries[date, hour, weekday] = 1
-	
-		#Return the dictionaries computed by this process.  The caller is responsible for merging, if multiprocessing is used
-	
+		pace_matrix = numpy.memmap(pace_file, dtype=numpy.float64, mode='r', shape=shape)
+		paces = numpy.array(pace_matrix[row_ids])
+		del pace_matrix
+
+		(full_lnl, ind_lnl, zscores) = computeLeave1Stats(paces)
+
+		#If desired, also compute the kernel density estimate from the vectors with no missing data
+		kern_lnl = numpy.ones(len(row_ids))
+		complete = paces[(paces != 0).all(axis=1)]
+		if(COMPUTE_KERNEL and len(complete) > 0):
+			kernel = MVGaussianKernel([v.reshape(len(v), 1) for v in complete])
+			kern_lnl = kernel.logliks_scaled(paces.T)
+
 	except Exception as e:
 		traceback.print_exc()
 	   	print()
 		raise e
-	return (full_timeseries, ind_timeseries, kernel_timeseries, zscore_timeseries)
+	return (row_ids, full_lnl, ind_lnl, kern_lnl, zscores)
 
 
-#Iterator function - generates the tuple arguments for generateTimeslice().  Useful for multiprocessing
+#Writes the pace vectors into a binary file, which can be opened by many processes as a numpy.memmap
 #Arguments:
 	#pace_timeseries - a dictionary which maps (date, hour, weekday) -> mean pace vector for that time slice
-	#pace_grouped - a dictionary which maps (weekday, hour) -> list of mean pace vectors for that point in the periodic pattern
-	#groupedStats - a dictionary which maps (weekday, hour) -> the 0th, 1st, and 2nd moments of the data. see computeGroupedStats()
-	#num_slices - how many pieces to cut pace_timeseries into?  Generally the number of available CPUs
-def makeSlices(pace_timeseries, pace_grouped, groupedStats, num_slices):
-	data_size = len(pace_timeseries)
-	for i in range(num_slices):
-		lo = int(data_size * float(i)/num_slices) #start of this slice (inclusive)
-		hi = int(data_size * float(i+1)/num_slices) #end of this slice (non-inclusive)
-		#note that the same pace_timeseries, pace_grouepd, and groupedStats are put into every slice
-		yield (pace_timeseries, pace_grouped, groupedStats, lo, hi)
-
-#Reduces the outputs of generateTimeSlice() if many slices are run in parallel
-#Recall that generateTimeSlice() returns a tuple of dictionaries (full_timeseries, ind_timeseries, kernel_timeseries, zscore_timeseries)
-#This function will merge the dictionaries across tuples.  Note that a key should appear in only one of these dictionaries, so the merging is trivial
+	#keys - the order of the time slices.  Row i of the file is pace_timeseries[keys[i]]
+	#pace_file - the name of the file to write
+#Returns:
+	#the shape of the pace matrix - (number of time slices, number of trip types)
+def writePaceMatrix(pace_timeseries, keys, pace_file):
+	shape = (len(keys), len(pace_timeseries[keys[0]]))
+	pace_matrix = numpy.memmap(pace_file, dtype=numpy.float64, mode='w+', shape=shape)
+	for i in range(len(keys)):
+		pace_matrix[i] = numpy.asarray(pace_timeseries[keys[i]]).ravel()
+	pace_matrix.flush()
+	del pace_matrix
+	return shape
+
+
+#Groups the time slices by their point in the periodic pattern
 #Arguments:
-	#outputList - a list of these tuples (one for each processor)
+	#keys - a list of (date, hour, weekday) tuples
 #Returns:
-	#A SINGLE tuple of the same form
-def mergeOutputs(outputList):
-	#Start dictionaries empty
-	merged_full_timeseries = {}
-	merged_ind_timeseries = {}
-	merged_kernel_timeseries = {}
-	merged_zscore_timeseries = {}
-	
-	#Iterate through all tuples in the list
-	for (full_timeseries, ind_timeseries, kernel_timeseries, zscore_timeseries) in outputList:
-		#Update each dictionary in the tuple
-		merged_full_timeseries.update(full_timeseries)
-		merged_ind_timeseries.update(ind_timeseries)
-		merged_kernel_timeseries.update(ind_timeseries)
-		merged_zscore_timeseries.update(zscore_timeseries)
-	
-	#Return the merged dictionaries
-	return (merged_full_timeseries, merged_ind_timeseries, merged_kernel_timeseries, merged_zscore_timeseries)
+	#a dictionary which maps (weekday, hour) --> an array of the ids of the corresponding keys
+def groupRows(keys):
+	groups = defaultdict(list)
+	for i in range(len(keys)):
+		(date, hour, weekday) = keys[i]
+		groups[weekday, hour].append(i)
+	return dict((key, numpy.array(groups[key])) for key in groups)
 
 
 
@@ -239,73 +179,64 @@ def readGlobalPace(dirName):
 
 
 
-#Computes statistics for each group of mean pace vectors (the grouping is determined by the time of week)
-#These statistics are the 0th (count), 1st (sum), and 2nd (sum of self-outer products) moments of the data in each of these groups
-#These moments are useful because they make it easy to compute the mean or covariance matrix - THIS IS NOT DONE HERE.  IT IS DONE IN computeLeave1Stats()
+#Computes the leave-1-out log-likelihoods and zscores of every mean pace vector in a group (e.g. all Mondays at 3pm)
+#Each vector is compared to the mean and covariance of the OTHER vectors in the group.  Vectors with missing data
+#(zeros) are not part of the group statistics, so they are compared to the statistics of the whole group
+#Instead of recomputing the statistics for each vector, the group's scatter matrix is factorized once, and leaving
+#out a vector x is treated as a rank-one downdate:  S' = S - n/(n-1) * d * d^T, where d = x - mean
+#By the Sherman-Morrison formula, the Mahalanobis distance under S' only depends on q = d^T * inv(S) * d
 #Arguments:
-	#pace_grouped - a dictionary which maps (weekday, hour) --> A list of mean pace vectors that occur at that time (e.g. all mondays at 3pm)
+	#paces - an (m x p) array with one mean pace vector per row
 #Returns:
-	#a tuple (s_x, s_xxt, count). Breakdown:
-		#s_x - a dictionary which maps (weekday, hour) --> The sum of mean pace vectors at that time (a vector)
-		#s_xxt - a dictionary which maps (weekday, hour) --> The sum of outer products at that time  (a matrix)
-		#count - a dictionary which maps (weekday, hour) --> The count of vectors at that time (a number)
-def computeGroupedStats(pace_grouped):
-	count = {}	#count of all vectors (0th moneht)
-	s_x = {} 	#sum of all vectors (1st moment)
-	s_xxt = {}	#sum of all outer products: x * transpose(x) (2nd moment)
-	
-	x = pace_grouped[arbitraryElement(pace_grouped)][0]
-
-	
-	#Iterate through all groups.  Note that key = (weekday, hour)
-	for key in pace_grouped:
-		#Initialize sums to zero
-		s_x[key] = matrix(zeros((len(x),1)))
-		s_xxt[key] = matrix(zeros((len(x),len(x))))
-		
-		#Get the group of mean pace vectors and store the count
-		group = pace_grouped[key]
-		count[key] = len(group)
-		
-		#Iterate through mean pace vectors, updating the appropriate counts
-		for meanPaceVector in group:
-			s_x[key] += meanPaceVector
-			s_xxt[key] += meanPaceVector * transpose(meanPaceVector)
-
-	#Return the thre statistics
-	return (s_x, s_xxt, count)
-
+	#a tuple (full_lnl, ind_lnl, zscores).  Breakdown:
+		#full_lnl - an array with the scaled log-likelihood of each vector, using the full covariance matrix (see MVGaussian.gaussian_loglik_scaled())
+		#ind_lnl - the same, but only using the diagonal of the covariance matrix (independence assumption)
+		#zscores - an (m x p) array with the standardized pace vector of each row (see MVGaussian.standardize_vector())
+def computeLeave1Stats(paces):
+	(m, p) = paces.shape
+	valid = (paces != 0)
+	left_out = valid.all(axis=1)	#only vectors with no missing data are part of the group statistics
+	n = float(left_out.sum())
+
+	#With fewer than 3 complete vectors, the leave-1-out covariance has less than 2 vectors behind it and is
+	#undefined - give the whole group the same sentinel values as a failed likelihood (and no zscores)
+	if(n < 3):
+		logMsg("Only %d complete vectors - skipping group" % n)
+		return (numpy.ones(m), numpy.ones(m), numpy.zeros((m, p)))
+
+	#Mean and scatter matrix (sum of outer products of deviations) of the whole group
+	mean = paces[left_out].mean(axis=0)
+	deviations = paces - mean
+	scatter = deviations[left_out].T.dot(deviations[left_out])
+
+	#Leaving out x moves the mean away from it:  x - mean' = n/(n-1) * (x - mean)
+	b = n / (n-1)
+	new_count = n - left_out
+	diffs = numpy.where(left_out, b, 1)[:,None] * deviations
+
+	#Diagonal of the leave-1-out covariance matrix
+	variances = (scatter.diagonal()[None,:] - numpy.where(left_out, b, 0)[:,None] * deviations**2) / (new_count - 1)[:,None]
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		zscores = numpy.where(valid, diffs / numpy.sqrt(variances), 0)
+	ind_lnl = -.5 * (zscores**2).sum(axis=1)
+
+	full_lnl = numpy.ones(m)
+	try:
+		#Vectors in the group - q = d^T * inv(S) * d, then Sherman-Morrison for the downdated scatter matrix
+		chol = numpy.linalg.cholesky(scatter)
+		w = solve_triangular(chol, deviations[left_out].T, lower=True)
+		q = (w**2).sum(axis=0)
+		with numpy.errstate(divide='ignore'):
+			full_lnl[left_out] = numpy.where(b*q < 1, -.5 * (n-2) * b**2 * q / (1 - b*q), 1)
 
+		#Vectors with missing data - the distribution of the whole group, restricted to the valid dimensions
+		if((~left_out).any()):
+			fullDistrib = MVGaussian(mean.reshape(p, 1), scatter / (n-1))
+			full_lnl[~left_out] = fullDistrib.logpdf(paces[~left_out].T, scaled=True)
+	except (numpy.linalg.LinAlgError, InvalidCovarianceException):
+		logMsg("Covariance matrix is not positive definite - skipping group")
 
-#Compute the mean and variance of mean pace vectors that occur at the same point in time periodic pattern
-#EXCEPT FOR one particular value, X.  Note that this can be done in constant time if computeGroupedStats() is already run
-#Arguments:
-	#s_x - output of computeGroupedStats()
-	#s_xxt - output of computeGroupedStats()
-	#count - output of computeGroupedStats()
-	#x - a particular mean pace vector
-	#weekday - the weekday on which X was observed
-	#hour - the hour on which X was observed
-def computeLeave1Stats(s_x, s_xxt, count, x, weekday, hour):
-	if(allNonzero(x)):
-		#update the grouped statistics to not include X (subtract it from the sums)
-		new_s_x = s_x[weekday, hour] - x
-		new_s_xxt = s_xxt[weekday, hour] - x * transpose(x)
-		new_count = count[weekday, hour] - 1
-	else:
-		#If x has a zero, then it was not included in the sums - leave them as is
-		new_s_x = s_x[weekday, hour]
-		new_s_xxt = s_xxt[weekday, hour]
-		new_count = count[weekday, hour]
-	
-	#compute the mean from these new sums
-	mu = new_s_x / new_count
-	
-	#var(x) = E[x**2] - E[x]**2.  Multiply by n/(n-1) for unbiased covariance correction
-	sigma = (new_s_xxt / new_count - mu * transpose(mu)) * (new_count / (new_count - 1))
-	
-	#Return the mean and covariance matrix
-	return (mu, sigma)
+	return (full_lnl, ind_lnl, zscores)
 
 
 #Temporary
@@ -337,35 +268,45 @@ def scale_kern_timeseries(kern_timeseries):
 # days (same hour and day of week) but not today.
 #Params:
 	#inDir - the directory which contains the time-series feature files (CSV format)
+	#pool - a multiprocessing Pool.  Each group (weekday, hour) is processed by one call of processGroup()
 	#returns - no return value, but saves files into results/...
-def generateTimeSeriesLeave1(inDir):
+def generateTimeSeriesLeave1(inDir, pool=DefaultPool()):
 	numpy.set_printoptions(linewidth=1000, precision=4)
 	
 	#Read the time-series data from the file
 	logMsg("Reading files...")
 	(pace_timeseries, pace_grouped) = readPaceData(inDir)
 	
+	#Write the pace vectors to a shared file, in chronological order
+	keys = sorted(pace_timeseries)
+	tmp_dir = tempfile.mkdtemp()
+	pace_file = os.path.join(tmp_dir, "pace_features.bin")
+	shape = writePaceMatrix(pace_timeseries, keys, pace_file)
+	groups = groupRows(keys)
 	
-	
-	
-		
-
-	logMsg("Computing grouped stats")
-	groupedStats = computeGroupedStats(pace_grouped)
-	
-		
 	logMsg("Starting Processes")
-	#Use a pool to compute the probabilities in parallel
-	pool = Pool(NUM_PROCESSORS)
-	sliceIterator = makeSlices(pace_timeseries, pace_grouped, groupedStats, NUM_PROCESSORS) #Iterator breaks the data into slices
-	
-
-	outputList = map(generateTimeSlice, sliceIterator) #Run all of the slices in parallel
-	#outputList is a list of tuples of incomplete dictionaries - they need to be merged in order to have complete dictionaries
+	#Each process only receives the row ids of one group - the pace vectors are read from the shared file
+	try:
+		outputList = pool.map(processGroup, [(pace_file, shape, groups[key]) for key in sorted(groups)])
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
 	
 	logMsg("Merging outputs")
-	#Merge the results from the multiple processes
-	(full_timeseries, ind_timeseries, kern_timeseries, zscore_timeseries) = mergeOutputs(outputList)
+	#Every row belongs to exactly one group, so the outputs are simply scattered into arrays
+	full_lnl = numpy.zeros(len(keys))
+	ind_lnl = numpy.zeros(len(keys))
+	kern_lnl = numpy.zeros(len(keys))
+	zscores = numpy.zeros(shape)
+	for (row_ids, full, ind, kern, z) in outputList:
+		full_lnl[row_ids] = full
+		ind_lnl[row_ids] = ind
+		kern_lnl[row_ids] = kern
+		zscores[row_ids] = z
+	
+	full_timeseries = dict(zip(keys, full_lnl.tolist()))
+	ind_timeseries = dict(zip(keys, ind_lnl.tolist()))
+	kern_timeseries = dict(zip(keys, kern_lnl.tolist()))
+	zscore_timeseries = dict(zip(keys, zscores.tolist()))
 	
 
 	#temporary...
@@ -408,4 +349,5 @@ def generateTimeSeriesLeave1(inDir):
 
 
 if(__name__=="__main__"):
-	generateTimeSeriesLeave1("4year_features")
\ No newline at end of file
+	pool = Pool(NUM_PROCESSORS)
+	generateTimeSeriesLeave1(IN_DIR, pool)
\ No newline at end of file
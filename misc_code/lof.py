@@ -4,75 +4,130 @@ Created on Wed Sep 24 12:34:53 2014
 
 @author: brian
 """
+import numpy
+from scipy import sparse
+from scipy.spatial import cKDTree
+
 from tools import *
-from Queue import PriorityQueue
+from data_preprocessing import as_data_matrix
 
 
+#Above this many dimensions, a KD-tree is no faster than comparing all pairs
+KD_TREE_MAX_DIMS = 16
 
-def getPairwiseDist(vects):
-	dist =[[0]*len(vects) for x in range(len(vects))]
-	for i in range(len(vects)):
-		for j in range(len(vects)):
-			dist[i][j] = euclideanDist(vects[i], vects[j])
-			dist[j][i] = dist[i][j]
-	return dist
+#The number of points whose distances are computed at once in blockedNeighbors()
+BLOCK_SIZE = 1024
+
+
+#Converts a group of vectors into a 2-D array with one ROW per point
+#Arguments:
+	#vects - a list of column vectors, or a data matrix whose columns are observations (see data_preprocessing.as_data_matrix())
+def getPointMatrix(vects):
+	data_matrix = as_data_matrix(vects)
+	if(sparse.issparse(data_matrix)):
+		data_matrix = data_matrix.toarray()
+	return numpy.asarray(data_matrix, dtype=float).T
+
+
+#Finds the k nearest neighbors of each point by brute force, one block of points at a time
+#The squared distances are computed with a matrix product, so only a (BLOCK_SIZE x n) array is in memory at once
+#Arguments:
+	#points - a 2-D array with one row per point
+	#k - the number of neighbors (not counting the point itself)
+#Returns:
+	#(neighbor_dists, neighbor_ids) - two (n x k) arrays, sorted by increasing distance
+def blockedNeighbors(points, k):
+	n = len(points)
+	sq_norms = (points**2).sum(axis=1)
+	neighbor_ids = numpy.zeros((n, k), dtype=int)
+	neighbor_dists = numpy.zeros((n, k))
+	for start in xrange(0, n, BLOCK_SIZE):
+		block = points[start:start+BLOCK_SIZE]
+		sq_dists = sq_norms[start:start+BLOCK_SIZE, None] + sq_norms[None,:] - 2*block.dot(points.T)
+		numpy.maximum(sq_dists, 0, out=sq_dists)
+
+		#A point is not its own neighbor
+		rows = numpy.arange(len(block))
+		sq_dists[rows, rows + start] = numpy.inf
+
+		#Select the k smallest in each row, then sort them
+		ids = numpy.argpartition(sq_dists, k-1, axis=1)[:,:k]
+		dists = sq_dists[rows[:,None], ids]
+		order = numpy.argsort(dists, axis=1)
+		neighbor_ids[start:start+BLOCK_SIZE] = ids[rows[:,None], order]
+		neighbor_dists[start:start+BLOCK_SIZE] = numpy.sqrt(dists[rows[:,None], order])
+	return neighbor_dists, neighbor_ids
+
+
+#Finds the k nearest neighbors of each point.  A KD-tree is used for low-dimensional data,
+#and blockedNeighbors() otherwise
+#Arguments:
+	#points - a 2-D array with one row per point
+	#k - the number of neighbors (not counting the point itself)
+#Returns:
+	#(neighbor_dists, neighbor_ids) - two (n x k) arrays, sorted by increasing distance
+def getNearestNeighbors(points, k):
+	if(points.shape[1] > KD_TREE_MAX_DIMS):
+		return blockedNeighbors(points, k)
+
+	#Ask for one extra neighbor, since each point finds itself.  With duplicate points, the
+	#point itself is not necessarily first, so it is removed by id
+	(dists, ids) = cKDTree(points).query(points, k=k+1)
+	dists = dists.reshape(len(points), k+1)
+	ids = ids.reshape(len(points), k+1)
+	not_self = ids != numpy.arange(len(points))[:,None]
+	#Drop the last column in rows where the point itself was not found
+	not_self[not_self.all(axis=1), k] = False
+	return dists[not_self].reshape(-1, k), ids[not_self].reshape(-1, k)
+
+
+#Computes the local outlier factor of each point from its nearest neighbors
+#Arguments:
+	#neighbor_dists, neighbor_ids - the k nearest neighbors of each point, see getNearestNeighbors()
+#Returns:
+	#An array with the local outlier factor of each point.  Values near 1 are inliers
+def lofFromNeighbors(neighbor_dists, neighbor_ids):
+	k = neighbor_dists.shape[1]
 
-def getLocalOutlierFactors(vects, k):
-	
-	#TMP HACK
-	return [0]*len(vects)
-	pairDist = getPairwiseDist(vects)
-	
-
-	#The list of neighbor ids for each point
-	neighbors = [None for x in range(len(vects))]
-	#Populate each of these lists with the k nearest neighbors
-	for i in range(len(vects)):
-		pq = PriorityQueue()
-		for j in range(len(vects)):
-			if(i != j):
-				pq.put((-pairDist[i][j], j))
-				if(pq.qsize() > k):
-					pq.get()
-		neighbors[i] = [neighborId for (negDist, neighborId) in pq.queue]
-		
-	#print("neighbors " + str(neighbors))
-	
 	#For each point, the distance to its kth nearest neighbor
-	kDist = [0] * len(vects)
-	for i in range(len(vects)):
-		for j in neighbors[i]:
-			kDist[i] = max(kDist[i], pairDist[i][j])
-	
-	#print("kdist " + str(kDist))
-			
-			
-	
+	k_dist = neighbor_dists[:,k-1]
+
 	#local reachability density - the inverse of the average reachability distance to all of my neighbors
-	lrd = [0] * len(vects)
-	
-	for i in range(len(vects)):
-		#first compute the sum
-		for j in neighbors[i]:
-			lrd[i] += max(kDist[j], pairDist[i][j])
-		#normalize and invert in one step
-		lrd[i] = k / lrd[i]
-	
-	#print("lrd " + str(lrd))
-	
-	#local outlier factor - average ratio  of neighbor densities to my density
-	lof = [0] * len(vects)
-	for i in range(len(vects)):
-		#first compute the sum
-		for j in neighbors[i]:
-			lof[i] += lrd[j]
-		#normalize and divide by my density
-		lof[i] = lof[i] / (k*lrd[i])
-	
-	#print("lof " + str(lof))
-	
-	return lof
-	
-	
-	
-	
\ No newline at end of file
+	#Duplicate points would give a density of infinity, so a small constant is added to the average
+	reach_dist = numpy.maximum(k_dist[neighbor_ids], neighbor_dists)
+	lrd = 1.0 / (reach_dist.mean(axis=1) + 1e-10)
+
+	#local outlier factor - average ratio of neighbor densities to my density
+	return lrd[neighbor_ids].mean(axis=1) / lrd
+
+
+#Computes the local outlier factor of each vector, relative to the other vectors in the group
+#Arguments:
+	#vects - a list of column vectors, or a data matrix whose columns are observations
+	#k - the number of neighbors.  Limited to the number of vectors minus one
+#Returns:
+	#An array with one local outlier factor per vector
+def getLocalOutlierFactors(vects, k):
+	return getLocalOutlierFactorsForKs(vects, [k])[k]
+
+
+#Computes local outlier factors for several values of k.  The neighbors are only
+#searched once, for the largest k, since the smaller neighborhoods are prefixes of it
+#Arguments:
+	#vects - a list of column vectors, or a data matrix whose columns are observations
+	#ks - a list of neighborhood sizes
+#Returns:
+	#A dictionary which maps each k to an array of local outlier factors
+def getLocalOutlierFactorsForKs(vects, ks):
+	points = getPointMatrix(vects)
+	n = len(points)
+	if(n < 2):
+		return dict((k, numpy.ones(n)) for k in ks)
+
+	max_k = min(max(ks), n-1)
+	(neighbor_dists, neighbor_ids) = getNearestNeighbors(points, max_k)
+	lofs = {}
+	for k in ks:
+		k_used = min(k, n-1)
+		lofs[k] = lofFromNeighbors(neighbor_dists[:,:k_used], neighbor_ids[:,:k_used])
+	return lofs
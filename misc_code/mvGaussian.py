@@ -3,15 +3,23 @@
 A class which represents the multivariate Gaussian distribution.
 Implements likelihood functions and log-likelihood functions.
 
+The covariance matrix is factorized once (Cholesky), and the factor is used to
+validate the matrix, compute the log-determinant and solve linear systems.
+Observations with missing values (0 is assumed to be missing) use the factor
+of the corresponding submatrix, which is computed once per missingness pattern
+and cached.
+
 Created on Wed May 21 17:38:31 2014
 
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
 
 
-from numpy import  transpose, zeros, trace
-from numpy.linalg import inv, det, eig
-from math import log, pi, sqrt, exp
+import numpy
+from numpy import zeros, asarray, column_stack, flatnonzero, log as np_log
+from numpy.linalg import cholesky, LinAlgError
+from scipy.linalg import solve_triangular, cho_solve
+from math import log, pi, exp
 
 from tools import *
 
@@ -26,7 +34,17 @@ class InvalidCovarianceException(Exception):
 		#vals, vects = eig(self.sigma)
 		#return str(self.sigma) + "\n" + self.reason + "\n Eigenvals : " + str(self.vals)
 		return str(self.sigma) + "\n" + self.reason
-		
+
+
+#Converts an observation (Nx1 matrix, or list of column vectors) into a 2-D array with one COLUMN per observation
+def as_column_array(obs):
+	if(isinstance(obs, list)):
+		return column_stack([asarray(v, dtype=float).ravel() for v in obs])
+	obs = asarray(obs, dtype=float)
+	if(obs.ndim == 1):
+		return obs.reshape(-1, 1)
+	return obs
+
 
 #Represents a multivariate Gaussian distribution.  Likelihood can be evaluated in several ways
 class MVGaussian():
@@ -35,127 +53,109 @@ class MVGaussian():
 		#mu - the mean vector.  Must be an Nx1 Numpy matrix (column vector)
 		#sigma - the covariance matrix.  Must be an NxN Numpy matrix
 	def __init__(self, mu=None, sig=None):
-		
-		if(mu==None and sig==None):
+
+		if(mu is None and sig is None):
 			return
 		self.mu = mu
 		self.sig = sig
+
+		#The Cholesky factorization only exists if sig is positive definite
 		try:
-			self.inv_sig = inv(sig)
-		except:
-			self.inv_sig = None
-			#print("Non-invertible matrix")
-			raise InvalidCovarianceException(sig, "Non-invertible matrix")
-		self.determ = det(sig)
-		if(self.determ < 0):
-			#print ("Negative determinant")
-			raise InvalidCovarianceException(sig, "Negative determinant")
-		
-		vals, vects = eig(self.sig)
-		for v in vals:
-			if(v < 0):
-				#print ("Not positive definite")
-				raise InvalidCovarianceException(sig, "Negative eigenvalue")
-				
+			self.chol = cholesky(asarray(sig, dtype=float))
+		except LinAlgError:
+			raise InvalidCovarianceException(sig, "Not positive definite")
+		self.log_determ = 2*np_log(self.chol.diagonal()).sum()
+
+		#Maps missingness pattern --> factorization of the corresponding submatrix.  See factor_subset()
+		self.subset_cache = {}
+
 	#Generates a copy of this distribution.  Faster than calling the custructor again
-	#because it doesn't need to invert the covariance matrix, compute the determinate,
-	#or check the validity of the covariance matrix via eigen-decomposition
+	#because it doesn't need to factorize the covariance matrix.  The copy shares the
+	#cache of factorized subsets, so the mean can be changed but the covariance can not
 	def copy(self):
 		other = MVGaussian()
 		other.mu = self.mu
 		other.sig = self.sig
-		other.inv_sig = self.inv_sig
-		other.determ = self.determ
+		other.chol = self.chol
+		other.log_determ = self.log_determ
+		other.subset_cache = self.subset_cache
 		return other
 
-	
+
 	#If an observation has missing values, we need to take a subset of the dimensions
 	#AKA the mean vector now has less than K dimensions where K <= N, and the cov matrix is K x K
-	#This method performs the dimension selection
+	#This method gives the factorization of that KxK matrix.  Each missingness pattern is only
+	#factorized once - the results are cached
 	#Arguments:
-		#mu - the original N-dimensional mean vector
-		#sig - the original NxN covariance matrix
-		#obs - the observation which may have some missing values (0 is assumed to be missing)
-		#returns a tuple containing the selection on these three inputs, as well as the inverse and determinant of the new matrix
+		#valid - a boolean array of length N, True for the dimensions that are present
 	#Returns:
-		#A tuple (mu_subset, sig_subset, inv_sig_subset, determ_subset, obs_subset).  Breakdown:
-			#mu_subset - a Kx1 vector
-			#sig_subset -a KxK matrix
-			#inv_sig_subset - a KxK matrix, the inverse of sig_subset
-			#determ_subset - a number. The determinant of sig_subset
-			#obs_subset - a Kx1 vector
-	def dimension_subset(self, mu, sig, obs, sig2=None):
-		valid_ids = []
-		#Loop through the dimensions of the observation - record the indexes with nonzero values
-		for i in range(len(obs)):
-			if(not obs[i]==0):
-				valid_ids.append(i)
-		
-		#Time saver - return the original values if all of the dimensions are valid
-		if(len(valid_ids)==len(sig)):
-			if(sig2==None):
-				return (mu, sig, self.inv_sig, self.determ, obs)
+		#A tuple (valid_ids, chol_subset, log_determ_subset).  Breakdown:
+			#valid_ids - an integer array with the K valid dimensions
+			#chol_subset - a KxK lower-triangular matrix, the Cholesky factor of the subset of sig
+			#log_determ_subset - a number.  The log-determinant of the subset of sig
+	def factor_subset(self, valid):
+		key = valid.tostring()
+		if(key not in self.subset_cache):
+			valid_ids = flatnonzero(valid)
+			if(len(valid_ids)==0):
+				#If no dimensions are valid, we cannot compute anything - throw an exception
+				raise InvalidVectorException()
+			elif(len(valid_ids)==len(valid)):
+				#Time saver - use the full factorization if all of the dimensions are valid
+				self.subset_cache[key] = (valid_ids, self.chol, self.log_determ)
 			else:
-				return (mu, sig, self.inv_sig, self.determ, obs, sig2)
-		elif(len(valid_ids)==0):
-			#If no dimensions are valid, we cannot compute anything - throw an exception
-			raise InvalidVectorException()
-		
-		#Perform the selection using Numpy slicing
-		mu_subset = mu[valid_ids]
-		sig_subset = sig[valid_ids,:][:,valid_ids]
-		obs_subset = obs[valid_ids]
-		
-		#Compute the inverse and determinant of the matrix
-		inv_sig_subset = inv(sig_subset)
-		determ_subset = det(sig_subset)
-		
-		if(not sig2==None):
-			sig2_subset = sig2[valid_ids,:][:,valid_ids]
-			
-			return (mu_subset, sig_subset, inv_sig_subset, determ_subset, obs_subset, sig2_subset)
-			
-		
-		
-		return (mu_subset, sig_subset, inv_sig_subset, determ_subset, obs_subset)		
-	
-	
-	
+				chol_subset = cholesky(asarray(self.sig, dtype=float)[numpy.ix_(valid_ids, valid_ids)])
+				self.subset_cache[key] = (valid_ids, chol_subset, 2*np_log(chol_subset.diagonal()).sum())
+		return self.subset_cache[key]
+
+
+	#The log-likelihood of many observations, given this MVGaussian distribution
+	#Observations are grouped by their missingness pattern, and each group is solved at once
+	#Observations where all values are missing get a log-likelihood of 0
+	#Params:
+		#obs_matrix - an NxM array (or list of Nx1 column vectors) - each column is an observation
+		#scaled - if True, the log-likelihood of the mean is subtracted (see gaussian_loglik_scaled())
+	#Returns:
+		#an array with M log-probability densities
+	def logpdf(self, obs_matrix, scaled=False):
+		obs_matrix = as_column_array(obs_matrix)
+		mu = asarray(self.mu, dtype=float).reshape(-1, 1)
+		valid = (obs_matrix != 0)
+		lnl = zeros(obs_matrix.shape[1])
+
+		#Find the distinct missingness patterns
+		patterns, pattern_ids = numpy.unique(valid.T, axis=0, return_inverse=True)
+		for p in xrange(len(patterns)):
+			if(not patterns[p].any()):
+				continue
+			cols = flatnonzero(pattern_ids==p)
+			(valid_ids, chol, log_determ) = self.factor_subset(patterns[p])
+
+			#The Mahalanobis distance is the squared norm of L^-1 (obs - mu)
+			diff = obs_matrix[numpy.ix_(valid_ids, cols)] - mu[valid_ids]
+			mahal = (solve_triangular(chol, diff, lower=True)**2).sum(axis=0)
+			lnl[cols] = -.5 * mahal
+			if(not scaled):
+				lnl[cols] += -.5*len(valid_ids) * log(2*pi) - .5*log_determ
+		return lnl
+
+
 	#The likelihood of obs, given this MVGaussian distribution
 	#Params:
 		#obs - the observed vector.  Must be an Nx1 Numpy matrix (column vector)
 		#returns - a probability density
 	def gaussian_likelihood(self, obs):
-		
-		try:
-			(mu, sig, inv_sig, determ, obs) = self.dimension_subset(self.mu, self.sig, obs)
-		except InvalidVectorException:
+		if(not as_column_array(obs).any()):
 			return 0
-		
-		denom = sqrt((2*pi)**len(mu) * determ)
-		pwr = -.5 * transpose(obs - mu) * inv_sig * (obs - mu)
-		return (exp(pwr) / denom)[0,0]
-	
+		return exp(self.logpdf(obs)[0])
+
 	#The log-likelihood of obs, given this MVGaussian distribution
 	#(Equivalent to taking the log of gaussian_likelihood, but more efficient)
 	#Params:
 		#obs - the observed vector.  Must be an Nx1 Numpy matrix (column vector)
 		#returns - a log-probability density
 	def gaussian_loglik(self, obs):
-		
-		if(self.inv_sig==None):
-			return float('-inf')
-		
-		try:
-			(mu, sig, inv_sig, determ, obs) = self.dimension_subset(self.mu, self.sig, obs)
-		except InvalidVectorException:
-			return 0		
-		
-		#print determ
-		
-		logdenom = -.5*len(mu) * log(2*pi) - .5*log(determ)
-		pwr = -.5 * transpose(obs - mu) * inv_sig * (obs - mu)
-		return (logdenom + pwr)[0,0]
+		return self.logpdf(obs)[0]
 
 	#The log-likelihood of obs, given this MVGaussian distribution
 	#minus the MAXIMUM log-likelihood of this distribution (gaussian_loglik)
@@ -165,48 +165,37 @@ class MVGaussian():
 		#obs - the observed vector.  Must be an Nx1 Nuumpy matrix (column vector)
 		#returns - a scaled log-probability density
 	def gaussian_loglik_scaled(self, obs):
+		return self.logpdf(obs, scaled=True)[0]
 
-		if(self.inv_sig==None):
-			return float('-inf')
-			
-		try:
-			(mu, sig, inv_sig, determ, obs) = self.dimension_subset(self.mu, self.sig, obs)
-		except InvalidVectorException:
-			return 0		
-
-		lnl = -.5 * transpose(obs - mu) * inv_sig * (obs - mu)
-		return (lnl)[0,0]
-	
 	#The expected scaled log-likelihood of this distribution, according to some other distribution
 	#Params:
 		#otherMu - the mean of the other multivariate gaussian distribution
 		#otherSig - the covariance matrix of the other multivariate gaussian distribution
 	#Returns: - an expected scaled log-probability density
 	def expected_loglik_scaled(self, otherMu, otherSig):
-		if(self.inv_sig==None):
-			return float('-inf')
-		
-		
+		otherMu = asarray(otherMu, dtype=float).reshape(-1, 1)
 		try:
-			(mu, sig, inv_sig, determ, mu2, sig2) = self.dimension_subset(self.mu, self.sig, otherMu, otherSig)
+			(valid_ids, chol, log_determ) = self.factor_subset(otherMu.ravel() != 0)
 		except InvalidVectorException:
-			return 0			
-		
-		traceterm = -.5 * trace(inv_sig * sig2)
-		mahal_term = -.5* transpose(mu - mu2) * inv_sig * (mu - mu2)
-		
-		return (traceterm + mahal_term)[0,0]
-	
+			return 0
+
+		sig2 = asarray(otherSig, dtype=float)[numpy.ix_(valid_ids, valid_ids)]
+		diff = asarray(self.mu, dtype=float).reshape(-1, 1)[valid_ids] - otherMu[valid_ids]
+
+		traceterm = -.5 * cho_solve((chol, True), sig2).trace()
+		mahal_term = -.5 * (solve_triangular(chol, diff, lower=True)**2).sum()
+		return traceterm + mahal_term
+
 	#Using diagonal components of the covariance matrix, compute the z-score for each entry of the vector
 	#(obs - mean)/stdev
 	#Params:
 		# vect - the vector to be standardized
 	#Returns: A standardized vector
 	def standardize_vector(self, vect):
+		vect = asarray(vect, dtype=float).reshape(-1, 1)
+		mu = asarray(self.mu, dtype=float).reshape(-1, 1)
+		sd = numpy.sqrt(asarray(self.sig, dtype=float).diagonal()).reshape(-1, 1)
 		tmp = zeros((len(vect), 1))
-		for i in range(len(vect)):
-			if(vect[i]==0):
-				tmp[i] = 0
-			else:
-				tmp[i] = (vect[i] - self.mu[i]) / sqrt(self.sig[i,i])
-		return tmp
\ No newline at end of file
+		valid = (vect != 0)
+		tmp[valid] = ((vect - mu) / sd)[valid]
+		return tmp
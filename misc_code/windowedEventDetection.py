@@ -6,76 +6,114 @@ Created on Tue Mar 17 15:18:52 2015
 """
 
 from eventDetection import keyFromDatetime, computeEventProperties, readOutlierScores, readZScoresTimeseries
-from measureOutliers import readGlobalPace, getExpectedPace
+from global_pace import load_global_pace
 from tools import logMsg, getQuantile, dateRange
 
-from datetime import datetime, timedelta
-import csv
-
-
-
-def crossesThreshold(start_date, end_date, mahal_timeseries, threshold):
-    for key in [keyFromDatetime(d) for d in dateRange(start_date, end_date, timedelta(hours=1))]:
-        if(key in mahal_timeseries and mahal_timeseries[key] > threshold):
-            return True
-
-
+from zscore_array import datetime_index
 
-def detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace_timeseries, 
-                          out_file, window_size=6, threshold_quant=.95):
+from datetime import datetime, timedelta
+import csv, math
+import numpy
+
+
+
+# Converts a time series into a dense array with one entry per hour.  Hours that
+# are missing from the time series are -inf, so they never cross a threshold
+# Params:
+    # mahal_timeseries - a dictionary which maps (date, hour, weekday) to a value
+    # start_date - a datetime, the hour of the first entry
+    # num_hours - the length of the array
+# Returns:
+    # a float array of length num_hours
+def hourlyArray(mahal_timeseries, start_date, num_hours):
+    keys = list(mahal_timeseries)
+    hour_ids = (datetime_index([date for (date, hour, weekday) in keys],
+                               [hour for (date, hour, weekday) in keys]) -
+                numpy.datetime64(start_date, 'h')).astype(int)
+    vals = numpy.array([mahal_timeseries[key] for key in keys])
+    
+    in_range = (hour_ids >= 0) & (hour_ids < num_hours)
+    hourly = numpy.empty(num_hours)
+    hourly.fill(-numpy.inf)
+    hourly[hour_ids[in_range]] = vals[in_range]
+    return hourly
+
+
+# Finds the windowed events for many window sizes and thresholds at once.  The time
+# range is cut into consecutive windows, and the maximum of each window is computed
+# with a reshaped view of the hourly array - a window crosses a threshold if its
+# maximum does.  An event is a run of consecutive windows that cross the threshold,
+# and is only reported once a window that does not cross it follows.
+# Params:
+    # mahal_timeseries - a dictionary which maps (date, hour, weekday) to a mahalanobis distance
+    # window_sizes - a list of window sizes, in hours
+    # thresholds - a list of thresholds
+    # start_date, end_date - the time range.  The last window may extend past end_date
+# Returns:
+    # a dictionary which maps (window_size, threshold) to a list of (event_start, event_end)
+    # datetimes.  event_end is the end of the last window, as in detectWindowedEvents()
+def sweepWindowedEvents(mahal_timeseries, window_sizes, thresholds,
+                        start_date=datetime(2010,1,1), end_date=datetime(2014,1,1)):
+    num_hours = int((end_date - start_date).total_seconds() / 3600)
+    max_window = max(window_sizes)
+    hourly = hourlyArray(mahal_timeseries, start_date,
+                         int(math.ceil(float(num_hours) / max_window)) * max_window)
+    thresholds = numpy.array(thresholds)
+    
+    events = {}
+    for window_size in window_sizes:
+        num_windows = int(math.ceil(float(num_hours) / window_size))
+        window_max = hourly[:num_windows*window_size].reshape(num_windows, window_size).max(axis=1)
+        
+        # One row per threshold - does each window cross it?
+        crosses = (window_max[None,:] > thresholds[:,None]).astype(numpy.int8)
+        changes = numpy.diff(crosses, axis=1)
+        for i in xrange(len(thresholds)):
+            start_ids = numpy.flatnonzero(changes[i] == 1) + 1
+            end_ids = numpy.flatnonzero(changes[i] == -1) + 1
+            if(crosses[i,0] == 1):
+                start_ids = numpy.concatenate([[0], start_ids])
+            events[(window_size, thresholds[i])] = [
+                (start_date + timedelta(hours=window_size*s), start_date + timedelta(hours=window_size*e))
+                for (s, e) in zip(start_ids.tolist(), end_ids.tolist())]
+    return events
+
+
+
+# Params:
+    # mahal_timeseries, zscore_timeseries - see eventDetection.readOutlierScores() and readZScoresTimeseries()
+    # global_pace - a global_pace.GlobalPaceSeries
+    # out_file - the CSV file where the events are saved
+    # window_size - the size of the windows, in hours
+    # threshold_quant - the quantile of mahalanobis distances that is considered an outlier
+    # sorted_mahal - a sorted array of the mahalanobis distances.  Built from
+        # mahal_timeseries if not given - pass it in to reuse it across many calls
+def detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace, 
+                          out_file, window_size=6, threshold_quant=.95, sorted_mahal=None):
                               
     logMsg("Detecting events at %d%% bound" % int(threshold_quant*100))
                               
-    #Sort the keys of the timeseries chronologically    
-    sorted_dates = sorted(mahal_timeseries)
-    
-    #Generate the list of values of R(t)
-    mahal_list = [mahal_timeseries[d] for d in sorted_dates]
-
-    
     #Use the quantile to determine the threshold
-    sorted_mahal = sorted(mahal_list)
+    if(sorted_mahal is None):
+        sorted_mahal = numpy.sort(mahal_timeseries.values())
     threshold = getQuantile(sorted_mahal, threshold_quant)
 
-    # Get the expected global pace    
-    (expected_pace_timeseries, sd_pace_timeseries) = getExpectedPace(global_pace_timeseries)        
-    
+    # Get the global pace and expected global pace (global_pace is a GlobalPaceSeries)
+    (global_pace_timeseries, expected_pace_timeseries, sd_pace_timeseries) = global_pace.as_dicts()
     
     
-    start_date = datetime(2010,1,1)
-    end_date = datetime(2014,1,1)
-    shift = timedelta(hours=window_size)
     
-    prev_above_threshold = False
-    current_event_start = None
-    current_event_end = None
     eventList = []
-    for date in dateRange(start_date, end_date, shift):
-        #print
-        #print(str(date))
-        #print(prev_above_threshold)
-        if(crossesThreshold(date, date+shift, mahal_timeseries, threshold)):
-            #print("CROSS")
-            if(not prev_above_threshold):
-                #print("RESET")
-                current_event_start = date
-                
-            current_event_end = date+shift
-            prev_above_threshold=True
-        else:
-            if(prev_above_threshold):
-                #print("*************OUTPUTTING************")
-                #print("%s -> %s" % (current_event_start, current_event_end))
-                start_key = keyFromDatetime(current_event_start)
-                end_key = keyFromDatetime(current_event_end)
-                event = computeEventProperties(start_key, end_key, mahal_timeseries, 
-                                           global_pace_timeseries, expected_pace_timeseries,
-                                           zscore_timeseries, sorted_mahal=sorted_mahal,
-                                           mahal_threshold=threshold)
-                #Add to list            
-                eventList.append(event)
-                
-            prev_above_threshold =False
+    event_ranges = sweepWindowedEvents(mahal_timeseries, [window_size], [threshold])
+    for (current_event_start, current_event_end) in event_ranges[(window_size, threshold)]:
+        start_key = keyFromDatetime(current_event_start)
+        end_key = keyFromDatetime(current_event_end)
+        event = computeEventProperties(start_key, end_key, mahal_timeseries, 
+                                   global_pace_timeseries, expected_pace_timeseries,
+                                   zscore_timeseries, sorted_mahal=sorted_mahal,
+                                   mahal_threshold=threshold)
+        #Add to list            
+        eventList.append(event)
     
     #Sort events by duration, in descending order
     eventList.sort(key = lambda x: x[5], reverse=True)
@@ -105,33 +143,42 @@ def getEventDuration(events, dateStr):
             return duration
     return 0
 
+# Same as getEventDuration(), but for the event ranges returned by sweepWindowedEvents()
+def getRangeDuration(event_ranges, dateStr):
+    for (start_date, end_date) in event_ranges:
+        if(str(start_date) <= dateStr and str(end_date) >= dateStr):
+            #Add 1 because start and end times are inclusive - see computeEventProperties()
+            return int((end_date - start_date + timedelta(hours=1)).total_seconds() / 3600)
+    return 0
+
 def performEventDurationTest():
     mahal_timeseries = readOutlierScores("results/outlier_scores.csv")
-    global_pace_timeseries = readGlobalPace("4year_features")
-    zscore_timeseries = readZScoresTimeseries("results/zscore.csv")
-    
     mahal_timeseries_fine = readOutlierScores("results/link_20_normalize_outlier_scores.csv")
     
+    # Each time series is sorted once, and reused for every threshold
+    sorted_mahal = numpy.sort(mahal_timeseries.values())
+    sorted_mahal_fine = numpy.sort(mahal_timeseries_fine.values())
+    
     threshold_vals = [.90,.91,.92,.93,.94,.95,.96,.97,.98,.99]
     window_sizes = [1,2,3,4,6,8,12,24]
+    
+    # Find the events for all window sizes and thresholds at once
+    thresholds = [getQuantile(sorted_mahal, q) for q in threshold_vals]
+    thresholds_fine = [getQuantile(sorted_mahal_fine, q) for q in threshold_vals]
+    events = sweepWindowedEvents(mahal_timeseries, window_sizes, thresholds)
+    events_fine = sweepWindowedEvents(mahal_timeseries_fine, window_sizes, thresholds_fine)
+    
     with open('results/threshold_experiment.csv', 'w') as f:
         w = csv.writer(f)
         w.writerow(['granularity', 'window','threshold', 'duration'])
         
         for window_size in window_sizes:
-            for threshold in threshold_vals:
-                print (window_size, threshold)
-                events = detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace_timeseries, 
-                      "results/events_windowed.csv", window_size=window_size, threshold_quant=threshold)
-                duration = getEventDuration(events, "2012-10-31")
-                w.writerow(["coarse", window_size, threshold, duration])
-    
-    
-                events= detectWindowedEvents(mahal_timeseries_fine, zscore_timeseries, global_pace_timeseries, 
-                    "results/link_20_normalize_events_windowed.csv", window_size=window_size,
-                    threshold_quant=threshold)      
-                duration = getEventDuration(events, "2012-10-31")
-                w.writerow(["fine", window_size, threshold, duration])
+            for i in xrange(len(threshold_vals)):
+                duration = getRangeDuration(events[(window_size, thresholds[i])], "2012-10-31")
+                w.writerow(["coarse", window_size, threshold_vals[i], duration])
+    
+                duration = getRangeDuration(events_fine[(window_size, thresholds_fine[i])], "2012-10-31")
+                w.writerow(["fine", window_size, threshold_vals[i], duration])
                           
                 
 
@@ -142,15 +189,15 @@ if(__name__=="__main__"):
     #performEventDurationTest()    
     
     mahal_timeseries = readOutlierScores("results/outlier_scores.csv")
-    global_pace_timeseries = readGlobalPace("4year_features")
+    global_pace = load_global_pace("4year_features")
     zscore_timeseries = readZScoresTimeseries("results/zscore.csv")
-    detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace_timeseries, 
+    detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace, 
                           "results/events_windowed.csv", window_size=8, threshold_quant=.95)
     
     mahal_timeseries = readOutlierScores("results/link_20_normalize_outlier_scores.csv")
-    global_pace_timeseries = readGlobalPace("4year_features")
+    global_pace = load_global_pace("4year_features")
     zscore_timeseries = readZScoresTimeseries("results/zscore.csv")
-    detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace_timeseries, 
+    detectWindowedEvents(mahal_timeseries, zscore_timeseries, global_pace, 
                           "results/link_20_normalize_events_windowed.csv", window_size=8,
                           threshold_quant=.95)                  
                           
@@ -27,66 +27,98 @@ import io
 import sys
 import time
 import numpy as np
+from scipy import sparse
+from scipy.sparse.linalg import norm as sparse_norm, svds
 from optparse import OptionParser
 from tools import logMsg
 
 def __iter_C(C, epsilon):
     """Helper for opursuit(...).
+
+    Shrinks the l2 norm of every column of C by epsilon (columns with
+    a smaller norm become 0).
     """
-    m,n=C.shape
-    output = np.zeros(C.shape)
-    for i in range(0,n):
-        tmp = C[:,i]
-        norm_tmp = np.linalg.norm(tmp, ord=2)
-        if norm_tmp > epsilon:
-            tmp = tmp - tmp*epsilon/norm_tmp;
-        else:
-            tmp = np.zeros((m,1))
-        output[:,i] = tmp.ravel();
-    return output
+    norms = np.sqrt(np.square(C).sum(axis=0))
+    # 1 - epsilon/norm, or 0 if norm <= epsilon
+    shrink = 1 - epsilon/np.maximum(norms, epsilon)
+    return np.multiply(C, shrink)
 
 
 def __iter_L(L, epsilon):
     """Helper for opursuit(...).
+
+    Shrinks the singular values of L by epsilon.  Only the components
+    that remain nonzero are multiplied back together.
     """
     U,S,V = np.linalg.svd(L, full_matrices=False)
-    S = np.diag(S)
-    for i in range(0,np.amin(S.shape)):
-        if S[i,i]>epsilon :
-            S[i,i] = S[i,i] - epsilon
-        elif S[i,i]<-epsilon:
-            S[i,i] = S[i,i] + epsilon
-        else:
-            S[i,i] = 0
-    return np.mat(U)*np.mat(S)*np.mat(V)
+    S = np.maximum(S - epsilon, 0)
+    r = np.count_nonzero(S)
+    return np.dot(U[:,:r] * S[:r], V[:r,:])
 
 
 
 def obj_func(L, C, gamma):
-    U,S,V = np.linalg.svd(L, full_matrices=False)
-    S = np.diag(S)
-    nuc_norm = 0.0
-    for i in range(0,np.amin(S.shape)):
-        #print("---- %f" % S[i,i])
-        nuc_norm += S[i,i]
-        if(S[i,i] < 0):
-            print("WHAAAAAT")
+    S = np.linalg.svd(L, compute_uv=False)
+    nuc_norm = S.sum()
     
-    l12 = 0.0
-    (rows, cols) = C.shape
-    for i in xrange(0,cols):
-        l12 += np.sqrt(sum(np.square(C[:,i])))
+    l12 = np.sqrt(np.square(np.asarray(C)).sum(axis=0)).sum()
     
     obj = nuc_norm + gamma*l12
     
     return obj
 
 
+def masked_diff(P, M, O, out=None):
+    """Computes (P - M) at the observed entries, and 0 elsewhere.
+
+    If M is a scipy.sparse matrix, its stored entries are the observed
+    values and O is ignored.  The result is then a sparse matrix with
+    the same pattern as M, so no dense observation matrix is needed.
+    Otherwise the result is written to out, if it is given (out may
+    be P itself).
+    """
+    if sparse.issparse(M):
+        if M.format != 'coo':
+            M = M.tocoo()
+        vals = np.asarray(P[M.row, M.col]).ravel() - M.data
+        return sparse.coo_matrix((vals, (M.row, M.col)), shape=M.shape)
+    out = np.subtract(P, M, out=out)
+    return np.multiply(out, O, out=out)
+
+
+def subtract_masked(Y, M_diff, scale):
+    """Computes Y - scale*M_diff, where M_diff comes from masked_diff().
+
+    For a sparse M_diff, only the observed entries of Y are updated.
+    """
+    if sparse.issparse(M_diff):
+        output = np.array(Y)
+        output[M_diff.row, M_diff.col] -= scale*M_diff.data
+        return output
+    return Y - scale*M_diff
+
+
+def fro_norm(M):
+    """Frobenius norm of a dense or scipy.sparse matrix.
+    """
+    if sparse.issparse(M):
+        return sparse_norm(M, 'fro')
+    return np.linalg.norm(M, 'fro')
+
+
+def spectral_norm(M):
+    """Largest singular value of a dense or scipy.sparse matrix.
+    """
+    if sparse.issparse(M):
+        return svds(M.astype(float), k=1, return_singular_vectors=False)[0]
+    return np.linalg.norm(M, ord=2)
+
+
 def compute_err(L,C,M,O):
-    m_diff = np.multiply(M - (L+C), O)
-    err = np.linalg.norm((m_diff), 'fro')
+    m_diff = masked_diff(L+C, M, O)
+    err = fro_norm(m_diff)
     
-    err_perc = err / np.linalg.norm(M, 'fro')
+    err_perc = err / fro_norm(M)
     return err_perc
 
 
@@ -105,25 +137,27 @@ def opursuit(M,O=None,gamma=None, tol_perc = 1e-06, eps_ratio=2):
     Paramters
     ---------
 
-    M : numpy matrix, shape (D, N)
+    M : numpy array or scipy.sparse matrix, shape (D, N)
         Input data, where D is the dimensionality of the data (e.g.,
         the number of pixels in an image) and N is the number of
-        data samples.
+        data samples.  If M is sparse, its stored entries are the
+        observed values and everything else is missing.
 
-    O : numpy matrix, shape (D, N), default: None
+    O : numpy array, shape (D, N), default: None
         Binary matrix, where a 1 at (i,j) signifies that the value
         has been observed, 0 signifies that this value is missing.
         In case O is 'None', all values are assumed to be existent.
+        Ignored if M is sparse.
 
     gamma : float
 
     Returns
     -------
 
-    L : numpy matrix, shape (D, N)
+    L : numpy array, shape (D, N)
         Low-rank approximation of M
 
-    C : numpy matrix, shape (D, N)
+    C : numpy array, shape (D, N)
         Sparse part of the deconvolution.
 
     term : float
@@ -137,8 +171,18 @@ def opursuit(M,O=None,gamma=None, tol_perc = 1e-06, eps_ratio=2):
     if gamma is None:
         raise Exception("\Gamma not given")
     # what is observable
-    if O is None:
-        O = np.ones(M.shape)
+    if O is None and not sparse.issparse(M):
+        O = np.ones(M.shape, dtype=M.dtype)
+
+    # work with plain arrays - numpy matrices allocate a new matrix for every
+    # slice and product, and their scalar products upcast float32 to float64
+    if not sparse.issparse(M):
+        M = np.asarray(M)
+        O = np.asarray(O)
+    else:
+        # masked_diff() reads the row/col indices of M in every iteration, so
+        # convert it to COO once here instead of once per iteration
+        M = M.tocoo()
 
     #print("TOL PERC = %f" % tol_perc)
 
@@ -146,20 +190,26 @@ def opursuit(M,O=None,gamma=None, tol_perc = 1e-06, eps_ratio=2):
     #(eta, delta, k) = (0.9, 1e-05, 0)
     (eta, delta, k) = (0.9, 1e-06, 0)
     
-    # (L_{k), C_{k})
-    L_cur = np.zeros(M.shape)
-    C_cur = np.zeros(M.shape)
+    # (L_{k), C_{k}) - these use the same precision as M (e.g. float32)
+    L_cur = np.zeros(M.shape, dtype=M.dtype)
+    C_cur = np.zeros(M.shape, dtype=M.dtype)
     # (L_{k-1), C_{k-1})
-    L_pre = np.zeros(M.shape)
-    C_pre = np.zeros(M.shape)
+    L_pre = np.zeros(M.shape, dtype=M.dtype)
+    C_pre = np.zeros(M.shape, dtype=M.dtype)
     # t_{k-1}, t_{k}
     t_pre = 1
     t_cur = 1
     # \mu_{k}, \bar{\mu}, for k=0
-    m_cur = 0.99 * np.linalg.norm(M, ord=2)
+    m_cur = 0.99 * spectral_norm(M)
     m_bar = delta * m_cur
     # tolerance
-    tol = tol_perc * np.linalg.norm(M, 'fro')
+    tol = tol_perc * fro_norm(M)
+
+    # work buffers which are overwritten in every iteration
+    YL = np.empty(M.shape, dtype=M.dtype)
+    YC = np.empty(M.shape, dtype=M.dtype)
+    diff_buf = np.empty(M.shape, dtype=M.dtype)
+    S_buf = np.empty(M.shape, dtype=M.dtype)
 
     stopped = False
     MAX_ITER = 100
@@ -173,30 +223,47 @@ def opursuit(M,O=None,gamma=None, tol_perc = 1e-06, eps_ratio=2):
 
 
         # lno. (3)
-        YL = L_cur + (t_pre-1)/t_cur *(L_cur-L_pre)
-        YC = C_cur + (t_pre-1)/t_cur *(C_cur-C_pre)
+        # YL = L_cur + (t_pre-1)/t_cur *(L_cur-L_pre), same for YC
+        momentum = (t_pre-1)/t_cur
+        np.subtract(L_cur, L_pre, out=YL)
+        YL *= momentum
+        YL += L_cur
+        np.subtract(C_cur, C_pre, out=YC)
+        YC *= momentum
+        YC += C_cur
 
         # helper for eqs. on line (4)
-        M_diff = np.multiply((YL+YC-M),O)
+        np.add(YL, YC, out=diff_buf)
+        M_diff = masked_diff(diff_buf, M, O, out=diff_buf)
 
         # lno. (4)
-        GL = YL - 0.5*M_diff
+        GL = subtract_masked(YL, M_diff, 0.5)
         L_new = __iter_L(GL, m_cur/eps_ratio)
 
         # lno. (4)
-        GC = YC - 0.5*M_diff
+        GC = subtract_masked(YC, M_diff, 0.5)
         C_new = __iter_C(GC, m_cur*gamma/eps_ratio)
 
         # lno. (7)
         t_new = (1 + np.sqrt(4*t_cur**2+1))/2
-        m_new = np.amax(eta*m_cur, m_bar)
+        m_new = max(eta*m_cur, m_bar)
 
         # check stopping crit.
-        S_L = 2*(YL-L_new)+(L_new+C_new-YL-YC)
-        S_C = 2*(YC-C_new)+(L_new+C_new-YL-YC)
-
-        fro_part0 = np.linalg.norm(S_L,ord='fro')
-        fro_part1 = np.linalg.norm(S_C,ord='fro')
+        # S_L = 2*(YL-L_new)+(L_new+C_new-YL-YC)
+        # S_C = 2*(YC-C_new)+(L_new+C_new-YL-YC)
+        # (M_diff is no longer needed, so its buffer is reused)
+        resid = np.add(L_new, C_new, out=diff_buf)
+        resid -= YL
+        resid -= YC
+
+        np.subtract(YL, L_new, out=S_buf)
+        S_buf *= 2
+        S_buf += resid
+        fro_part0 = np.linalg.norm(S_buf,ord='fro')
+        np.subtract(YC, C_new, out=S_buf)
+        S_buf *= 2
+        S_buf += resid
+        fro_part1 = np.linalg.norm(S_buf,ord='fro')
         term_crit = fro_part0**2 + fro_part1**2
 
         current_err_perc = compute_err(L_new,C_new,M,O)
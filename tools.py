@@ -8,6 +8,8 @@ Created on Sat May  3 12:33:42 2014
 """
 from datetime import datetime, timedelta
 import math
+from itertools import imap
+from random import Random
 import re
 #import psycopg2
 from numpy.linalg import norm
@@ -193,22 +195,34 @@ def getQuantile(sortedVals, quant):
 
 
 
+#Finds the position of a value in a list of sorted values - the index of the last value which
+#is <= testVal, or the nearest end of the list if testVal is out of range
+#Arguments:
+	#sortedVals - a list of numbers sorted in INCREASING order
+	#start, end - the range of sortedVals to search (end is non inclusive)
+	#testVal - the value to look for
 def binarySearch(sortedVals, start, end, testVal):
-	
-	if(testVal <= sortedVals[start]):
-		return start
-	
-	if(testVal >= sortedVals[end-1]):
-		return end-1
-	
-	m = int((start + end)/2)
-	
-	if(testVal < sortedVals[m]):
-		return binarySearch(sortedVals, start, m, testVal)
-	else:
-		return binarySearch(sortedVals, m, end, testVal)
+	while(True):
+		if(testVal <= sortedVals[start]):
+			return start
+		
+		if(testVal >= sortedVals[end-1]):
+			return end-1
+		
+		m = int((start + end)/2)
+		
+		if(testVal < sortedVals[m]):
+			end = m
+		else:
+			start = m
 
 
+#Approximates the quantile of a value, relative to a list of sorted values
+#Arguments:
+	#sortedVals - a list of numbers sorted in INCREASING order
+	#testVal - the value whose quantile is desired
+#Returns:
+	#A number between 0 and 1
 def findQuantile(sortedVals, testVal):
 	i = binarySearch(sortedVals, 0, len(sortedVals), testVal)
 	
@@ -216,6 +230,123 @@ def findQuantile(sortedVals, testVal):
 	return q
 
 
+
+#A mergeable sketch of a stream of numbers, which can estimate any quantile without
+#storing or sorting all of the values (in the style of the KLL sketch - see "Optimal
+#Quantile Approximation in Streams" by Karnin, Lang, and Liberty).  Values are inserted
+#into level 0.  When a level holds k values, it is sorted and every other value (with a
+#random offset) is promoted to the next level, where it stands for 2x as many values.
+#Until the first compaction, the sketch is exact.  Sketches built separately (e.g. one
+#per group or per worker) can be merged into one, which is the same as inserting all of
+#their values into one sketch.
+#The sketch is only useful when the values are not all in one place (e.g. partial sketches
+#built by several workers and merged).  If all of the values are already in memory, an exact
+#quantile (numpy.sort / numpy.partition, then getQuantile()) is both faster and reproducible.
+class QuantileSketch:
+	#Arguments:
+		#k - the capacity of each level.  Larger values are more accurate - the rank
+			#error is roughly log2(count/k) / k
+		#seed - a random seed for the compactions.  Fixed by default, so results are repeatable
+	def __init__(self, k=1000, seed=0):
+		self.k = k
+		self.levels = [[]]
+		self.count = 0
+		self.rng = Random(seed)
+		self.sorted_items = None #Cached (value, weight) list - see getSortedItems()
+	
+	#Builds a sketch from a list of values
+	@staticmethod
+	def fromValues(values, k=1000, seed=0):
+		sketch = QuantileSketch(k, seed)
+		for v in values:
+			sketch.insert(v)
+		return sketch
+	
+	#Adds a value to the sketch
+	def insert(self, x):
+		self.levels[0].append(x)
+		self.count += 1
+		self.sorted_items = None
+		if(len(self.levels[0]) >= self.k):
+			self.compress()
+	
+	#Promotes half of the values of each full level to the next level
+	def compress(self):
+		for h in xrange(len(self.levels)):
+			if(len(self.levels[h]) < self.k):
+				continue
+			if(h + 1 == len(self.levels)):
+				self.levels.append([])
+			items = sorted(self.levels[h])
+			
+			#If there is an odd number of items, one of them stays behind
+			num_promoted = len(items) - len(items) % 2
+			self.levels[h] = items[num_promoted:]
+			self.levels[h+1].extend(items[self.rng.randint(0, 1):num_promoted:2])
+		self.sorted_items = None
+	
+	#Merges another sketch into this one
+	#Arguments:
+		#other - a QuantileSketch.  It is not modified
+	#Returns:
+		#this sketch
+	def merge(self, other):
+		for h in xrange(len(other.levels)):
+			if(h == len(self.levels)):
+				self.levels.append([])
+			self.levels[h].extend(other.levels[h])
+		self.count += other.count
+		self.compress()
+		return self
+	
+	#Returns a sorted list of (value, weight) - each value stands for weight of the inserted values
+	def getSortedItems(self):
+		if(self.sorted_items is None):
+			self.sorted_items = sorted((x, 2**h) for h in xrange(len(self.levels)) for x in self.levels[h])
+		return self.sorted_items
+	
+	#Estimates a quantile of the inserted values.  While the sketch is exact, this is the
+	#same as getQuantile() on the sorted values
+	#Arguments:
+		#quant - A number between 0 and 1
+	def quantile(self, quant):
+		items = self.getSortedItems()
+		if(len(self.levels) == 1):
+			vals = [x for (x, w) in items]
+			i = min(int(math.floor(len(vals) * quant)), len(vals) - 1)
+			j = min(int(math.ceil(len(vals) * quant)), len(vals) - 1)
+			return vals[i] + (vals[j] - vals[i]) * (len(vals)*quant - i)
+		
+		#Otherwise, find the first value whose cumulative weight reaches the quantile
+		target = quant * self.count
+		cumulative = 0
+		for (x, w) in items:
+			cumulative += w
+			if(cumulative >= target):
+				return x
+		return items[-1][0]
+	
+	#Estimates the quantile of a value, i.e. the fraction of inserted values that are
+	#below it.  Values that are equal to it count as half, so for distinct values this
+	#matches findQuantile()
+	#Arguments:
+		#x - a number
+	#Returns:
+		#A number between 0 and 1
+	def rank(self, x):
+		items = self.getSortedItems()
+		below = 0
+		equal = 0
+		for (v, w) in items:
+			if(v < x):
+				below += w
+			elif(v == x):
+				equal += w
+			else:
+				break
+		return (below + equal / 2.0) / self.count
+
+
 #Performs addition in log-space without underflow error
 #Formally, returns:  log(e^v1 + e^v2 + e^v3 + ...)
 #See: http://stackoverflow.com/questions/9336701/how-to-deal-with-underflow-in-scientific-computing
@@ -291,6 +422,9 @@ class DefaultPool():
     def map(self, fun, args):
         return map(fun, args)
     
+    def imap_unordered(self, fun, args, chunksize=1):
+        return imap(fun, args)
+    
     def close(self):
         pass
     
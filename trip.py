@@ -7,6 +7,7 @@ Created on Wed Aug  6 14:17:57 2014
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
 from tools import *
+from numpy import array
 
 #A single taxi trip - contains information such as coordinates, times, etc...
 #Can be parsed from a line of a CSV file via the constructor
@@ -32,6 +33,7 @@ class Trip:
         self.dist = float(trip_distance)
         
         self.driver_id = hack_license
+        self.medallion = medallion
         
         
         #Parse the pickup datetime the fast way (defined in tools.csv) The slow way is commented out for reference
@@ -190,3 +192,17 @@ class Trip:
         
         s = "<<TRIP>>\n" + "driver " + self.driver_id + "\ntime " + str(self.time) + "\n" + "dist " + str(self.dist) + "\n"
         return s
+
+
+#The numeric Trip attributes which are stored as columns by tripColumns()
+TRIP_COLUMNS = ['fromLon', 'fromLat', 'toLon', 'toLat', 'dist', 'time', 'pace',
+                'straight_line_dist', 'winding_factor']
+
+#Converts a list of Trips into columnar arrays, so features can be processed in batches
+#Arguments:
+    #trips - a list of Trip objects
+#Returns:
+    #A dictionary which maps each attribute in TRIP_COLUMNS to a float array (one entry per trip)
+def tripColumns(trips):
+    return dict((col, array([getattr(trip, col) for trip in trips], dtype=float))
+                for col in TRIP_COLUMNS)
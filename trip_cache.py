@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+A binary, columnar cache of the parsed trip files.  Each trip_data_N.csv is
+converted once (during a scan - see trip_scan.py) into a directory with one raw
+binary file per column and a manifest:
+
+    <cache_dir>/FOIL2012/trip_data_1/
+        manifest.json       - number of rows, column dtypes, source file size and mtime
+        pickup.bin          - int32 pickup time (seconds since the epoch, UTC)
+        dropoff.bin         - int32 dropoff time
+        from_lon.bin, ...   - float32 coordinates and metered distance
+        driver.bin          - uint32 driver id (see below)
+        medallion.bin       - uint32 medallion id
+        error_code.bin      - uint8 Trip.isValid() code (ERR_OTHER for trips in the wrong month)
+
+Drivers (hack_licenses) and medallions are dictionary-encoded across the whole
+dataset (see id_dictionary.py).  The dictionaries are saved in the root of the
+cache, as <cache_dir>/drivers.txt and <cache_dir>/medallions.txt.  Each worker
+encodes its month with a local dictionary, and the ids are rewritten to the
+global ones after the scan.  anonymizeCache() writes a copy of the cache where
+both id columns are relabeled by a random permutation, without the dictionaries.
+
+Lines which cannot be parsed into a Trip are counted in the manifest, but not
+stored.  The columns are opened with numpy.memmap, so later passes read them at
+disk bandwidth instead of re-parsing the CSV.
+
+@author: Brian Donovan (briandonovan100@gmail.com)
+"""
+import os
+import json
+import shutil
+import calendar
+from numpy import array, memmap, dtype, int32, uint8, uint32, float32, float64, sqrt, where, bincount
+
+from tools import *
+from trip import *
+from trip_scan import TripConsumer, scanMonths, tripFileName, ERROR_NAMES, PARSE_ERROR
+from id_dictionary import IdDictionary, uniqueCounts
+
+
+CACHE_VERSION = 2
+
+# The stored columns and their types
+CACHE_COLUMNS = [('pickup', int32), ('dropoff', int32), ('from_lon', float32), ('from_lat', float32),
+                 ('to_lon', float32), ('to_lat', float32), ('dist', float32), ('driver', uint32),
+                 ('medallion', uint32), ('error_code', uint8)]
+
+# The dictionary-encoded columns, and the names of their dictionaries in the root of the cache
+ID_COLUMNS = [('driver', 'drivers'), ('medallion', 'medallions')]
+
+# The number of trips which are buffered before they are appended to the column files
+CHUNK_SIZE = 1000000
+
+
+
+# The file which contains one of the global id dictionaries (e.g. 'drivers')
+def dictionaryFile(cache_dir, dict_name):
+    return os.path.join(cache_dir, dict_name + ".txt")
+
+# Loads one of the global id dictionaries of the cache (e.g. 'drivers' or 'medallions')
+# Returns:
+    # an IdDictionary
+def loadDictionary(cache_dir, dict_name):
+    filename = dictionaryFile(cache_dir, dict_name)
+    if(not os.path.exists(filename)):
+        return IdDictionary()
+    return IdDictionary.load(filename)
+
+
+# The cache directory of a given month
+def monthCacheDir(cache_dir, year, month):
+    return os.path.join(cache_dir, "FOIL" + str(year), "trip_data_" + str(month))
+
+
+# Converts a (naive, UTC) datetime into seconds since the epoch
+def epochSeconds(dt):
+    return calendar.timegm(dt.utctimetuple())
+
+
+# The size and modification time of a source file - used to detect stale caches
+def sourceStamp(filename):
+    st = os.stat(filename)
+    return {"source": filename, "source_size": st.st_size, "source_mtime": int(st.st_mtime)}
+
+
+# Checks whether a month has been cached, from the current version of its trip file
+def isCached(cache_dir, year, month):
+    manifest_file = os.path.join(monthCacheDir(cache_dir, year, month), "manifest.json")
+    if(not os.path.exists(manifest_file)):
+        return False
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    stamp = sourceStamp(tripFileName(year, month))
+    return (manifest["version"] == CACHE_VERSION and
+            manifest["source_size"] == stamp["source_size"] and
+            manifest["source_mtime"] == stamp["source_mtime"])
+
+
+
+# Writes the cache of each scanned month.  Trips are buffered in python lists, and appended
+# to the column files every CHUNK_SIZE trips.  merge() converts the local driver and
+# medallion ids of each month to the global dictionaries.
+class TripCacheConsumer(TripConsumer):
+    # Params:
+        # cache_dir - the root of the cache
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def begin(self, year, month, header):
+        (self.year, self.month) = (year, month)
+        self.out_dir = monthCacheDir(self.cache_dir, year, month)
+        shutil.rmtree(self.out_dir, ignore_errors=True)
+        os.makedirs(self.out_dir)
+
+        self.column_fps = dict((name, open(os.path.join(self.out_dir, name + ".bin"), "wb"))
+                               for (name, col_type) in CACHE_COLUMNS)
+        self.buffers = dict((name, []) for (name, col_type) in CACHE_COLUMNS)
+        self.dicts = dict((name, IdDictionary()) for (name, dict_name) in ID_COLUMNS)
+        self.num_rows = 0
+        self.num_parse_errors = 0
+
+    def record(self, trip, line):
+        if(trip is None):
+            self.num_parse_errors += 1
+            return
+
+        error_code = trip.isValid()
+        if(trip.has_other_error and error_code == Trip.VALID):
+            error_code = Trip.ERR_OTHER
+
+        b = self.buffers
+        b['pickup'].append(epochSeconds(trip.pickup_time))
+        b['dropoff'].append(b['pickup'][-1] + trip.time)
+        b['from_lon'].append(trip.fromLon)
+        b['from_lat'].append(trip.fromLat)
+        b['to_lon'].append(trip.toLon)
+        b['to_lat'].append(trip.toLat)
+        b['dist'].append(trip.dist)
+        b['driver'].append(self.dicts['driver'].encode(trip.driver_id))
+        b['medallion'].append(self.dicts['medallion'].encode(trip.medallion))
+        b['error_code'].append(error_code)
+
+        if(len(b['pickup']) >= CHUNK_SIZE):
+            self.flush()
+
+    # Appends the buffered trips to the column files
+    def flush(self):
+        for (name, col_type) in CACHE_COLUMNS:
+            array(self.buffers[name], dtype=col_type).tofile(self.column_fps[name])
+        self.num_rows += len(self.buffers['pickup'])
+        self.buffers = dict((name, []) for (name, col_type) in CACHE_COLUMNS)
+
+    # Writes the remaining trips.  The manifest is written by merge(), after the ids are converted
+    # Returns:
+        # (out_dir, manifest, local_names) - local_names maps each id column to the names of its local ids
+    def finish(self):
+        self.flush()
+        for fp in self.column_fps.values():
+            fp.close()
+
+        manifest = {"version": CACHE_VERSION, "year": self.year, "month": self.month,
+                    "num_rows": self.num_rows, "num_parse_errors": self.num_parse_errors,
+                    "columns": [[name, dtype(col_type).str] for (name, col_type) in CACHE_COLUMNS]}
+        manifest.update(sourceStamp(tripFileName(self.year, self.month)))
+        local_names = dict((name, self.dicts[name].names) for (name, dict_name) in ID_COLUMNS)
+        return (self.out_dir, manifest, local_names)
+
+    # Rewrites the id columns of each month with global ids, then saves the global dictionaries
+    # and the manifests.  Months are processed in order, so the global ids are repeatable.
+    # Returns:
+        # a list of the cache directories which were written
+    def merge(self, results):
+        if(len(results) == 0):
+            return []
+        global_dicts = dict((name, loadDictionary(self.cache_dir, dict_name))
+                            for (name, dict_name) in ID_COLUMNS)
+        for (out_dir, manifest, local_names) in results:
+            for (name, dict_name) in ID_COLUMNS:
+                local_to_global = global_dicts[name].encodeAll(local_names[name])
+                if(manifest["num_rows"] > 0):
+                    col = memmap(os.path.join(out_dir, name + ".bin"), dtype=uint32, mode='r+',
+                                 shape=(manifest["num_rows"],))
+                    col[:] = local_to_global[col]
+                    col.flush()
+                    del col
+
+        for (name, dict_name) in ID_COLUMNS:
+            global_dicts[name].save(dictionaryFile(self.cache_dir, dict_name))
+
+        # The manifests are written last, so a partially written month is never considered cached
+        for (out_dir, manifest, local_names) in results:
+            with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+        return [out_dir for (out_dir, manifest, local_names) in results]
+
+
+
+# One cached month, with each column opened as a read-only memmap
+class CachedMonth:
+    # Params:
+        # cache_dir - the root of the cache
+        # year, month - the month to open
+    def __init__(self, cache_dir, year, month):
+        self.dir_name = monthCacheDir(cache_dir, year, month)
+        with open(os.path.join(self.dir_name, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+        self.num_rows = self.manifest["num_rows"]
+
+        self.columns = {}
+        for (name, col_type) in self.manifest["columns"]:
+            filename = os.path.join(self.dir_name, name + ".bin")
+            if(self.num_rows == 0):
+                self.columns[name] = array([], dtype=col_type)
+            else:
+                self.columns[name] = memmap(filename, dtype=col_type, mode='r', shape=(self.num_rows,))
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    # The number of distinct drivers in each group of trips
+    # Params:
+        # group_ids - an integer array with the group of each trip (e.g. OD pair and hour)
+        # num_groups - the total number of groups
+        # rows - an optional boolean mask or index array, to select a subset of the trips
+    def uniqueDrivers(self, group_ids, num_groups, rows=slice(None)):
+        return uniqueCounts(group_ids, self.columns['driver'][rows], num_groups)
+
+    # Counts the trips with each error code, in the same format as ErrorCountConsumer (see trip_scan.py)
+    def errorCounts(self):
+        counts = bincount(self.columns['error_code'], minlength=len(ERROR_NAMES) + 1)
+        counts[PARSE_ERROR] = self.manifest["num_parse_errors"]
+        return counts
+
+    # Computes the Trip features in the format of tripColumns() (see trip.py), with array operations
+    # Params:
+        # rows - an optional boolean mask or index array, to select a subset of the trips
+    def tripColumns(self, rows=slice(None)):
+        c = dict((name, self.columns[name][rows].astype(float64)) for name in
+                 ['from_lon', 'from_lat', 'to_lon', 'to_lat', 'dist', 'pickup', 'dropoff'])
+        time = c['dropoff'] - c['pickup']
+        dist = c['dist']
+
+        #Same formulas as Trip and tools.approxdist_nyc()
+        straight_line_dist = sqrt(4784.533643189461*(c['from_lat'] - c['to_lat'])**2 +
+                                  2743.9973517536278*(c['from_lon'] - c['to_lon'])**2)
+        safe_dist = where(dist == 0, 1, dist)
+        safe_straight = where(straight_line_dist <= 0, 1, straight_line_dist)
+        return {'fromLon': c['from_lon'], 'fromLat': c['from_lat'],
+                'toLon': c['to_lon'], 'toLat': c['to_lat'],
+                'dist': dist, 'time': time,
+                'pace': where(dist == 0, 0, time / safe_dist),
+                'straight_line_dist': straight_line_dist,
+                'winding_factor': where(straight_line_dist <= 0, 1, dist / safe_straight)}
+
+
+
+# The (year, month) of every cached month, in order
+def cachedMonths(cache_dir):
+    months = []
+    for year_dir in sorted(os.listdir(cache_dir)):
+        if(not year_dir.startswith("FOIL")):
+            continue
+        for month_dir in os.listdir(os.path.join(cache_dir, year_dir)):
+            if(os.path.exists(os.path.join(cache_dir, year_dir, month_dir, "manifest.json"))):
+                months.append((int(year_dir[len("FOIL"):]), int(month_dir[len("trip_data_"):])))
+    return sorted(months)
+
+
+# Writes an anonymized copy of the cache.  Each id column is relabeled with one random permutation
+# of its dictionary (see IdDictionary.permutation()), so the same driver keeps the same anonymous id
+# in every month, but the dictionaries which map the ids back to hack_licenses and medallions are
+# not copied.  The other columns are copied unchanged.
+# Params:
+    # cache_dir - the root of the cache
+    # out_dir - the root of the anonymized cache.  Must be different from cache_dir
+    # seed - a seed for the permutations.  If None, the relabeling is not repeatable
+# Returns:
+    # a list of the cache directories which were written
+def anonymizeCache(cache_dir, out_dir, seed=None):
+    perms = dict((name, loadDictionary(cache_dir, dict_name).permutation(seed))
+                 for (name, dict_name) in ID_COLUMNS)
+    id_names = set(perms)
+    out_dirs = []
+    for (year, month) in cachedMonths(cache_dir):
+        logMsg("Anonymizing %d-%d" % (year, month))
+        cached = CachedMonth(cache_dir, year, month)
+        month_dir = monthCacheDir(out_dir, year, month)
+        shutil.rmtree(month_dir, ignore_errors=True)
+        os.makedirs(month_dir)
+
+        for (name, col_type) in cached.manifest["columns"]:
+            filename = name + ".bin"
+            if(name not in id_names):
+                shutil.copyfile(os.path.join(cached.dir_name, filename), os.path.join(month_dir, filename))
+                continue
+            with open(os.path.join(month_dir, filename), "wb") as f:
+                for start in xrange(0, len(cached), CHUNK_SIZE):
+                    perms[name][cached[name][start:start+CHUNK_SIZE]].tofile(f)
+
+        # The manifest is written last, as in TripCacheConsumer.merge()
+        manifest = dict(cached.manifest)
+        manifest["anonymized"] = True
+        with open(os.path.join(month_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        out_dirs.append(month_dir)
+        del cached
+    return out_dirs
+
+
+
+# Converts the trip files of many months into the cache (in parallel).  Months which are
+# already cached from the current version of their trip file are skipped.
+# Params:
+    # months - a list of (year, month) tuples
+    # cache_dir - the root of the cache
+    # pool - a multiprocessing Pool
+    # overwrite - if True, months are converted even if they are already cached
+# Returns:
+    # a list of the cache directories which were written
+def buildTripCache(months, cache_dir="trip_cache", pool=DefaultPool(), overwrite=False):
+    todo = [(year, month) for (year, month) in months
+            if(overwrite or not isCached(cache_dir, year, month))]
+    logMsg("Caching %d of %d months" % (len(todo), len(months)))
+    [out_dirs] = scanMonths(todo, [TripCacheConsumer(cache_dir)], pool=pool)
+    return out_dirs
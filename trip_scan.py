@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+A single-pass driver for the monthly trip files.  Each month is read and parsed
+once, and every parsed trip is handed to a list of consumers (OD feature
+aggregation, feature histograms, error tallies, anonymized output, ...), so
+adding another per-trip analysis does not cost another pass over the data.
+
+A consumer is built in the main process, and is sent to the worker which scans
+a month.  There, begin() is called before the first trip, record() once per CSV
+line and finish() at the end of the file.  The per-month results of finish()
+are collected back in the main process and combined by merge().
+
+@author: Brian Donovan (briandonovan100@gmail.com)
+"""
+import csv
+import os
+from numpy import zeros, int64
+
+from tools import *
+from trip import *
+from anonymize import processChunk, CHUNK_LINES
+
+
+# The error codes of Trip.isValid(), in the same order as the global feature file
+ERROR_NAMES = ['VALID', 'BAD_GPS', 'ERR_GPS', 'BAD_LO_STRAIGHTLINE', 'BAD_HI_STRAIGHTLINE',
+               'ERR_LO_STRAIGHTLINE', 'ERR_HI_STRAIGHTLINE', 'BAD_LO_DIST', 'BAD_HI_DIST',
+               'ERR_LO_DIST', 'ERR_HI_DIST', 'BAD_LO_WIND', 'BAD_HI_WIND', 'ERR_LO_WIND',
+               'ERR_HI_WIND', 'BAD_LO_TIME', 'BAD_HI_TIME', 'ERR_LO_TIME', 'ERR_HI_TIME',
+               'BAD_LO_PACE', 'BAD_HI_PACE', 'ERR_LO_PACE', 'ERR_HI_PACE', 'ERR_DATE', 'ERR_OTHER']
+
+# An extra error code for lines which could not be parsed into a Trip
+PARSE_ERROR = len(ERROR_NAMES)
+
+
+
+# The name of the CSV file which contains the trips of a given month
+def tripFileName(year, month):
+    return "../new_chron/FOIL" + str(year) + "/trip_data_" + str(month) + ".csv"
+
+# The name of the CSV file which contains the fares of a given month
+def fareFileName(year, month):
+    return "../new_chron/FOIL" + str(year) + "/trip_fare_" + str(month) + ".csv"
+
+
+
+# The interface of a consumer.  Subclasses override the methods they need.
+class TripConsumer:
+    # Called in the worker process, before the first trip of a month
+    # Params:
+        # year, month - the month being scanned
+        # header - the header line of the trip file
+    def begin(self, year, month, header):
+        pass
+
+    # Called once per line of the trip file, in file order
+    # Params:
+        # trip - the parsed Trip, or None if the line could not be parsed.
+            # trip.has_other_error is set if the trip belongs to a different month
+        # line - the CSV line (a list of strings)
+    def record(self, trip, line):
+        pass
+
+    # Called in the worker process, after the last trip of a month
+    # Returns:
+        # the result for this month - it must be picklable
+    def finish(self):
+        return None
+
+    # Called in the main process to combine the results of all months
+    # Params:
+        # results - a list of values returned by finish(), in month order
+    # Returns:
+        # the final result of this consumer
+    def merge(self, results):
+        return results
+
+
+
+# Counts the trips with each error code of Trip.isValid().  Trips which are in the wrong
+# month file (or are otherwise valid but flagged) are counted as ERR_OTHER, as in GridSystem
+class ErrorCountConsumer(TripConsumer):
+    def begin(self, year, month, header):
+        self.counts = zeros(len(ERROR_NAMES) + 1, dtype=int64)
+
+    def record(self, trip, line):
+        if(trip is None):
+            self.counts[PARSE_ERROR] += 1
+            return
+        error_code = trip.isValid()
+        if(trip.has_other_error and error_code == Trip.VALID):
+            error_code = Trip.ERR_OTHER
+        self.counts[error_code] += 1
+
+    def finish(self):
+        return self.counts
+
+    def merge(self, results):
+        return sum(results, zeros(len(ERROR_NAMES) + 1, dtype=int64))
+
+
+
+# Saves the result of ErrorCountConsumer to a CSV file with columns error, count
+def saveErrorCounts(counts, filename):
+    with open(filename, "w") as f:
+        w = csv.writer(f)
+        w.writerow(["error", "count"])
+        for name, count in zip(ERROR_NAMES + ['PARSE_ERROR'], counts):
+            w.writerow([name, count])
+
+
+
+# Writes a copy of the trip and fare files, with encrypted medallions and hack_licenses.
+# The fare file is read in lockstep with the trip file.  Only lines in the correct month are kept.
+# Lines are buffered and encrypted in chunks by anonymize.processChunk(), the same code as
+# misc_code/anonymize_data.py, so each distinct id is only encrypted once per process.
+# Requires pycrypto, which is only imported when a month is scanned
+class AnonymizeConsumer(TripConsumer):
+    # Params:
+        # secrets - a dictionary which maps year --> AES key
+        # out_dir - the output directory, which contains one subdirectory per year (e.g. FOIL2012)
+    def __init__(self, secrets, out_dir="../anon"):
+        self.secrets = secrets
+        self.out_dir = out_dir
+
+    def begin(self, year, month, header):
+        (self.year, self.month) = (year, month)
+        self.bad_month = 0
+        self.trip_lines = []
+        self.fare_lines = []
+
+        out_prefix = os.path.join(self.out_dir, "FOIL" + str(year))
+        self.fare_in_fp = open(fareFileName(year, month), "r")
+        self.trip_out_fp = open(os.path.join(out_prefix, "trip_data_" + str(month) + ".csv"), "w")
+        self.fare_out_fp = open(os.path.join(out_prefix, "trip_fare_" + str(month) + ".csv"), "w")
+
+        # Copy the headers
+        self.trip_out_fp.write(",".join(header) + "\n")
+        self.fare_out_fp.write(self.fare_in_fp.next())
+
+    def record(self, trip, line):
+        fare_line = next(self.fare_in_fp, None)
+        if(fare_line is None):
+            return
+        # The trip file has no quoted fields, so joining the parsed line gives back the raw line
+        self.trip_lines.append(",".join(line) + "\n")
+        self.fare_lines.append(fare_line)
+        if(len(self.trip_lines) >= CHUNK_LINES):
+            self.flush()
+
+    # Encrypts and writes the buffered lines
+    def flush(self):
+        (trip_out, fare_out, bad_month, messages) = processChunk(
+            (self.year, self.month, self.secrets[self.year], self.trip_lines, self.fare_lines))
+        self.trip_out_fp.writelines(trip_out)
+        self.fare_out_fp.writelines(fare_out)
+        self.bad_month += bad_month
+        for msg in messages:
+            logMsg(msg)
+        self.trip_lines = []
+        self.fare_lines = []
+
+    def finish(self):
+        self.flush()
+        for fp in (self.fare_in_fp, self.trip_out_fp, self.fare_out_fp):
+            fp.close()
+        return tripFileName(self.year, self.month) + "  :  " + str(self.bad_month)
+
+
+
+# Reads one month of trips and feeds every line to each of the consumers
+# Params - one tuple for ease of use with Pool.map().  The tuple contains:
+    # year - an integer. the year containing the month of interest
+    # month - an integer (1 through 12) the month to be processed
+    # consumers - a list of TripConsumers
+# Returns:
+    # a list with the result of finish() for each consumer
+def scanMonth((year, month, consumers)):
+    infile = tripFileName(year, month)
+    logMsg("Scanning file " + infile)
+    with open(infile, "r") as f:
+        r = csv.reader(f)
+        header = r.next()
+        for consumer in consumers:
+            consumer.begin(year, month, header)
+
+        i = 0
+        for line in r:
+            try:
+                trip = Trip(line)
+            except ValueError:
+                trip = None
+
+            # Flag trips that are placed in the wrong month file
+            if(trip is not None and (year != trip.pickup_time.year or month != trip.pickup_time.month)):
+                trip.has_other_error = True
+
+            for consumer in consumers:
+                consumer.record(trip, line)
+
+            # Intermediate output
+            i += 1
+            if(i%1000000==0):
+                logMsg(infile + " read " + str(i) + " rows")
+
+    return [consumer.finish() for consumer in consumers]
+
+
+# Scans many months (in parallel) with a list of consumers, and merges the results
+# Params:
+    # months - a list of (year, month) tuples
+    # consumers - a list of TripConsumers
+    # pool - a multiprocessing Pool
+# Returns:
+    # a list with the merged result of each consumer
+def scanMonths(months, consumers, pool=DefaultPool()):
+    month_results = pool.map(scanMonth, [(year, month, consumers) for (year, month) in months])
+    return [consumer.merge([results[i] for results in month_results])
+            for i, consumer in enumerate(consumers)]
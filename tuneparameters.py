@@ -13,7 +13,8 @@ from numpy import  square
 from numpy import column_stack, arange
 import numpy as np
 
-from data_preprocessing import remove_bad_dimensions_grouped
+from data_preprocessing import remove_bad_dimensions_grouped, as_data_matrix, observation_matrix
+from data_preprocessing import rank_threshold
 from op_modified import opursuit, multiple_op, obj_func
 
 
@@ -36,7 +37,7 @@ class ConvergenceException:
 
 def fast_rank(A):
     u, s, v = np.linalg.svd(A)
-    rank = np.sum(s > .0001)
+    rank = np.sum(s > rank_threshold(s, A.dtype, max(A.shape)))
     return rank
 
 
@@ -102,7 +103,7 @@ def guess_param(current_val, lo_bound, hi_bound, SEARCH_RATE=5, BACKTRACK_PROB=.
 # in such a way that the number of outliers in the C matrix and the rank of the L
 # matrix meet some target values
 # Params:
-    # vectors - The data to perform RPCA on, a list of Numpy column vectors
+    # vectors - The data to perform RPCA on, a list of Numpy column vectors (or a matrix)
     # gamma_guess - an intial guess for gamma
     # tol_guess - an initial guess for the tolerance
     # lo_target_c_perc - lower bound for the desired percentage of outliers
@@ -119,8 +120,8 @@ def tune_gamma_and_tol(vectors, gamma_guess=.5, tol_guess=1e-2,
     num_resets = 0
 
     
-    data_matrix = column_stack(vectors)
-    O = (data_matrix!=0)*1 # Observation matrix - 1 where we have data, 0 where we do not
+    data_matrix = as_data_matrix(vectors)
+    O = observation_matrix(data_matrix) # Observation matrix - 1 where we have data, 0 where we do not
 
     #Initially, we don't have any bounds on our search
     lo_gamma = None
@@ -286,8 +287,8 @@ def tryParameters((data_matrix, O, tol_perc, gamma)):
 
 
 def sweepGammaAndTol(vectors, pool=DefaultPool()):
-    data_matrix = column_stack(vectors)
-    O = (data_matrix!=0)*1 # Observation matrix - 1 where we have data, 0 where we do not
+    data_matrix = as_data_matrix(vectors)
+    O = observation_matrix(data_matrix) # Observation matrix - 1 where we have data, 0 where we do not
     
     it = paramIterator(data_matrix, O)
     vals = pool.map(tryParameters, it)
@@ -306,8 +307,8 @@ def sweepGammaAndTol(vectors, pool=DefaultPool()):
 
 
 def compare_eps(vectors):
-    data_matrix = column_stack(vectors)
-    O = (data_matrix!=0)*1 # Observation matrix - 1 where we have data, 0 where we do not
+    data_matrix = as_data_matrix(vectors)
+    O = observation_matrix(data_matrix) # Observation matrix - 1 where we have data, 0 where we do not
     
     
     gamma = .5
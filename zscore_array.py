@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Binary storage for the z-score output of measureOutliers.py.  The z-scores are
+kept in one (hours x links) float32 array, saved in .npy format so it can be
+memory-mapped, along with a datetime index of the rows and the names of the
+columns.  One hour across all links, or one link over a time window, is a
+slice of this array.  A CSV export in the old format (Date, Hour, Weekday,
+one column per link) is kept for the R scripts.
+
+@author: Brian Donovan (briandonovan100@gmail.com)
+"""
+import csv
+from datetime import datetime
+from numpy import array, asarray, datetime64, timedelta64, float32, save, load
+from numpy import searchsorted, all as np_all, diff
+from numpy.lib.format import open_memmap
+
+
+HOUR = timedelta64(1, 'h')
+
+
+# The files which make up a z-score array
+# Params:
+    # filename_base - e.g. "results/coarse_features_imb20_k10_RPCAtune_10000000pcs_5percmiss"
+# Returns:
+    # (array_file, times_file, names_file)
+def zscore_files(filename_base):
+    return (filename_base + "_zscore.npy", filename_base + "_zscore_times.npy",
+            filename_base + "_zscore_names.csv")
+
+
+# Converts a datetime (or a numpy.datetime64) to a numpy.datetime64 in hours
+def to_hour(t):
+    return datetime64(t, 'h')
+
+
+# Builds the datetime index of a list of timeslices
+# Params:
+    # dates - a list of date strings (e.g. "2012-10-29")
+    # hours - a list of integer hours
+# Returns:
+    # a numpy.datetime64[h] array
+def datetime_index(dates, hours):
+    return array(dates, dtype='datetime64[D]').astype('datetime64[h]') + asarray(hours) * HOUR
+
+
+# Creates a new, empty z-score array on disk.  The rows are filled in by the caller,
+# and written when the returned memmap is flushed or deleted.
+# Params:
+    # filename_base - see zscore_files()
+    # times - the datetime64[h] index of the rows, in increasing order
+    # names - the names of the columns (links or trips)
+# Returns:
+    # a writable (len(times) x len(names)) float32 memmap
+def create_zscore_array(filename_base, times, names):
+    (array_file, times_file, names_file) = zscore_files(filename_base)
+    times = asarray(times, dtype='datetime64[h]')
+    save(times_file, times)
+    with open(names_file, "w") as f:
+        w = csv.writer(f)
+        for name in names:
+            w.writerow([name])
+    return open_memmap(array_file, mode='w+', dtype=float32, shape=(len(times), len(names)))
+
+
+
+# A memory-mapped (hours x links) z-score array, as written by create_zscore_array()
+class ZscoreArray:
+    # Params:
+        # filename_base - see zscore_files()
+    def __init__(self, filename_base):
+        (array_file, times_file, names_file) = zscore_files(filename_base)
+        self.zscores = open_memmap(array_file, mode='r')
+        self.times = load(times_file)
+        with open(names_file, "r") as f:
+            self.names = [line[0] for line in csv.reader(f)]
+        self.name_index = dict((name, i) for i, name in enumerate(self.names))
+
+        # If there is one row per hour, row numbers can be computed directly
+        self.contiguous = (len(self.times) > 0 and np_all(diff(self.times) == HOUR))
+
+    # The row of a given hour, or None if it is not in the index
+    def row(self, t):
+        t = to_hour(t)
+        if(self.contiguous):
+            i = int((t - self.times[0]) / HOUR)
+        else:
+            i = int(searchsorted(self.times, t))
+        if(i < 0 or i >= len(self.times) or self.times[i] != t):
+            return None
+        return i
+
+    # The rows in the time window [start, end)
+    def row_range(self, start, end):
+        if(self.contiguous and len(self.times) > 0):
+            first = int((to_hour(start) - self.times[0]) / HOUR)
+            last = int((to_hour(end) - self.times[0]) / HOUR)
+            return (min(max(first, 0), len(self.times)), min(max(last, 0), len(self.times)))
+        return (int(searchsorted(self.times, to_hour(start))),
+                int(searchsorted(self.times, to_hour(end))))
+
+    # The z-scores of all links at one hour, or None if the hour is missing
+    def hour(self, t):
+        i = self.row(t)
+        if(i is None):
+            return None
+        return self.zscores[i]
+
+    # The z-scores of all links in the time window [start, end)
+    # Returns:
+        # (times, zscores) - the datetime64[h] index and the corresponding rows
+    def window(self, start, end):
+        (first, last) = self.row_range(start, end)
+        return self.times[first:last], self.zscores[first:last]
+
+    # The z-scores of one link, over the whole time period or the window [start, end)
+    # Params:
+        # link - the name or the column number of the link
+    # Returns:
+        # (times, zscores)
+    def link_series(self, link, start=None, end=None):
+        col = self.name_index[link] if link in self.name_index else link
+        (first, last) = (0, len(self.times))
+        if(start is not None or end is not None):
+            (first, last) = self.row_range(self.times[0] if start is None else start,
+                                           self.times[-1] + HOUR if end is None else end)
+        return self.times[first:last], self.zscores[first:last, col]
+
+    # Writes the z-scores to a CSV file with columns Date, Hour, Weekday, and one
+    # column per link
+    def export_csv(self, out_file):
+        with open(out_file, "w") as f:
+            w = csv.writer(f)
+            w.writerow(['Date', 'Hour', 'Weekday'] + self.names)
+            for i in xrange(len(self.times)):
+                dt = self.times[i].astype(datetime)
+                w.writerow([dt.strftime('%Y-%m-%d'), dt.hour, dt.strftime('%A')] +
+                           self.zscores[i].tolist())